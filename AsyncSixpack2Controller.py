@@ -0,0 +1,785 @@
+#!/usr/bin/env python
+
+import asyncio
+from time import monotonic
+from contextlib import asynccontextmanager
+from Sixpack2Controller import Sixpack2Controller
+from AsyncSixpack2Motor import AsyncSixpack2Motor
+from codec import (FRAME_LENGTH, COMMANDS, GET_UNIT_INFO, GET_POS,
+                   QUERY_ALL, REF_SEARCH_PARAMS)
+from constants import (BAUDRATE_DIVISORS, DEFAULT_BAUDRATE, BITS_PER_BYTE,
+                       PROBE_TIMEOUT, PROBE_ATTEMPTS, MAX_MOTORS,
+                       TELEMETRY_SHARE, _check_baudrate, _parse_addr,
+                       _parse_mask)
+from codec import FrameBuffer
+from portstate import load_port_state, save_port_state
+from scheduler import AsyncBusScheduler, default_classes
+from worker import AsyncIOWorker, _is_delayed
+
+
+class AsyncSixpack2Controller(Sixpack2Controller):
+    """
+    asyncio flavour of Sixpack2Controller. All methods of the controller
+    and its motors that talk to the PACK return awaitables:
+
+        ctrl = AsyncSixpack2Controller(num_motors=2)
+        await ctrl[0].start_ramp(1000)
+        posact, action, stop_status = await ctrl[0].get_pos()
+
+    Frames are encoded (and parameters checked) when the method is called,
+    the serial port is read without blocking the event loop. Each request
+    waits at most timeout seconds for its reply (None: adaptive, see
+    rtt.py); wrap single calls in asyncio.wait_for() for a different
+    deadline or cancel them like any other task.
+    """
+
+    # =========================================================================
+    # Initialize Sixpack Controller
+    # =========================================================================
+
+    def __init__(self, port='/dev/ttySIXPACK',
+                 baudrate=19200, timeout=1.0,
+                 sixpack_addr='00', resp_addr='00', num_motors=1,
+                 transport=None, lazy=False):
+
+        Sixpack2Controller.__init__(self, port=port, baudrate=baudrate,
+                                    timeout=0, sixpack_addr=sixpack_addr,
+                                    resp_addr=resp_addr,
+                                    num_motors=num_motors,
+                                    transport=transport, lazy=lazy)
+
+        self.timeout = timeout
+
+        self._batch = None
+        self._rx = FrameBuffer()
+        self._rx_waiter = None
+        self._lock = None
+        self._loop = None
+
+    def _create_motors(self):
+        for motno in range(self.num_motors):
+            motor = AsyncSixpack2Motor(self, motno)
+            self.append(motor)
+
+    # ========================================================================
+    # Non-blocking serial transport
+    # ========================================================================
+
+    def _attach(self):
+        """
+        Registers the serial port with the running event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return None
+        if self._loop is not None:
+            raise RuntimeError('controller is attached to another event loop')
+
+        if not self._connected:
+            self._connect()
+        self._loop = loop
+        self._lock = asyncio.Lock()
+        loop.add_reader(self._ser.fileno(), self._on_readable)
+
+        return None
+
+    def _detach(self):
+
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._ser.fileno())
+        self._loop = None
+
+        return None
+
+    def _on_readable(self):
+
+        data = self._ser.read(self._ser.in_waiting or 1)
+        if not data:
+            return None
+
+        self._rx.feed(data)
+
+        waiter = self._rx_waiter
+        if (waiter is not None and not waiter.done()
+                and len(self._rx) >= FRAME_LENGTH):
+            waiter.set_result(None)
+
+        return None
+
+    async def _read_frame(self, request, prefix):
+
+        while True:
+            reply = self._rx.take(request, prefix)
+            if reply is not None:
+                return reply
+            self._rx_waiter = self._loop.create_future()
+            try:
+                await self._rx_waiter
+            finally:
+                self._rx_waiter = None
+
+    async def _read_reply(self, frame, request, timeout=None):
+        """
+        Waits for and decodes the reply to the given request frame,
+        skipping bytes which do not belong to it (see codec.FrameBuffer)
+        """
+
+        if timeout is None:
+            timeout = self._reply_timeout(frame)
+
+        before = self._rx.discarded
+        try:
+            return await asyncio.wait_for(
+                self._read_frame(request, request.reply_prefix(frame)),
+                timeout)
+        except asyncio.TimeoutError:
+            discarded = self._rx.discarded - before
+            if discarded >= FRAME_LENGTH:
+                raise UserWarning('Warning: no reply to {0} among the'
+                                  ' received bytes ({1} discarded)'
+                                  .format(request.name, discarded))
+            raise TimeoutError('no complete reply received for {0} within'
+                               ' {1} s'.format(request.name, timeout))
+        finally:
+            discarded = self._rx.discarded - before
+            if discarded and self._metrics is not None:
+                self._metrics.discard(request.opcode, discarded)
+
+    def _discard_stale(self, frame):
+
+        discarded = self._rx.discard()
+        if discarded and self._metrics is not None:
+            self._metrics.discard(frame[1], discarded)
+
+        return None
+
+    @asynccontextmanager
+    async def _hold_port(self, frames):
+        """
+        Holds the port for frames: in turn by priority with the worker
+        (see start_worker), first come first served without
+        """
+
+        self._attach()
+        worker = self._worker
+        if worker is None:
+            async with self._lock:
+                yield
+            return
+
+        async with worker.port(frames):
+            async with self._lock:
+                yield
+
+    async def _write(self, frame, command=None, params=None):
+        """
+        Writes a command frame; a setting is recorded in the shadow only
+        once it is written, so that an awaitable which is never awaited,
+        cancelled or fails does not suppress the next identical setter
+        """
+
+        worker = self._worker
+        if worker is not None and worker.preempts(frame):
+            # the port waits for a delayed reply
+            self._attach()
+            self._write_now(frame, command, params)
+            worker.preempted += 1
+            return None
+
+        async with self._hold_port([frame]):
+            self._write_now(frame, command, params)
+
+        return None
+
+    def _write_now(self, frame, command, params):
+
+        metrics = self._metrics
+        if metrics is not None:
+            start = metrics.before(frame)
+        self._ser.write(frame)
+        if command is not None:
+            self._store(command, params)
+        if metrics is not None:
+            metrics.after(frame, None, start)
+
+        return None
+
+    async def _async_exchange(self, frame, request, parse, timeout,
+                              retries=None):
+        """
+        Awaitable counterpart of Sixpack2Controller._exchange, which it does
+        not override: it takes parse and returns the parsed reply
+        """
+
+        delayed = _is_delayed(frame)
+        adaptive = timeout is None and self.timeout is None
+        if retries is None:
+            retries = self.retries
+        if not request.idempotent or delayed:
+            retries = 0
+        # emergency commands may be written while waiting (see _write)
+        worker = self._worker if delayed else None
+
+        async with self._hold_port([frame]):
+            metrics = self._metrics
+            attempt = 0
+            while True:
+                # drop late replies of timed out or cancelled requests
+                self._discard_stale(frame)
+                if metrics is not None:
+                    start = metrics.before(frame)
+                self._ser.write(frame)
+                sent = monotonic()
+                if worker is not None:
+                    worker.waiting = True
+                try:
+                    reply = await self._read_reply(frame, request, timeout)
+                    break
+                except (TimeoutError, UserWarning) as error:
+                    if metrics is not None:
+                        metrics.after(frame, None, start, error)
+                    if (adaptive and not delayed
+                            and isinstance(error, TimeoutError)):
+                        self._rtt.backoff(frame[1])
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+                    if metrics is not None:
+                        metrics.retry(frame[1])
+                finally:
+                    if worker is not None:
+                        worker.waiting = False
+
+            if not attempt and not delayed:
+                self._rtt.sample(frame[1], monotonic() - sent)
+            if metrics is not None:
+                metrics.after(frame, reply, start)
+
+        if parse is None:
+            return reply
+        return parse(reply)
+
+    # ========================================================================
+    # Send command and request reply
+    # ========================================================================
+
+    def _send_command(self, command, *params):
+        """
+        Encodes command and returns an awaitable sending it to the PACK.
+        Inside a transaction, and for settings the PACK already holds
+        (see Sixpack2Controller._holds), an already completed future is
+        returned.
+        """
+
+        command.pack_into(self._cmdbuf, self._sixpack_addr, *params)
+        frame = bytes(self._cmdbuf)
+        setting = command.keys is not None
+        skip = setting and self._holds(command, params)
+
+        if skip or self._batch is not None:
+            if not skip:
+                if setting:
+                    # forgotten again if the transaction fails
+                    self._store(command, params)
+                self._batch.append((frame, None, None, None))
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(None)
+            return done
+
+        if setting:
+            return self._write(frame, command, params)
+        return self._write(frame)
+
+    def _send_request(self, request, *params, parse=None, timeout=None):
+        """
+        Encodes request and returns an awaitable yielding the (parsed)
+        reply. Inside a transaction the request is queued and a future is
+        returned, which is resolved when the transaction is flushed.
+        """
+
+        request.pack_into(self._reqbuf, self._sixpack_addr, *params)
+        frame = bytes(self._reqbuf)
+
+        if self._batch is not None:
+            future = asyncio.get_running_loop().create_future()
+            self._batch.append((frame, request, parse, future))
+            return future
+
+        return self._async_exchange(frame, request, parse, timeout)
+
+    # ========================================================================
+    # Transactions
+    # ========================================================================
+
+    @asynccontextmanager
+    async def transaction(self, gap=0):
+        """
+        Same as Sixpack2Controller.transaction, but to be used with
+        'async with'. Inside the block the controller and motor methods
+        must not be awaited; requests return futures which can be awaited
+        after the block.
+        """
+
+        if self._batch is not None:
+            yield self
+            return
+
+        self._batch = []
+        try:
+            yield self
+        except BaseException:
+            self._forget(frame for frame, _, _, _ in self._batch)
+            self._batch = None
+            raise
+
+        batch, self._batch = self._batch, None
+        await self._flush(batch, gap)
+
+    async def resync(self):
+        """
+        Same as Sixpack2Controller.resync, to be awaited
+        """
+
+        stale = [key for key in self._written if key in self._stale]
+        async with self.transaction():
+            for key in stale:
+                self._send_command(COMMANDS[key[0]], *self._written[key])
+
+        return len(stale)
+
+    def wait_until_idle(self, mask='111111', timeout=None):
+        """
+        Same as Sixpack2Controller.wait_until_idle, returns an awaitable
+        (a future inside a transaction)
+        """
+
+        mask = _parse_mask(mask)
+        if timeout is None:
+            if self._batch is None:
+                return self._wait_until_idle(mask)
+            timeout = self._wait_timeout(self._motors_in(mask))
+
+        return self._send_request(QUERY_ALL, self._resp_addr, mask,
+                                  parse=self._parse_query_all,
+                                  timeout=timeout)
+
+    async def _wait_until_idle(self, mask):
+
+        for motor in self._motors_in(mask):
+            if motor._move_unpredicted():
+                await motor.get_pos()
+
+        return await self._send_request(
+            QUERY_ALL, self._resp_addr, mask, parse=self._parse_query_all,
+            timeout=self._wait_timeout(self._motors_in(mask)))
+
+    async def apply_profile(self, profile, force=False):
+        """
+        Same as Sixpack2Controller.apply_profile, to be awaited
+        """
+
+        frames = self._profile_frames(profile, force)
+
+        if any(command is REF_SEARCH_PARAMS for command, _ in frames):
+            await self.wait_until_idle('111111')
+
+        if force:
+            self._stale.update(command.key(params)
+                               for command, params in frames)
+        async with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+
+        return len(frames)
+
+    async def move_linear(self, targets):
+        """
+        Same as Sixpack2Controller.move_linear, to be awaited
+        """
+
+        targets = self._linear_targets(targets)
+
+        now = monotonic()
+        moves = {}
+        for motor, targetpos in targets.items():
+            startpos = motor._startpos(now)
+            if startpos is None:
+                startpos = (await motor.get_pos())[0]
+            moves[motor] = (startpos, targetpos)
+
+        frames, nominal, duration = self._linear_frames(moves)
+
+        mask = 0
+        async with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+            for motor, targetpos in targets.items():
+                motor.set_targetpos(targetpos)
+                mask |= 1 << motor._motno
+            self.start_multi_movement(mask)
+        self._nominal.update(nominal)
+
+        return duration
+
+    async def restore_limits(self, motors=None):
+        """
+        Same as Sixpack2Controller.restore_limits, to be awaited
+        """
+
+        frames = self._nominal_frames(motors)
+        async with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+
+        return len(frames)
+
+    async def _flush(self, batch, gap=0):
+
+        if not batch:
+            return None
+
+        async with self._hold_port(frame for frame, _, _, _ in batch):
+            self._discard_stale(batch[0][0])
+
+            metrics = self._metrics
+            if metrics is not None:
+                for frame, _, _, _ in batch:
+                    start = metrics.before(frame)
+
+            try:
+                if gap > 0:
+                    for i, (frame, _, _, _) in enumerate(batch):
+                        if i:
+                            await asyncio.sleep(gap)
+                        self._ser.write(frame)
+                else:
+                    self._ser.write(b''.join(frame
+                                             for frame, _, _, _ in batch))
+            except BaseException:
+                self._forget(frame for frame, _, _, _ in batch)
+                raise
+
+            # the replies queue up behind the frames of the batch
+            backlog = 0.0
+            if self.timeout is None:
+                backlog = (len(batch) * FRAME_LENGTH * BITS_PER_BYTE
+                           / self._ser.baudrate)
+
+            error = None
+            failed = []
+            for frame, request, parse, future in batch:
+                if request is None:
+                    if metrics is not None:
+                        metrics.after(frame, None, start)
+                    continue
+                if error is not None:
+                    failed.append((frame, request, parse, future, error))
+                    continue
+                try:
+                    reply = await self._read_reply(
+                        frame, request, self._reply_timeout(frame) + backlog)
+                    if metrics is not None:
+                        metrics.after(frame, reply, start)
+                    if not future.done():
+                        future.set_result(reply if parse is None
+                                          else parse(reply))
+                except (TimeoutError, UserWarning) as exc:
+                    if metrics is not None:
+                        metrics.after(frame, None, start, exc)
+                    if isinstance(exc, TimeoutError):
+                        # the PACK stopped answering, fail the remaining
+                        error = exc
+                    failed.append((frame, request, parse, future, exc))
+                except Exception as exc:
+                    if not future.done():
+                        future.set_exception(exc)
+
+        # repeat the idempotent ones until a repetition times out as well
+        stopped = not self.retries
+        for frame, request, parse, future, exc in failed:
+            if future.done():
+                continue
+            if stopped or not request.idempotent or _is_delayed(frame):
+                future.set_exception(exc)
+                continue
+            if metrics is not None:
+                metrics.retry(frame[1])
+            try:
+                future.set_result(await self._async_exchange(
+                    frame, request, parse, None))
+            except (TimeoutError, UserWarning) as exc:
+                if isinstance(exc, TimeoutError):
+                    stopped = True
+                future.set_exception(exc)
+            except Exception as exc:
+                future.set_exception(exc)
+
+        return None
+
+    # ========================================================================
+    # Status cache
+    # ========================================================================
+
+    def start_poller(self, rate=20.0, motors=None):
+        """
+        Starts a task refreshing position, velocity and action of the
+        given motors (default: all) rate times per second
+        """
+
+        if self._poller is not None:
+            raise RuntimeError('status poller is already running')
+
+        motors = list(self) if motors is None else list(motors)
+        self._poller = asyncio.get_running_loop().create_task(
+            self._poll(motors, 1.0 / rate))
+
+        return self._poller
+
+    def stop_poller(self):
+
+        poller, self._poller = self._poller, None
+        if isinstance(poller, AsyncBusScheduler):
+            poller.stop()
+        elif poller is not None:
+            poller.cancel()
+
+        return None
+
+    async def _poll(self, motors, period):
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            for motor in motors:
+                try:
+                    await motor.get_pos()
+                    await motor.get_vel()
+                except (TimeoutError, UserWarning, ValueError):
+                    pass
+
+            deadline = max(deadline + period, loop.time())
+            await asyncio.sleep(deadline - loop.time())
+
+    def start_worker(self):
+        """
+        Same as Sixpack2Controller.start_worker, without a thread (see
+        worker.AsyncIOWorker): the tasks waiting for the port take turns
+        by priority, stop_motors and abort_ref_search are written even
+        while wait_until_idle waits for its delayed reply.
+        Returns the worker.
+        """
+
+        if self._worker is not None:
+            raise RuntimeError('I/O worker is already running')
+
+        self._worker = AsyncIOWorker()
+
+        return self._worker
+
+    def start_scheduler(self, classes=None, share=TELEMETRY_SHARE,
+                        **options):
+        """
+        Same as Sixpack2Controller.start_scheduler, as a task of the
+        running event loop (see scheduler.AsyncBusScheduler)
+        """
+
+        if self._poller is not None:
+            raise RuntimeError('status poller is already running')
+
+        if self._worker is None:
+            self.start_worker()
+        if classes is None:
+            classes = default_classes(self, **options)
+        self._poller = AsyncBusScheduler(self, classes, share)
+        self._poller.start()
+
+        return self._poller
+
+    # =============================================================================
+    # Discovery
+    # =============================================================================
+
+    async def discover(self, addresses=range(256), persist=True):
+        """
+        Same as Sixpack2Controller.discover, to be awaited
+        """
+
+        addresses = [_parse_addr(address) for address in addresses]
+        if self._batch is not None:
+            raise RuntimeError('cannot discover units inside a transaction')
+
+        units = []
+        for address in addresses:
+            unit = await self._probe_unit(address)
+            if unit is not None:
+                units.append(unit)
+
+        if persist:
+            self._save_units(addresses, units)
+
+        return units
+
+    async def _probe_unit(self, address):
+
+        timeout = self._probe_timeout()
+
+        try:
+            info = await self._async_exchange(
+                GET_UNIT_INFO.pack(address, self._resp_addr), GET_UNIT_INFO,
+                None, timeout)
+        except (TimeoutError, UserWarning):
+            return None
+
+        num_motors = 0
+        for motno in range(MAX_MOTORS):
+            try:
+                await self._async_exchange(
+                    GET_POS.pack(address, motno, self._resp_addr), GET_POS,
+                    None, timeout, retries=0)
+            except (TimeoutError, UserWarning):
+                continue
+            num_motors = motno + 1
+
+        return self._describe_unit(address, info, num_motors)
+
+    def _unit(self, address):
+        """
+        Description of the unit at address from the discovery cache of the
+        port (the constructor cannot await discover)
+        """
+
+        for unit in load_port_state(self._port).get('units', ()):
+            if unit['address'] == address:
+                return unit
+
+        raise RuntimeError('unit {:02X} is not in the discovery cache of {},'
+                           ' await discover() first'
+                           .format(address, self._port))
+
+    # =============================================================================
+    # Other Settings
+    # =============================================================================
+
+    async def negotiate_baudrate(self, target=57600, transmitter_delay=3,
+                                 persist=True):
+        """
+        Same as Sixpack2Controller.negotiate_baudrate, to be awaited.
+        Other tasks must not talk to the PACK meanwhile (stop the poller
+        first), their frames would be sent at the wrong baud rate.
+        """
+
+        _check_baudrate(target)
+        if self._batch is not None:
+            raise RuntimeError('cannot negotiate the baud rate inside a'
+                               ' transaction')
+        stored = load_port_state(self._port) if persist else {}
+
+        current = await self._find_baudrate(stored.get('baudrate'))
+        if current is None:
+            raise TimeoutError('PACK does not answer at any supported'
+                               ' baud rate')
+
+        if (current == target and stored.get('baudrate') == target
+                and 'transmitter_delay' in stored):
+            self.transmitter_delay = stored['transmitter_delay']
+            return target, self.transmitter_delay
+
+        if current != target:
+            await self._switch_baudrate(target, transmitter_delay)
+            if not await self._probe(PROBE_ATTEMPTS):
+                await self._fall_back(current, target, transmitter_delay)
+                target = current
+
+        delay = await self._tune_transmitter_delay(target, transmitter_delay)
+
+        if persist:
+            save_port_state(self._port, baudrate=target,
+                            transmitter_delay=delay)
+
+        return target, delay
+
+    async def _probe(self, attempts=1):
+
+        frames = 2 * FRAME_LENGTH * BITS_PER_BYTE / self._ser.baudrate
+        for _ in range(attempts):
+            try:
+                await self._send_request(GET_UNIT_INFO, self._resp_addr,
+                                         parse=self._parse_unit_info,
+                                         timeout=frames + PROBE_TIMEOUT)
+            except (TimeoutError, UserWarning):
+                return False
+
+        return True
+
+    async def _find_baudrate(self, stored=None):
+
+        candidates = [stored, self._ser.baudrate, DEFAULT_BAUDRATE]
+        candidates += sorted(BAUDRATE_DIVISORS, reverse=True)
+
+        tried = set()
+        for baudrate in candidates:
+            if baudrate is None or baudrate in tried:
+                continue
+            tried.add(baudrate)
+            self._ser.baudrate = baudrate
+            if await self._probe():
+                return baudrate
+
+        return None
+
+    async def _switch_baudrate(self, baudrate, transmitter_delay):
+
+        old = self._ser.baudrate
+        await self.adjust_baudrate(BAUDRATE_DIVISORS[baudrate],
+                                   transmitter_delay)
+        self._ser.flush()
+        await asyncio.sleep(FRAME_LENGTH * BITS_PER_BYTE / old)
+        self._ser.baudrate = baudrate
+
+        return None
+
+    async def _fall_back(self, previous, target, transmitter_delay):
+
+        self._ser.baudrate = target
+        await self._switch_baudrate(previous, transmitter_delay)
+
+        if not await self._probe(PROBE_ATTEMPTS):
+            raise TimeoutError('PACK does not answer at {0} baud after'
+                               ' failed switch to {1} baud'
+                               .format(previous, target))
+
+        return None
+
+    async def _tune_transmitter_delay(self, baudrate, transmitter_delay):
+
+        divisor = BAUDRATE_DIVISORS[baudrate]
+        for delay in range(1, transmitter_delay):
+            await self.adjust_baudrate(divisor, delay)
+            if await self._probe(PROBE_ATTEMPTS):
+                return delay
+
+        await self.adjust_baudrate(divisor, transmitter_delay)
+
+        return transmitter_delay
+
+    # =============================================================================
+    # Closing Serial Port
+    # =============================================================================
+
+    async def __aenter__(self):
+        self._attach()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stop_poller()
+        self._detach()
+        self._ser.close()
+
+    def __del__(self):
+        if hasattr(self, '_loop') and self._ser.is_open:
+            self._detach()
+            self._ser.close()
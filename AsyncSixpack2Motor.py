@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from Sixpack2Motor import Sixpack2Motor
+from codec import REF_SEARCH_PARAMS
+from constants import _debounce_bits
+
+
+class AsyncSixpack2Motor(Sixpack2Motor):
+    """
+    Motor of an AsyncSixpack2Controller. Provides the Sixpack2Motor API,
+    every method talking to the PACK returns an awaitable.
+    """
+
+    async def ref_search_params(self, vrefmax, debounce, stop_after=0):
+        """
+        change parameters for fast reference search
+        (waits until all motors are inactive)
+        """
+
+        debounce = _debounce_bits(debounce)
+        REF_SEARCH_PARAMS.check((self._motno, vrefmax, debounce, stop_after))
+
+        await self._ctrl.wait_until_idle('111111')
+
+        return await self._ctrl._send_command(REF_SEARCH_PARAMS, self._motno,
+                                              vrefmax, debounce, stop_after)
+
+    async def position(self, max_age=0):
+
+        value = self._cached('position', max_age)
+        if value is None:
+            value = (await self.get_pos())[0]
+
+        return value
+
+    async def velocity(self, max_age=0):
+
+        value = self._cached('velocity', max_age)
+        if value is None:
+            value = (await self.get_vel())[1]
+
+        return value
+
+    async def action(self, max_age=0):
+
+        value = self._cached('action', max_age)
+        if value is None:
+            value = (await self.get_pos())[1]
+
+        return value
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+from time import monotonic, sleep
+from threading import RLock
+from serial import Serial
+from Sixpack2Controller import Sixpack2Controller
+from portstate import load_port_state
+from worker import IOWorker
+from codec import FrameBuffer
+from constants import (_parse_addr, DEFAULT_TRANSMITTER_DELAY,
+                       TRANSMITTER_DELAY_UNIT)
+
+
+class _BusPort(object):
+    """
+    Serial port shared by the units of a bus: a frame is written no
+    earlier than turnaround seconds after the last received byte (the line
+    is half duplex), close() of the units is ignored
+    """
+
+    def __init__(self, ser, turnaround):
+
+        self.ser = ser
+        self.turnaround = turnaround
+        self._ready = 0.0
+
+    def write(self, data):
+
+        wait = self._ready - monotonic()
+        if wait > 0:
+            sleep(wait)
+
+        return self.ser.write(data)
+
+    def read(self, size=1):
+
+        data = self.ser.read(size)
+        if data:
+            self._ready = monotonic() + self.turnaround
+
+        return data
+
+    def readinto(self, buffer):
+
+        received = self.ser.readinto(buffer)
+        if received:
+            self._ready = monotonic() + self.turnaround
+
+        return received
+
+    def close(self):
+        # the port is closed by Sixpack2Bus.close
+        return None
+
+    # the remaining interface of the port is passed through
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.ser.baudrate = baudrate
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ser.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+class Sixpack2Bus(dict):
+    """
+    Several Sixpack2 units on one RS-485 line sharing a serial port,
+    indexed by unit address:
+
+        bus = Sixpack2Bus(units={0: 6, 1: 6, 2: 3})
+        bus[1][0].start_ramp(1000)
+
+    units maps the addresses to the numbers of motors (None: from the
+    discovery cache); without units, those stored for the port are used
+    or the line is discovered (see Sixpack2Controller.discover).
+
+    Every unit is a Sixpack2Controller answering at its own response
+    address (default: its unit address), so a late reply of one unit is
+    never taken for the reply of another. The units share the port lock
+    and the receive buffer. Frames are written no earlier than turnaround
+    seconds (default: the stored transmitter delay) after the last
+    received byte. start_worker() queues the frames of all units in one
+    I/O worker which lets the units take turns.
+
+    All units run at the baud rate of the port; negotiate_baudrate of a
+    single unit is not supported on a bus.
+    """
+
+    def __init__(self, port='/dev/ttySIXPACK', baudrate=19200, timeout=None,
+                 units=None, turnaround=None, transport=None, lazy=False):
+
+        dict.__init__(self)
+
+        self._port = port
+        if transport is not None:
+            ser = transport
+        elif lazy:
+            ser = Serial()
+            ser.port = port
+        else:
+            ser = Serial(port)
+        ser.baudrate = baudrate
+
+        if turnaround is None:
+            turnaround = TRANSMITTER_DELAY_UNIT * load_port_state(port).get(
+                'transmitter_delay', DEFAULT_TRANSMITTER_DELAY)
+
+        self._ser = _BusPort(ser, turnaround)
+        self._timeout = timeout
+        self._io_lock = RLock()
+        self._rx = FrameBuffer()
+        self._worker = None
+
+        if units is None:
+            units = {unit['address']: unit['num_motors']
+                     for unit in load_port_state(port).get('units', ())}
+            if not units:
+                units = {unit['address']: unit['num_motors']
+                         for unit in self.discover()}
+        elif not isinstance(units, dict):
+            units = dict.fromkeys(units)
+
+        for address, num_motors in units.items():
+            self.add_unit(address, num_motors)
+
+    # ========================================================================
+    # Units
+    # ========================================================================
+
+    def _controller(self, address, num_motors, resp_addr=None):
+        """
+        Controller of a unit on the shared port
+        """
+
+        ctrl = Sixpack2Controller(port=self._port,
+                                  baudrate=self._ser.baudrate,
+                                  timeout=self._timeout,
+                                  sixpack_addr=address,
+                                  resp_addr=(address if resp_addr is None
+                                             else resp_addr),
+                                  num_motors=num_motors,
+                                  transport=self._ser)
+        ctrl._io_lock = self._io_lock
+        ctrl._rx = self._rx
+        ctrl.transmitter_delay = round(self._ser.turnaround
+                                       / TRANSMITTER_DELAY_UNIT)
+        ctrl._worker = self._worker
+
+        return ctrl
+
+    def add_unit(self, address, num_motors=None, resp_addr=None):
+        """
+        Adds the unit at address, num_motors=None takes the number of
+        motors from the discovery cache (or discovers the unit).
+        Returns its controller.
+        """
+
+        address = _parse_addr(address)
+        if address in self:
+            raise ValueError('unit {:02X} is already on the bus'
+                             .format(address))
+
+        if num_motors is None:
+            for unit in load_port_state(self._port).get('units', ()):
+                if unit['address'] == address:
+                    num_motors = unit['num_motors']
+                    break
+            else:
+                units = self.discover([address])
+                if not units:
+                    raise TimeoutError('no unit answers at address {:02X}'
+                                       .format(address))
+                num_motors = units[0]['num_motors']
+
+        self[address] = self._controller(address, num_motors, resp_addr)
+
+        return self[address]
+
+    def discover(self, addresses=range(256), persist=True):
+        """
+        Probes the unit addresses on the line (see
+        Sixpack2Controller.discover), returns the units found
+        """
+
+        units = self._controller(0, 0).discover(addresses, persist)
+
+        for unit in units:
+            if unit['reset_flag'] and unit['address'] in self:
+                self[unit['address']].invalidate()
+
+        return units
+
+    # ========================================================================
+    # I/O worker
+    # ========================================================================
+
+    def start_worker(self):
+        """
+        Starts one I/O worker for all units (see worker.py): frames are
+        sent by priority, the units take turns within a priority.
+        Returns the worker.
+        """
+
+        if self._worker is not None and self._worker.is_alive():
+            raise RuntimeError('I/O worker is already running')
+
+        self._worker = IOWorker()
+        for ctrl in self.values():
+            ctrl._worker = self._worker
+        self._worker.start()
+
+        return self._worker
+
+    def stop_worker(self):
+
+        worker, self._worker = self._worker, None
+        for ctrl in self.values():
+            ctrl._worker = None
+        if worker is not None:
+            worker.stop()
+
+        return None
+
+    # ========================================================================
+    # All units
+    # ========================================================================
+
+    def stop_motors(self):
+        """
+        Stops all motors of all units
+        """
+
+        for ctrl in self.values():
+            ctrl.stop_motors()
+
+        return None
+
+    def close(self):
+
+        self.stop_worker()
+        for ctrl in self.values():
+            ctrl.stop_poller()
+        self._ser.ser.close()
+
+        return None
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+import os
+import socket
+from itertools import count
+from threading import Thread, Lock
+from contextlib import nullcontext
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from Sixpack2Controller import Sixpack2Controller
+from sixpack_daemon import (DEFAULT_SOCKET, HELLO, FRAME, BATCH, STATUS,
+                            SUBSCRIBE, NEGOTIATE, CAPTURE, REPLY, ERROR,
+                            UPDATE, HELLO_REPLY, BAUDRATE, TIMEOUT, RESULT_OK,
+                            recv_message, pack_message, decode_error,
+                            decode_status)
+from constants import (BAUDRATE_DIVISORS, BITS_PER_BYTE, PROBE_TIMEOUT,
+                       PROBE_ATTEMPTS, RTO_MAX, DAEMON_TIMEOUT_MARGIN,
+                       _check_baudrate)
+from codec import FRAME_LENGTH
+
+
+class _DaemonPort(object):
+    """
+    Stands in for the serial port, which is owned by the daemon
+    """
+
+    def __init__(self, path, sock):
+
+        self.port = 'unix://' + path
+        self.baudrate = None
+        self.timeout = None
+        self.is_open = True
+        self._sock = sock
+
+    def close(self):
+
+        if self.is_open:
+            self.is_open = False
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+
+        return None
+
+
+class Sixpack2Client(Sixpack2Controller):
+    """
+    Sixpack2Controller talking to the PACK through a sixpack-daemon (see
+    sixpack_daemon.py), so that several processes can share one port:
+
+        ctrl = Sixpack2Client()
+        ctrl[0].start_ramp(1000)
+
+    The daemon reports number and addresses of the motors. Requests of all
+    threads are pipelined to the daemon (submit() returns at once), the
+    daemon filters redundant settings with its parameter shadow. With
+    subscribe, the status cache (status(), Sixpack2Motor.position() etc.)
+    is kept up to date by the daemon's poller.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None, subscribe=True):
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+
+        self._sock = sock
+        self._ids = count(1)
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._send_lock = Lock()
+        self._callbacks = []
+        self._snapshot = ()
+
+        self._reader = Thread(target=self._read_messages,
+                              name='Sixpack2ClientReader', daemon=True)
+        self._reader.start()
+
+        num_motors, sixpack_addr, resp_addr = HELLO_REPLY.unpack(
+            self._wait(self._call(HELLO)))
+
+        Sixpack2Controller.__init__(self, port=path, timeout=timeout,
+                                    sixpack_addr=sixpack_addr,
+                                    resp_addr=resp_addr,
+                                    num_motors=num_motors,
+                                    transport=_DaemonPort(path, sock))
+
+        # the daemon serializes the frames and keeps the shadow
+        self._io_lock = nullcontext()
+        self.shadow = False
+
+        self._subscribed = False
+        if subscribe:
+            self._wait(self._call(SUBSCRIBE))
+            self._subscribed = True
+
+    # ========================================================================
+    # Messages to and from the daemon
+    # ========================================================================
+
+    def _call(self, kind, payload=b''):
+        """
+        Sends a message to the daemon, returns a Future resolved with the
+        payload of the reply
+        """
+
+        msg_id = next(self._ids)
+        future = Future()
+        with self._pending_lock:
+            self._pending[msg_id] = future
+
+        message = pack_message(kind, msg_id, payload)
+        try:
+            with self._send_lock:
+                self._sock.sendall(message)
+        except OSError as error:
+            with self._pending_lock:
+                self._pending.pop(msg_id, None)
+            raise ConnectionError('connection to sixpack-daemon lost'
+                                  ' ({})'.format(error))
+
+        return future
+
+    def _wait(self, future, timeout=0.0):
+        """
+        Payload of the reply to a message, waiting timeout seconds plus
+        DAEMON_TIMEOUT_MARGIN at most (raises TimeoutError)
+        """
+
+        try:
+            return future.result(timeout + DAEMON_TIMEOUT_MARGIN)
+        except FutureTimeout:
+            if future.done():
+                # the daemon answered with a timeout
+                raise
+        with self._pending_lock:
+            for msg_id, pending in list(self._pending.items()):
+                if pending is future:
+                    del self._pending[msg_id]
+
+        raise TimeoutError('no answer from sixpack-daemon within {:.2f} s'
+                           .format(timeout + DAEMON_TIMEOUT_MARGIN))
+
+    def _reply_wait(self, timeout=None, frames=1):
+        """
+        Time (s) the daemon may take for frames frames with the given reply
+        timeout (default: that of the port, at most RTO_MAX if adaptive),
+        each repeated up to self.retries times
+        """
+
+        if timeout is None:
+            timeout = self._ser.timeout
+        if timeout is None:
+            timeout = RTO_MAX
+
+        return frames * (self.retries + 1) * timeout
+
+    def _read_messages(self):
+
+        try:
+            while True:
+                message = recv_message(self._sock)
+                if message is None:
+                    break
+                kind, msg_id, payload = message
+
+                if kind == UPDATE:
+                    self._snapshot = decode_status(payload)
+                    for callback in list(self._callbacks):
+                        callback(self._snapshot)
+                    continue
+
+                with self._pending_lock:
+                    future = self._pending.pop(msg_id, None)
+                if future is None:
+                    continue
+                if kind == REPLY:
+                    future.set_result(payload)
+                elif kind == ERROR:
+                    future.set_exception(decode_error(payload)[0])
+        except OSError:
+            pass
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError('connection to'
+                                                 ' sixpack-daemon lost'))
+
+        return None
+
+    def _timeout(self, timeout):
+
+        if timeout is None:
+            timeout = self._ser.timeout
+
+        return TIMEOUT.pack(-1.0 if timeout is None else timeout)
+
+    # ========================================================================
+    # Frames (see Sixpack2Controller)
+    # ========================================================================
+
+    def _queued(self):
+        return False
+
+    def _write_frame(self, frame):
+
+        metrics = self._metrics
+        if metrics is not None:
+            start = metrics.before(frame)
+
+        try:
+            self._wait(self._call(FRAME, frame + self._timeout(None)),
+                       self._reply_wait())
+        except BaseException:
+            self._forget([frame])
+            raise
+
+        if metrics is not None:
+            metrics.after(frame, None, start)
+
+        return None
+
+    def _exchange(self, frame, request, timeout=None, preempt=None,
+                  retries=None):
+
+        metrics = self._metrics
+        if metrics is not None:
+            start = metrics.before(frame)
+
+        try:
+            reply = self._wait(self._call(FRAME,
+                                          frame + self._timeout(timeout)),
+                               self._reply_wait(timeout))
+            reply = self._decode(request, reply)
+        except (TimeoutError, UserWarning) as error:
+            if metrics is not None:
+                metrics.after(frame, None, start, error)
+            raise
+
+        if metrics is not None:
+            metrics.after(frame, reply, start)
+
+        return reply
+
+    def _decode(self, request, reply):
+
+        if reply[1] != request.opcode:
+            raise UserWarning('Warning: Response command nr ({0:02X}) does'
+                              ' not match requested command nr ({1:02X})'
+                              .format(reply[1], request.opcode))
+
+        return request.unpack_reply(reply)
+
+    def _flush(self, batch, gap=0):
+
+        if not batch:
+            return None
+
+        payload = TIMEOUT.pack(gap) + b''.join(frame
+                                               for frame, _, _, _ in batch)
+        try:
+            results = self._wait(self._call(BATCH, payload),
+                                 self._reply_wait(frames=len(batch))
+                                 + gap * len(batch))
+        except Exception as error:
+            for _, request, _, future in batch:
+                if request is not None:
+                    future.set_exception(error)
+            self._forget(frame for frame, request, _, _ in batch
+                         if request is None)
+            return None
+
+        offset = 0
+        for _, request, parse, future in batch:
+            if request is None:
+                continue
+            if results[offset] != RESULT_OK:
+                error, offset = decode_error(results, offset)
+                future.set_exception(error)
+                continue
+            reply = bytes(results[offset + 1:offset + 1 + FRAME_LENGTH])
+            offset += 1 + FRAME_LENGTH
+            try:
+                reply = self._decode(request, reply)
+                future.set_result(reply if parse is None else parse(reply))
+            except Exception as error:
+                future.set_exception(error)
+
+        return None
+
+    def submit(self, command, *params, parse=None, timeout=None,
+               priority=None):
+        """
+        Sends a command or request without waiting, returns a Future
+        (see Sixpack2Controller.submit). The priority is chosen by the
+        daemon.
+        """
+
+        with self._encode_lock:
+            buffer = self._reqbuf if command.is_request else self._cmdbuf
+            command.pack_into(buffer, self._sixpack_addr, *params)
+            if command.keys is not None:
+                self._record(command, params)
+            frame = bytes(buffer)
+
+        future = Future()
+        reply = self._call(FRAME, frame + self._timeout(timeout))
+
+        def resolve(done):
+            try:
+                result = done.result()
+                if command.is_request:
+                    result = self._decode(command, result)
+                    if parse is not None:
+                        result = parse(result)
+                else:
+                    result = None
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        reply.add_done_callback(resolve)
+
+        return future
+
+    # ========================================================================
+    # Status
+    # ========================================================================
+
+    def status(self):
+        """
+        Latest status snapshot; without subscription it is requested from
+        the daemon
+        """
+
+        if not self._subscribed:
+            self._snapshot = decode_status(self._wait(self._call(STATUS)))
+
+        return self._snapshot
+
+    def subscribe(self, callback):
+        """
+        Calls callback(snapshot) from the reader thread whenever the daemon
+        publishes a new status snapshot
+        """
+
+        self._callbacks.append(callback)
+        if not self._subscribed:
+            self._wait(self._call(SUBSCRIBE))
+            self._subscribed = True
+
+        return None
+
+    # ========================================================================
+    # Done by the daemon
+    # ========================================================================
+
+    def negotiate_baudrate(self, target=57600, transmitter_delay=3,
+                           persist=True):
+        """
+        Lets the daemon negotiate the baud rate of its port (see
+        Sixpack2Controller.negotiate_baudrate)
+        """
+
+        _check_baudrate(target)
+        # at worst the daemon probes every baud rate, twice
+        wait = 2 * PROBE_ATTEMPTS * sum(
+            2 * FRAME_LENGTH * BITS_PER_BYTE / baudrate + PROBE_TIMEOUT
+            for baudrate in BAUDRATE_DIVISORS)
+        baudrate, delay, _ = BAUDRATE.unpack(self._wait(self._call(
+            NEGOTIATE, BAUDRATE.pack(target, transmitter_delay, persist)),
+            wait))
+        self._ser.baudrate = baudrate
+        self.transmitter_delay = delay
+
+        return baudrate, delay
+
+    def start_worker(self):
+        """
+        Nothing to start: the I/O worker of the daemon queues the frames
+        of all clients by priority
+        """
+
+        return None
+
+    def start_capture(self, path):
+        """
+        Lets the daemon capture the traffic of its port into the file at
+        path (see Sixpack2Controller.start_capture)
+        """
+
+        path = os.path.abspath(path).encode('utf-8')
+        self._wait(self._call(CAPTURE, path))
+
+        return None
+
+    def stop_capture(self):
+
+        self._wait(self._call(CAPTURE))
+
+        return None
+
+    def close(self):
+
+        self.stop_poller()
+        self._ser.close()
+
+        return None
@@ -1,9 +1,29 @@
 #!/usr/bin/env python
 
+from time import sleep, monotonic
+from threading import RLock, Lock, get_ident
+from contextlib import contextmanager
+from concurrent.futures import Future
 from serial import Serial
-from collections import OrderedDict
 from Sixpack2Motor import Sixpack2Motor
-from constants import *
+from poller import StatusPoller, MotorStatus
+from scheduler import BusScheduler, default_classes
+from constants import (_parse_mask, _parse_addr, _decode_action,
+                       _check_baudrate)
+from constants import (WAIT_TIMEOUT_FACTOR, WAIT_TIMEOUT_MARGIN,
+                       DEFAULT_WAIT_TIMEOUT, REPLY_RETRIES, DISCOVERY_TIMEOUT,
+                       MAX_MOTORS, DEFAULT_TRANSMITTER_DELAY, TELEMETRY_SHARE)
+from constants import (BAUDRATE_DIVISORS, DEFAULT_BAUDRATE, BITS_PER_BYTE,
+                       PROBE_TIMEOUT, PROBE_ATTEMPTS, PREEMPT_INTERVAL)
+from constants import PARAMETER_RANGES, _velocity_hz, _acceleration_hz2
+from portstate import load_port_state, save_port_state
+from motorprofile import Profile
+from metrics import Metrics, RTT_BUCKETS
+from capture import CaptureTransport
+from worker import IOWorker, _is_delayed
+from rtt import RoundTripTimer
+from motion import Ramp, ramp_params
+from codec import *
 
 
 class Sixpack2Controller(list):
@@ -13,17 +33,71 @@ class Sixpack2Controller(list):
 
     def __init__(self, port='/dev/ttySIXPACK',
                  baudrate=19200, timeout=None,
-                 sixpack_addr='00', resp_addr='00', num_motors=1):
+                 sixpack_addr='00', resp_addr='00', num_motors=1,
+                 transport=None, lazy=False):
+        """
+        Opens the serial port, or uses the given transport instead: any
+        object with the interface of serial.Serial, e.g. the simulator's
+        SimulatedSerial. With lazy, the port is opened by the first frame
+        sent.
+
+        timeout is the time (s) to wait for a reply; None adapts it to the
+        measured round trip times (see rtt.py). Idempotent requests whose
+        reply is missing or garbled are repeated up to self.retries times.
+
+        num_motors=None takes the number of motors of the unit at
+        sixpack_addr from the discovery cache, or discovers it (see
+        discover).
+        """
 
         list.__init__(self)
 
         self._port = port
-        self._ser = Serial(self._port)
+        if transport is not None:
+            self._ser = transport
+        elif lazy:
+            self._ser = Serial()
+            self._ser.port = self._port
+        else:
+            self._ser = Serial(self._port)
+        self._connected = self._ser.is_open
         self._ser.baudrate = baudrate
         self._ser.timeout = timeout
-
-        self._sixpack_addr = sixpack_addr
-        self._resp_addr = resp_addr
+        self.timeout = timeout
+        self.retries = REPLY_RETRIES
+        self._rtt = RoundTripTimer()
+        # reply delay of the PACK (units of TRANSMITTER_DELAY_UNIT)
+        self.transmitter_delay = DEFAULT_TRANSMITTER_DELAY
+
+        self._sixpack_addr = _parse_addr(sixpack_addr)
+        self._resp_addr = _parse_addr(resp_addr)
+
+        self._cmdbuf = bytearray(FRAME_LENGTH)
+        self._reqbuf = bytearray(FRAME_LENGTH)
+
+        # replies are read into this buffer and decoded in place
+        self._rx = FrameBuffer()
+        self._batches = {}
+
+        # _io_lock guards the port, _encode_lock the buffers and the shadow
+        self._io_lock = RLock()
+        self._encode_lock = RLock()
+        self._port_owner = None
+        self._worker = None
+
+        # shadow of the settings written to the PACK (see _record)
+        self.shadow = True
+        self.suppressed = 0
+        self._written = {}
+        self._stale = set()
+        # settings of the user replaced by scaled ones (see move_linear)
+        self._nominal = {}
+
+        # instrumentation, see enable_metrics
+        self._metrics = None
+
+        if num_motors is None:
+            num_motors = self._unit(self._sixpack_addr)['num_motors']
         self.num_motors = num_motors
 
         self._create_motors()
@@ -34,16 +108,14 @@ class Sixpack2Controller(list):
                               '!= number of initialized motors (={1})'
                               .format(len(self)))
 
-        self.last_command = ''
-        self.last_request = ''
         self.status_dict = {'motor{}'.format(i): {'action': None,
                                                   'position': None,
                                                   'velocity': None}
                             for i in range(self.num_motors)}
 
-        self._reply_dict = OrderedDict.fromkeys(['addr', 'cmd', 'p0',
-                                                 'p1', 'p2', 'p3',
-                                                 'p4', 'p5', 'p6'])
+        self._status_lock = Lock()
+        self._snapshot = self.num_motors * (MotorStatus.empty(),)
+        self._poller = None
 
     # ========================================================================
     # Initialize Sixpack Motors
@@ -54,52 +126,929 @@ class Sixpack2Controller(list):
             motor = Sixpack2Motor(self, motno)
             self.append(motor)
 
+    # ========================================================================
+    # Discovery
+    # ========================================================================
+
+    def discover(self, addresses=range(256), persist=True):
+        """
+        Probes the given unit addresses with get_unit_info and, for every
+        unit answering, its motor channels with get_pos (the PACK ignores
+        frames for motors not fitted). Each probe waits DISCOVERY_TIMEOUT
+        seconds on top of the frame times.
+
+        Returns a dict per unit found: address, firmware, serial,
+        reset_flag, temperature and num_motors. With persist, address,
+        firmware, serial and num_motors are stored per port (see
+        portstate.py) for controllers created with num_motors=None.
+        """
+
+        addresses = [_parse_addr(address) for address in addresses]
+        units = []
+
+        with self._exclusive():
+            if self._batches.get(get_ident()) is not None:
+                raise RuntimeError('cannot discover units inside a'
+                                   ' transaction')
+            for address in addresses:
+                unit = self._probe_unit(address)
+                if unit is not None:
+                    units.append(unit)
+
+        if persist:
+            self._save_units(addresses, units)
+
+        return units
+
+    def _save_units(self, addresses, units):
+        """
+        Stores the units found at the probed addresses in the discovery
+        cache of the port
+        """
+
+        known = {unit['address']: unit for unit in
+                 load_port_state(self._port).get('units', ())
+                 if unit['address'] not in addresses}
+        for unit in units:
+            known[unit['address']] = {key: unit[key] for key in
+                                      ('address', 'firmware', 'serial',
+                                       'num_motors')}
+        save_port_state(self._port, units=[known[address] for address
+                                           in sorted(known)])
+
+        return None
+
+    def _probe_timeout(self):
+        """
+        Reply timeout of discovery probes
+        """
+
+        return (2 * FRAME_LENGTH * BITS_PER_BYTE / self._ser.baudrate
+                + DISCOVERY_TIMEOUT)
+
+    def _probe_unit(self, address):
+        """
+        Returns the description of the unit at address, None if it does
+        not answer (caller holds the port)
+        """
+
+        timeout = self._probe_timeout()
+
+        try:
+            info = self._exchange(GET_UNIT_INFO.pack(address, self._resp_addr),
+                                  GET_UNIT_INFO, timeout)
+        except (TimeoutError, UserWarning):
+            return None
+
+        num_motors = 0
+        for motno in range(MAX_MOTORS):
+            try:
+                self._exchange(GET_POS.pack(address, motno, self._resp_addr),
+                               GET_POS, timeout, retries=0)
+            except (TimeoutError, UserWarning):
+                continue
+            num_motors = motno + 1
+
+        return self._describe_unit(address, info, num_motors)
+
+    def _describe_unit(self, address, info, num_motors):
+        """
+        Description of a unit from its get_unit_info reply
+        """
+
+        if info.reset_flag and address == self._sixpack_addr:
+            # the PACK lost all settings
+            self.invalidate()
+
+        return {'address': address,
+                'firmware': '.'.join(str(info.firmware)),
+                'serial': info.serial,
+                'reset_flag': info.reset_flag,
+                'temperature': info.temperature,
+                'num_motors': num_motors}
+
+    def _unit(self, address):
+        """
+        Description of the unit at address from the discovery cache of the
+        port, discovered if unknown
+        """
+
+        for unit in load_port_state(self._port).get('units', ()):
+            if unit['address'] == address:
+                return unit
+
+        units = self.discover([address])
+        if not units:
+            raise TimeoutError('no unit answers at address {:02X}'
+                               .format(address))
+
+        return units[0]
+
     # ========================================================================
     # Send command and request reply
     # ========================================================================
 
-    def __send_command(self, command):
+    @property
+    def last_command(self):
+        return self._cmdbuf.hex().upper()
+
+    @property
+    def last_request(self):
+        return self._reqbuf.hex().upper()
+
+    def _send_command(self, command, *params):
         """
-        Encodes and sends command to the PACK.
+        Encodes command (see codec.py) into the transmit buffer
+        and sends it to the PACK. Settings the PACK already holds are
+        skipped (see _record).
         """
 
-        command = self._sixpack_addr + command
-        self.last_command = command
-        command_bytes = bytes.fromhex(command)
+        with self._encode_lock:
+            command.pack_into(self._cmdbuf, self._sixpack_addr, *params)
+            if command.keys is not None and not self._record(command,
+                                                             params):
+                return None
+            frame = bytes(self._cmdbuf)
 
-        self._ser.reset_output_buffer()
-        self._ser.write(command_bytes)
+        batch = self._batches.get(get_ident())
+        if batch is not None:
+            batch.append((frame, None, None, None))
+            return None
+
+        if self._queued():
+            return self._worker.submit(frame, ctrl=self).result()
+
+        with self._io_lock:
+            self._write_frame(frame)
 
         return None
 
-    def _send_request(self, request):
+    def _send_request(self, request, *params, parse=None, timeout=None):
         """
         Encodes and sends request to the PACK.
-        Receives reply bytes, transcodes them into integer numbers
-        and writes them into reply_dict dictonary.
+        Receives reply bytes and decodes them into a tuple
+        (addr, cmd, *reply parameters) as specified in codec.py.
+        If given, parse is applied to the decoded reply and its
+        result is returned instead. timeout overrides the reply timeout of
+        the controller for this request.
+
+        Inside a transaction the request is only queued and a Future is
+        returned, which is resolved when the transaction is flushed.
+        """
+
+        with self._encode_lock:
+            request.pack_into(self._reqbuf, self._sixpack_addr, *params)
+            frame = bytes(self._reqbuf)
+
+        batch = self._batches.get(get_ident())
+        if batch is not None:
+            future = Future()
+            batch.append((frame, request, parse, future))
+            return future
+
+        if self._queued():
+            reply = self._worker.submit(frame, request, timeout,
+                                        ctrl=self).result()
+        else:
+            with self._io_lock:
+                reply = self._exchange(frame, request, timeout)
+
+        if parse is None:
+            return reply
+        return parse(reply)
+
+    def _write_frame(self, frame):
+        """
+        Writes a command frame (caller holds the port)
+        """
+
+        if not self._connected:
+            self._connect()
+
+        metrics = self._metrics
+        if metrics is not None:
+            start = metrics.before(frame)
+
+        self._ser.reset_output_buffer()
+        try:
+            self._ser.write(frame)
+        except BaseException:
+            self._forget([frame])
+            raise
+
+        if metrics is not None:
+            metrics.after(frame, None, start)
+
+        return None
+
+    def _exchange(self, frame, request, timeout=None, preempt=None,
+                  retries=None):
+        """
+        Writes a request frame and reads its reply (caller holds the port),
+        see _read_reply for preempt. Idempotent requests are repeated up to
+        retries (default: self.retries) times, except delayed query_all.
+        """
+
+        if not self._connected:
+            self._connect()
+
+        delayed = _is_delayed(frame)
+        adaptive = timeout is None and self.timeout is None
+        if timeout is None:
+            timeout = self._reply_timeout(frame)
+        if retries is None:
+            retries = self.retries
+        if not request.idempotent or delayed:
+            retries = 0
+
+        metrics = self._metrics
+        attempt = 0
+        while True:
+            if metrics is not None:
+                start = metrics.before(frame)
+
+            self._discard_stale(frame)
+            self._ser.reset_output_buffer()
+            self._ser.write(frame)
+            sent = monotonic()
+
+            try:
+                reply = self._read_reply(frame, request, timeout, preempt)
+                break
+            except (TimeoutError, UserWarning) as error:
+                if metrics is not None:
+                    metrics.after(frame, None, start, error)
+                if (adaptive and not delayed
+                        and isinstance(error, TimeoutError)):
+                    self._rtt.backoff(frame[1])
+                    timeout = self._reply_timeout(frame)
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                if metrics is not None:
+                    metrics.retry(frame[1])
+
+        if not attempt and not delayed:
+            self._rtt.sample(frame[1], monotonic() - sent)
+
+        if metrics is not None:
+            metrics.after(frame, reply, start)
+
+        return reply
+
+    def _reply_timeout(self, frame):
+        """
+        Reply timeout for a request frame: the timeout of the controller,
+        or the adaptive one of its command. A delayed query_all is answered
+        once the motors have stopped, it waits as long as their predicted
+        moves take (see _wait_timeout).
+        """
+
+        if _is_delayed(frame):
+            timeout = self._wait_timeout(self._motors_in(frame[3]))
+            return max(timeout, self.timeout or 0.0)
+        if self.timeout is not None:
+            return self.timeout
+
+        rtt = self._rtt
+        if rtt.baudrate != self._ser.baudrate:
+            rtt.reset(self._ser.baudrate)
+
+        return rtt.timeout(frame[1])
+
+    def _frame_time(self):
+        """
+        Time (s) a frame takes on the line, 0.0 if the baud rate is unknown
+        """
+
+        baudrate = self._ser.baudrate
+        if not baudrate:
+            return 0.0
+
+        return FRAME_LENGTH * BITS_PER_BYTE / baudrate
+
+    def _sample_time(self):
+        """
+        Time (monotonic) at which the PACK took the values of the reply just
+        received: before sending it
+        """
+
+        return monotonic() - self._frame_time()
+
+    def round_trip_times(self):
+        """
+        Returns the learned round trip times (s) and timeouts per command:
+        {name: {'srtt': ..., 'rttvar': ..., 'timeout': ...}}
+        """
+
+        return self._rtt.snapshot()
+
+    def _connect(self):
+        """
+        Opens the port of a lazily created controller (caller holds the
+        port)
+        """
+
+        if not self._ser.is_open:
+            self._ser.open()
+        self._connected = True
+
+        return None
+
+    def _discard_stale(self, frame):
+        """
+        Drops received bytes no request is waiting for (late replies of
+        timed out requests) before frame is written
+        """
+
+        discarded = self._rx.discard(self._ser)
+        if discarded and self._metrics is not None:
+            self._metrics.discard(frame[1], discarded)
+
+        return None
+
+    def _read_reply(self, frame, request, timeout, preempt=None):
+        """
+        Reads and decodes the reply to the given request frame within
+        timeout seconds (None: no limit), skipping bytes which do not
+        belong to it (see codec.FrameBuffer).
+        If given, preempt is called every PREEMPT_INTERVAL seconds as long
+        as no reply byte is pending (the line is free then), e.g. to send
+        an emergency stop while waiting for a delayed reply.
+        """
+
+        ser = self._ser
+        rx = self._rx
+        prefix = request.reply_prefix(frame)
+        discarded = rx.discarded
+
+        deadline = None if timeout is None else monotonic() + timeout
+        # the first read waits for the whole timeout
+        first = preempt is None
+
+        while True:
+            reply = rx.take(request, prefix)
+            if reply is not None:
+                break
+            if first:
+                first = False
+                wait = timeout
+            else:
+                wait = None
+                if preempt is not None:
+                    if not rx:
+                        preempt()
+                    wait = PREEMPT_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    if wait is None or wait > remaining:
+                        wait = remaining
+            # the timeout of the port is only changed when it differs
+            if ser.timeout != wait:
+                ser.timeout = wait
+            rx.fill(ser, FRAME_LENGTH - len(rx))
+
+        discarded = rx.discarded - discarded
+        if discarded and self._metrics is not None:
+            self._metrics.discard(request.opcode, discarded)
+
+        if reply is not None:
+            return reply
+
+        if discarded >= FRAME_LENGTH:
+            raise UserWarning('Warning: no reply to {0} among the received'
+                              ' bytes ({1} discarded)'
+                              .format(request.name, discarded))
+
+        raise TimeoutError('no complete reply received for {0} ({1} of'
+                           ' {2} bytes)'.format(request.name, len(rx),
+                                                FRAME_LENGTH))
+
+    # ========================================================================
+    # I/O worker
+    # ========================================================================
+
+    def start_worker(self):
+        """
+        Starts an I/O worker thread owning the serial port (see worker.py):
+        frames from all threads are queued by priority, stop_motors and
+        abort_ref_search jump the queue (and are sent even while waiting
+        for the delayed reply of wait_until_idle), telemetry requests
+        (get_pos, get_vel, read_input_channels) come last.
+        Returns the worker.
+        """
+
+        if self._worker is not None and self._worker.is_alive():
+            raise RuntimeError('I/O worker is already running')
+
+        self._worker = IOWorker(self)
+        self._worker.start()
+
+        return self._worker
+
+    def stop_worker(self):
+
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.stop()
+
+        return None
+
+    def _queued(self):
+        """
+        True if frames of the calling thread go through the worker
+        """
+
+        worker = self._worker
+        thread = get_ident()
+
+        return (worker is not None and thread != worker.ident
+                and thread != self._port_owner)
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        Gives the calling thread direct access to the port for a sequence
+        of frames (the worker pauses meanwhile)
         """
 
-        request = self._sixpack_addr + request
-        self.last_request = request
-        request_bytes = bytes.fromhex(request)
+        with self._io_lock:
+            owner, self._port_owner = self._port_owner, get_ident()
+            try:
+                yield
+            finally:
+                self._port_owner = owner
 
+    def submit(self, command, *params, parse=None, timeout=None,
+               priority=None):
+        """
+        Sends a command or request (see codec.py) and returns a Future
+        resolved with None or the (parsed) reply. With a running worker,
+        the frame is queued with the given priority (default by opcode,
+        see worker.PRIORITIES) and the call returns at once.
+        """
+
+        if not self._queued():
+            future = Future()
+            try:
+                if command.is_request:
+                    future.set_result(self._send_request(
+                        command, *params, parse=parse, timeout=timeout))
+                else:
+                    future.set_result(self._send_command(command, *params))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+
+        with self._encode_lock:
+            buffer = self._reqbuf if command.is_request else self._cmdbuf
+            command.pack_into(buffer, self._sixpack_addr, *params)
+            if (command.keys is not None
+                    and not self._record(command, params)):
+                future = Future()
+                future.set_result(None)
+                return future
+            frame = bytes(buffer)
+
+        request = command if command.is_request else None
+        future = self._worker.submit(frame, request, timeout, priority,
+                                     ctrl=self)
+        if parse is None:
+            return future
+
+        parsed = Future()
+
+        def resolve(done):
+            try:
+                parsed.set_result(parse(done.result()))
+            except Exception as error:
+                parsed.set_exception(error)
+
+        future.add_done_callback(resolve)
+
+        return parsed
+
+    # ========================================================================
+    # Transactions
+    # ========================================================================
+
+    @contextmanager
+    def transaction(self, gap=0):
+        """
+        Collects all frames sent by the controller and its motors and
+        flushes them at the end of the with-block with a single write
+        (or one write per frame separated by gap seconds, if gap > 0).
+
+        Requests issued inside the transaction return a Future, resolved
+        with the reply (matched in order) when the transaction is flushed.
+
+            with ctrl.transaction():
+                ctrl[0].set_targetpos(1000)
+                ctrl[1].set_targetpos(-500)
+                ctrl.start_parallel_ramp('11')
+
+        Nested transactions are merged into the outermost one. If the
+        block raises, the collected frames are discarded. Transactions are
+        bound to the thread opening them.
+        """
+
+        thread = get_ident()
+        if thread in self._batches:
+            yield self
+            return
+
+        self._batches[thread] = []
+        try:
+            yield self
+        except BaseException:
+            self._forget(frame for frame, _, _, _ in
+                         self._batches.pop(thread))
+            raise
+
+        self._send_batch(self._batches.pop(thread), gap)
+
+    def _send_batch(self, batch, gap=0):
+        """
+        Flushes a batch of (frame, request, parse, future), through the I/O
+        worker if it runs
+        """
+
+        if self._queued():
+            self._worker.submit_batch(batch, gap, ctrl=self).result()
+        else:
+            with self._io_lock:
+                self._flush(batch, gap)
+
+        return None
+
+    def _flush(self, batch, gap=0):
+        """
+        Writes the collected frames and reads the replies to all
+        requests in order. Idempotent requests which failed are repeated
+        one at a time afterwards.
+        """
+
+        if not batch:
+            return None
+
+        if not self._connected:
+            self._connect()
+
+        metrics = self._metrics
+        if metrics is not None:
+            # round trip times of batched requests include queueing
+            for frame, _, _, _ in batch:
+                start = metrics.before(frame)
+
+        self._discard_stale(batch[0][0])
         self._ser.reset_output_buffer()
-        self._ser.write(request_bytes)
 
-        self._ser.reset_input_buffer()
-        reply_bytes = self._ser.read(9)
-        reply_hex = reply_bytes.hex()
+        try:
+            if gap > 0:
+                for i, (frame, _, _, _) in enumerate(batch):
+                    if i:
+                        sleep(gap)
+                    self._ser.write(frame)
+            else:
+                self._ser.write(b''.join(frame for frame, _, _, _ in batch))
+        except BaseException:
+            self._forget(frame for frame, _, _, _ in batch)
+            raise
+
+        # the replies queue up behind the frames of the batch
+        backlog = 0.0
+        if self.timeout is None:
+            backlog = (len(batch) * FRAME_LENGTH * BITS_PER_BYTE
+                       / self._ser.baudrate)
+
+        error = None
+        failed = []
+        for frame, request, parse, future in batch:
+            if request is None:
+                if metrics is not None:
+                    metrics.after(frame, None, start)
+                continue
+            if error is not None:
+                failed.append((frame, request, parse, future, error))
+                continue
+            try:
+                reply = self._read_reply(frame, request,
+                                         self._reply_timeout(frame) + backlog)
+                if metrics is not None:
+                    metrics.after(frame, reply, start)
+                future.set_result(reply if parse is None else parse(reply))
+            except (TimeoutError, UserWarning) as exc:
+                if metrics is not None:
+                    metrics.after(frame, None, start, exc)
+                if isinstance(exc, TimeoutError):
+                    # the PACK stopped answering, fail the remaining ones
+                    error = exc
+                failed.append((frame, request, parse, future, exc))
+            except Exception as exc:
+                future.set_exception(exc)
+
+        # repeat the idempotent ones until a repetition times out as well
+        stopped = not self.retries
+        for frame, request, parse, future, exc in failed:
+            if stopped or not request.idempotent or _is_delayed(frame):
+                future.set_exception(exc)
+                continue
+            if metrics is not None:
+                metrics.retry(frame[1])
+            try:
+                reply = self._exchange(frame, request,
+                                       retries=self.retries - 1)
+                future.set_result(reply if parse is None else parse(reply))
+            except (TimeoutError, UserWarning) as exc:
+                if isinstance(exc, TimeoutError):
+                    stopped = True
+                future.set_exception(exc)
+            except Exception as exc:
+                future.set_exception(exc)
+
+        return None
+
+    # ========================================================================
+    # Parameter shadow
+    # ========================================================================
+
+    def _record(self, command, params):
+        """
+        Records the parameters of a setting in the shadow. Returns False
+        if the PACK already holds exactly these values, so the frame can
+        be skipped (unless shadow is disabled).
+        """
+
+        if self._holds(command, params):
+            return False
+        self._store(command, params)
+
+        return True
+
+    def _holds(self, command, params):
+        """
+        True if the PACK already holds exactly these values of a setting
+        and shadow is enabled (counted as suppressed)
+        """
+
+        key = command.key(params)
+        self._nominal.pop(key, None)
+        if (self.shadow and key not in self._stale
+                and self._written.get(key) == params):
+            self.suppressed += 1
+            if self._metrics is not None:
+                self._metrics.suppress(command.opcode)
+            return True
+
+        return False
+
+    def _store(self, command, params):
+        """
+        Stores the parameters of a setting in the shadow
+        """
+
+        key = command.key(params)
+        self._written[key] = params
+        self._stale.discard(key)
+
+        return None
+
+    def _forget(self, frames):
+        """
+        Marks the settings in frames which did not reach the PACK as stale
+        """
+
+        with self._encode_lock:
+            for frame in frames:
+                command = COMMANDS.get(frame[1])
+                if command is not None and command.keys is not None:
+                    params = command.unpack(frame)[2:]
+                    self._stale.add(command.key(params))
+
+        return None
+
+    def _shadow_keys(self, motno=None):
+
+        if motno is None:
+            return list(self._written)
+
+        return [key for key in self._written
+                if COMMANDS[key[0]].fields[0][0] == 'motno'
+                and key[1] == motno]
 
-        if reply_hex[2:4] != request[2:4]:
-            raise UserWarning('Warning: Response command nr ({0}) does not'
-                              'match requested command nr ({1})'
-                              .format(reply_hex[2:4], request[2:4]))
+    def invalidate(self, motno=None):
+        """
+        Marks the recorded settings (of all motors, or only of motor motno)
+        as unknown to the PACK: the next identical setter is sent again.
+        Called automatically after complete_hwreset and when get_unit_info
+        reports a reset.
+        """
+
+        with self._encode_lock:
+            self._stale.update(self._shadow_keys(motno))
+
+        return None
+
+    def resync(self):
+        """
+        Re-sends all invalidated settings in one transaction, so the PACK
+        holds the recorded values again (e.g. after a reset).
+        Returns the number of frames sent.
+        """
+
+        with self._encode_lock:
+            stale = [(key, self._written[key]) for key in self._written
+                     if key in self._stale]
 
-        for i, k in enumerate(self.reply_dict):
-            self.reply_dict[k] = int(reply_hex[2*i:2*i+2], 16)
-        self.reply_dict['cmd'] = reply_hex[2:4]
+        with self.transaction():
+            for key, params in stale:
+                self._send_command(COMMANDS[key[0]], *params)
 
-        return self.reply_dict
+        return len(stale)
+
+    # ========================================================================
+    # Instrumentation
+    # ========================================================================
+
+    def enable_metrics(self, buckets=RTT_BUCKETS, before=(), after=()):
+        """
+        Starts recording frames, bytes, round trip times and errors per
+        opcode (see metrics.Metrics), with optional hooks called before and
+        after each frame. Returns the Metrics object.
+        """
+
+        self._metrics = Metrics(buckets, before, after)
+
+        return self._metrics
+
+    def disable_metrics(self):
+
+        self._metrics = None
+
+        return None
+
+    def metrics(self):
+        """
+        Snapshot of the metrics per command name (empty if disabled)
+        """
+
+        if self._metrics is None:
+            return {}
+
+        return self._metrics.snapshot()
+
+    def start_capture(self, path):
+        """
+        Tees every byte written to and read from the PACK into a capture
+        file (see capture.py), which capture.ReplayTransport replays
+        """
+
+        with self._io_lock:
+            if isinstance(self._ser, CaptureTransport):
+                raise RuntimeError('capture to {} already running'
+                                   .format(self._ser.path))
+            self._ser = CaptureTransport(self._ser, path)
+
+        return None
+
+    def stop_capture(self):
+
+        with self._io_lock:
+            if isinstance(self._ser, CaptureTransport):
+                self._ser.close_capture()
+                self._ser = self._ser.ser
+
+        return None
+
+    # ========================================================================
+    # Profiles
+    # ========================================================================
+
+    def _profile_frames(self, profile, force=False):
+        """
+        Returns the frames of profile (see motorprofile.Profile) which
+        differ from the shadow (all of them with force)
+        """
+
+        if isinstance(profile, dict):
+            profile = Profile.from_dict(profile)
+        elif not isinstance(profile, Profile):
+            profile = Profile.load(profile)
+
+        frames = []
+        for command, params in profile.frames(self.num_motors):
+            key = command.key(params)
+            if (force or key in self._stale
+                    or self._written.get(key) != params):
+                frames.append((command, params))
+
+        return frames
+
+    def apply_profile(self, profile, force=False):
+        """
+        Writes a profile (motorprofile.Profile, dict or path of a JSON or
+        TOML file) to the PACK. Only the settings differing from those
+        known to be on the PACK are sent (all with force), in a single
+        transaction. If reference search parameters change, waits until
+        all motors are inactive first.
+
+        Returns the number of frames sent.
+        """
+
+        frames = self._profile_frames(profile, force)
+
+        if any(command is REF_SEARCH_PARAMS for command, _ in frames):
+            self.wait_until_idle('111111')
+
+        if force:
+            with self._encode_lock:
+                self._stale.update(command.key(params)
+                                   for command, params in frames)
+
+        with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+
+        return len(frames)
+
+    # ========================================================================
+    # Status cache
+    # ========================================================================
+
+    def status(self):
+        """
+        Returns the latest status snapshot: an immutable tuple with one
+        MotorStatus (position, velocity, action and the monotonic time
+        each of them was received) per motor
+        """
+
+        return self._snapshot
+
+    def _publish_status(self, motno, **fields):
+        """
+        Publishes a new snapshot with updated fields of the given motor
+        """
+
+        now = monotonic()
+        with self._status_lock:
+            snapshot = list(self._snapshot)
+            snapshot[motno] = snapshot[motno].updated(now, **fields)
+            self._snapshot = tuple(snapshot)
+
+        return None
+
+    def start_poller(self, rate=20.0, motors=None):
+        """
+        Starts a background thread refreshing position, velocity and
+        action of the given motors (default: all) rate times per second.
+        Motor reads with max_age (e.g. Sixpack2Motor.position) are then
+        served from the status cache.
+        """
+
+        if self._poller is not None:
+            raise RuntimeError('status poller is already running')
+
+        motors = list(self) if motors is None else list(motors)
+        self._poller = StatusPoller(self, motors, rate)
+        self._poller.start()
+
+        return self._poller
+
+    def start_scheduler(self, classes=None, share=TELEMETRY_SHARE,
+                        **options):
+        """
+        Starts a background thread issuing telemetry by traffic classes
+        within share of the line, the rest staying free for commands (see
+        scheduler.BusScheduler). Default classes: positions of moving and
+        idle motors and analogue inputs, see scheduler.default_classes for
+        the options. Takes the place of the status poller (stop_poller).
+
+        Commands only take precedence over telemetry through the I/O
+        worker, so it is started as well if it is not running (on a bus,
+        start the worker of the bus first, see Sixpack2Bus.start_worker).
+        """
+
+        if self._poller is not None:
+            raise RuntimeError('status poller is already running')
+
+        if self._worker is None or not self._worker.is_alive():
+            self.start_worker()
+        if classes is None:
+            classes = default_classes(self, **options)
+        self._poller = BusScheduler(self, classes, share)
+        self._poller.start()
+
+        return self._poller
+
+    def stop_poller(self):
+
+        poller, self._poller = self._poller, None
+        if poller is not None:
+            poller.stop()
+
+        return None
 
     # ========================================================================
     # Get Unit Information
@@ -110,22 +1059,18 @@ class Sixpack2Controller(list):
         Reads out firmware revision, reset-flag, temperature and serial number
         """
 
-        request = '43{0}'.format(self._resp_addr) + 6*'00'
-        reply = self._send_request(request)
-
-        firmware = reply['p0']
-        firmware = '.'.join(str(firmware))
+        return self._send_request(GET_UNIT_INFO, self._resp_addr,
+                                  parse=self._parse_unit_info)
 
-        reset_flag = reply['p1']
+    def _parse_unit_info(self, reply):
 
-        pack_temp = _decode_param([reply['p2']])
+        _, _, firmware, reset_flag, pack_temp, serial_n = reply
 
-        serial_n = list(reply.values())[5:9]
-        serial_n = _decode_param(serial_n, signed=False)
+        if reset_flag:
+            # the PACK lost all settings
+            self.invalidate()
 
-        # serial_n = _decode_param([reply['p3'], reply['p4']
-        #                            reply['p5'], reply['p6']],
-        #                            signed=False)
+        firmware = '.'.join(str(firmware))
 
         return firmware, reset_flag, pack_temp, serial_n
 
@@ -144,28 +1089,75 @@ class Sixpack2Controller(list):
         The response is written in the status_dict dictonary.
         """
 
-        mask = _encode_mask(mask)
+        mask = _parse_mask(mask)
+
+        return self._send_request(QUERY_ALL, self._resp_addr, mask,
+                                  parse=self._parse_query_all)
 
-        request = '28{0}{1}'.format(self._resp_addr, mask) + 5 * '00'
-        reply = self._send_request(request)
+    def _parse_query_all(self, reply):
 
+        when = self._sample_time()
         for i in range(self.num_motors):
-            act = reply['p{}'.format(i)]
-            if act in ACTION_DICT:
-                self.status_dict[
-                                'motor{}'.format(i)
-                                ]['action'] = ACTION_DICT[act]
-            elif 20 <= act <= 29:
-                self.status_dict[
-                                'motor{}'.format(i)
-                                ]['action'] = 'reference switch search'
-            else:
-                raise UserWarning('reply action ({0}) for motor {1} seems to'
-                                  .format(act, i), 'be incorrect and was not'
-                                  'found in ACTION_DICT')
+            action = _decode_action(reply[2 + i])
+            self.status_dict[self[i]._key]['action'] = action
+            self._publish_status(i, action=action)
+            self[i]._observe(when, action)
 
         return self.status_dict
 
+    def _motors_in(self, mask):
+
+        return [motor for motor in self if mask >> motor._motno & 1]
+
+    def _wait_timeout(self, motors):
+        """
+        Reply timeout for waiting on the given motors, scaled with their
+        predicted remaining move time
+        """
+
+        remaining = [motor.remaining_move_time() for motor in motors]
+        if not remaining or None in remaining:
+            return DEFAULT_WAIT_TIMEOUT
+
+        return WAIT_TIMEOUT_FACTOR * max(remaining) + WAIT_TIMEOUT_MARGIN
+
+    def wait_until_idle(self, mask='111111', timeout=None):
+        """
+        Waits until all motors selected by mask are inactive, using the
+        delayed response of query_all: a single request on the bus which
+        the PACK answers once the motors have stopped.
+        If no timeout is given, it is derived from the predicted remaining
+        move time of the motors. The position of a motor whose move started
+        from an unknown position is read once for that (outside of
+        transactions); DEFAULT_WAIT_TIMEOUT if the time is still unknown.
+        Raises TimeoutError if the motors did not stop in time.
+        (mask: bit 0 = motor 0, ..., bit 5 = motor 5)
+        """
+
+        mask = _parse_mask(mask)
+        if timeout is None:
+            if self._batches.get(get_ident()) is None:
+                for motor in self._motors_in(mask):
+                    if motor._move_unpredicted():
+                        motor.get_pos()
+            timeout = self._wait_timeout(self._motors_in(mask))
+
+        return self._send_request(QUERY_ALL, self._resp_addr, mask,
+                                  parse=self._parse_query_all,
+                                  timeout=timeout)
+
+    def wait_until_reached(self, motors, timeout=None):
+        """
+        Waits until the given motors have finished their moves,
+        see wait_until_idle
+        """
+
+        mask = 0
+        for motor in motors:
+            mask |= 1 << motor._motno
+
+        return self.wait_until_idle(mask, timeout)
+
     def start_parallel_ramp(self, mask):
         """
         Starts coordinated movement, by starting multiple motors at the same
@@ -175,12 +1167,13 @@ class Sixpack2Controller(list):
          0: motor masked, 1: start motor)
         """
 
-        mask = _encode_mask(mask)
+        mask = _parse_mask(mask)
 
-        command = '29{}'.format(mask) + 6 * '00'
-        self._send_command(command)
+        sent = self._send_command(START_PARALLEL_RAMP, mask)
+        for motor in self._motors_in(mask):
+            motor._start_pending_move()
 
-        return None
+        return sent
 
     def stop_motors(self, mask='111111'):
         """
@@ -193,12 +1186,14 @@ class Sixpack2Controller(list):
          0: motor masked, 1: set target position to actual position)
         """
 
-        mask = _encode_mask(mask)
+        mask = _parse_mask(mask)
 
-        command = '2A{0}'.format(mask) + 6 * '00'
-        self._send_command(command)
+        sent = self._send_command(STOP_MOTORS, mask)
+        for motor in self._motors_in(mask):
+            motor._targetpos = None
+            motor._ramp = None
 
-        return None
+        return sent
 
     # ========================================================================
     # Setting motor parameters
@@ -206,11 +1201,7 @@ class Sixpack2Controller(list):
 
     def set_velocity(self, clkdiv=5):
 
-        clkdiv = _encode_param(clkdiv, 'clkdiv', num_bytes=1)
-        command = '12{}'.format(clkdiv) + 6 * '00'
-        self._send_command(command)
-
-        return None
+        return self._send_command(SET_VELOCITY, clkdiv)
 
     def write_motor_char_table(self, pointer, entrylist):
         # nochmal vestehen was die funktion genau macht
@@ -221,16 +1212,7 @@ class Sixpack2Controller(list):
                             'type of given entry list: {}'
                             .format(type(entrylist)))
 
-        else:
-            pointer = _encode_param(pointer, 'table_pointer', num_bytes=1)
-
-        for i, v in enumerate(entrylist):
-            entrylist[i] = _encode_param(v, 'table_entry', num_bytes=1)
-
-        cmd = '17{0}{1}{2}{3}{4}'.format(pointer, *entrylist) + 2 * '00'
-        self._send_command(cmd)
-
-        return None
+        return self._send_command(WRITE_MOTOR_CHAR_TABLE, pointer, *entrylist)
 
     # =============================================================================
     # Additional Inputs/Outputs
@@ -238,22 +1220,16 @@ class Sixpack2Controller(list):
 
     def read_input_channels(self, channelno):
 
-        channelno = _encode_param(channelno, 'channelno', num_bytes=1)
-
-        request = '30{0}{1}'.format(channelno, self._resp_addr) + 5 * '00'
-        reply = self._send_request(request)
+        return self._send_request(READ_INPUT_CHANNELS, channelno,
+                                  self._resp_addr,
+                                  parse=self._parse_input_channels)
 
-        channelno = reply['p0']
+    def _parse_input_channels(self, reply):
 
-        analogue_value = reply['p1']
-
-        ref_input = reply['p3']
-
-        all_ref_inputs = reply['p4']
-        # um die Bedeutung herauszubekommen müsste man hier
-        # wieder in binär umrechnen
-
-        logic_state_TTLIO1 = reply['p5']
+        (_, _, channelno, analogue_value, ref_input,
+         all_ref_inputs, logic_state_TTLIO1) = reply
+        # um die Bedeutung von all_ref_inputs herauszubekommen müsste man
+        # hier wieder in binär umrechnen
 
         return (reply, channelno, analogue_value, ref_input,
                 all_ref_inputs, logic_state_TTLIO1)
@@ -261,39 +1237,24 @@ class Sixpack2Controller(list):
     def set_limits_stop_func(self, channelno,
                              min_value_left=0,
                              max_value_right=1023):
-        channelno = _encode_param(channelno, 'channelno', num_bytes=1)
 
-        min_value_left = _encode_param(min_value_left, 'stop_func_limits',
-                                       num_bytes=2)
-        max_value_right = _encode_param(max_value_right, 'stop_func_limits',
-                                        num_bytes=2)
-
-        cmd = '31{0}{1}{2}'.format(channelno, min_value_left, max_value_right)
-        cmd += 2 * '00'
-        self._send_command(cmd)
-
-        return None
+        return self._send_command(SET_LIMITS_STOP_FUNC, channelno,
+                                  min_value_left, max_value_right)
 
     def set_add_outputs(self, logic_state_TTLOUT1, TTLIO1,
                         logic_state_TTLIO1, TTLOUT1_ready):
 
-        cmd = '320{0}{1}{2}{3}'.format(logic_state_TTLOUT1, TTLIO1,
-                                       logic_state_TTLIO1, TTLOUT1_ready)
-        cmd += 3 * '00'
-
-        self._send_command(cmd)
-
-        return None
+        return self._send_command(SET_ADD_OUTPUTS, logic_state_TTLOUT1,
+                                  TTLIO1, logic_state_TTLIO1,
+                                  TTLOUT1_ready)
 
     def set_ready_output_func(self, motormask, refsearchmask):
 
-        motormask = _encode_mask(motormask)
-        refsearchmask = _encode_mask(refsearchmask)
+        motormask = _parse_mask(motormask)
+        refsearchmask = _parse_mask(refsearchmask)
 
-        cmd = '33{0}{1}'.format(motormask, refsearchmask) + 5 * '00'
-        self._send_command(cmd)
-
-        return None
+        return self._send_command(SET_READY_OUTPUT_FUNC, motormask,
+                                  refsearchmask)
 
     # =============================================================================
     # Other Settings
@@ -301,43 +1262,162 @@ class Sixpack2Controller(list):
 
     def adjust_baudrate(self, baudratedivisor, transmitter_delay=3):
 
-        baudratedivisor = _encode_param(baudratedivisor, 'baudratedivisor',
-                                        num_bytes=2)
-        transmitter_delay = _encode_param(transmitter_delay,
-                                          'transmitter_delay',
-                                          num_bytes=2)
+        sent = self._send_command(ADJUST_BAUDRATE, baudratedivisor,
+                                  transmitter_delay)
+        self.transmitter_delay = transmitter_delay
+
+        return sent
+
+    def negotiate_baudrate(self, target=57600, transmitter_delay=3,
+                           persist=True):
+        """
+        Switches PACK and serial port together to the baud rate target
+        (a key of BAUDRATE_DIVISORS) and verifies the link with
+        get_unit_info probes. If the probes fail, both sides fall back to
+        the previous baud rate. Afterwards the lowest transmitter delay
+        (1..transmitter_delay ms) which still probes reliably is chosen.
+
+        With persist, the result is stored per port (see portstate.py),
+        so a reconnect to a PACK which is still running at the negotiated
+        rate skips the negotiation.
+
+        Returns the baud rate and transmitter delay in use.
+        """
+
+        _check_baudrate(target)
+        stored = load_port_state(self._port) if persist else {}
 
-        cmd = '40{0}{1}'.format(baudratedivisor, transmitter_delay) + 3 * '00'
-        self._send_command(cmd)
+        with self._exclusive():
+            if self._batches.get(get_ident()) is not None:
+                raise RuntimeError('cannot negotiate the baud rate inside'
+                                   ' a transaction')
+
+            current = self._find_baudrate(stored.get('baudrate'))
+            if current is None:
+                raise TimeoutError('PACK does not answer at any supported'
+                                   ' baud rate')
+
+            if (current == target and stored.get('baudrate') == target
+                    and 'transmitter_delay' in stored):
+                self.transmitter_delay = stored['transmitter_delay']
+                return target, self.transmitter_delay
+
+            if current != target:
+                self._switch_baudrate(target, transmitter_delay)
+                if not self._probe(PROBE_ATTEMPTS):
+                    self._fall_back(current, target, transmitter_delay)
+                    target = current
+
+            delay = self._tune_transmitter_delay(target, transmitter_delay)
+
+        if persist:
+            save_port_state(self._port, baudrate=target,
+                            transmitter_delay=delay)
+
+        return target, delay
+
+    def _probe(self, attempts=1):
+        """
+        Returns True if the PACK answers get_unit_info attempts times
+        at the current baud rate of the port
+        """
+
+        frames = 2 * FRAME_LENGTH * BITS_PER_BYTE / self._ser.baudrate
+        for _ in range(attempts):
+            try:
+                self._send_request(GET_UNIT_INFO, self._resp_addr,
+                                   parse=self._parse_unit_info,
+                                   timeout=frames + PROBE_TIMEOUT)
+            except (TimeoutError, UserWarning):
+                return False
+
+        return True
+
+    def _find_baudrate(self, stored=None):
+        """
+        Returns the baud rate the PACK answers at, trying the stored rate,
+        the rate of the port and the power-on default first
+        """
+
+        candidates = [stored, self._ser.baudrate, DEFAULT_BAUDRATE]
+        candidates += sorted(BAUDRATE_DIVISORS, reverse=True)
+
+        tried = set()
+        for baudrate in candidates:
+            if baudrate is None or baudrate in tried:
+                continue
+            tried.add(baudrate)
+            self._ser.baudrate = baudrate
+            if self._probe():
+                return baudrate
 
         return None
 
-    def set_abort_timeout(self, abort_timeout):
+    def _switch_baudrate(self, baudrate, transmitter_delay):
+        """
+        Sends adjust_baudrate and switches the port once the frame has
+        left the host at the old baud rate
+        """
+
+        old = self._ser.baudrate
+        self.adjust_baudrate(BAUDRATE_DIVISORS[baudrate], transmitter_delay)
+        self._ser.flush()
+        sleep(FRAME_LENGTH * BITS_PER_BYTE / old)
+        self._ser.baudrate = baudrate
+
+        return None
+
+    def _fall_back(self, previous, target, transmitter_delay):
+        """
+        Returns PACK and port to the previous baud rate after a failed
+        switch to target. The PACK may or may not have switched, so the
+        command is sent at the target rate (lost if the PACK did not
+        switch) before the port is switched back.
+        """
 
-        abort_timeout = _encode_param(abort_timeout, 'abort_timeout',
-                                      num_bytes=2)
+        self._ser.baudrate = target
+        self._switch_baudrate(previous, transmitter_delay)
 
-        cmd = '41{0}'.format(abort_timeout) + 5 * '00'
-        self._send_command(cmd)
+        if not self._probe(PROBE_ATTEMPTS):
+            raise TimeoutError('PACK does not answer at {0} baud after'
+                               ' failed switch to {1} baud'
+                               .format(previous, target))
 
         return None
 
-    def change_unit_address(self, unit_address):
+    def _tune_transmitter_delay(self, baudrate, transmitter_delay):
+        """
+        Lowers the transmitter delay of the PACK step by step and returns
+        the lowest one at which the probes still succeed
+        """
+
+        divisor = BAUDRATE_DIVISORS[baudrate]
+        for delay in range(1, transmitter_delay):
+            self.adjust_baudrate(divisor, delay)
+            if self._probe(PROBE_ATTEMPTS):
+                return delay
 
-        unit_address = _encode_param(unit_address, 'unit_address', num_bytes=1)
+        self.adjust_baudrate(divisor, transmitter_delay)
+
+        return transmitter_delay
+
+    def set_abort_timeout(self, abort_timeout):
+
+        return self._send_command(SET_ABORT_TIMEOUT, abort_timeout)
+
+    def change_unit_address(self, unit_address):
 
-        cmd = '42{0}'.format(unit_address) + 6 * '00'
-        self._send_command(cmd)
+        sent = self._send_command(CHANGE_UNIT_ADDRESS, unit_address)
         self._sixpack_addr = unit_address
 
-        return None
+        return sent
 
     def complete_hwreset(self):
 
-        cmd = 'CC' + 7 * '00'
-        self._send_command(cmd)
+        sent = self._send_command(COMPLETE_HWRESET)
+        self.invalidate()
 
-        return None
+        return sent
 
     # =============================================================================
     # Multi-dimensional movement
@@ -345,16 +1425,180 @@ class Sixpack2Controller(list):
 
     def start_multi_movement(self, motormask):
 
-        motormask = _encode_mask(motormask)
+        motormask = _parse_mask(motormask)
 
-        cmd = '50{0}'.format(motormask) + 6 * '00'
-        self._send_command(cmd)
+        sent = self._send_command(START_MULTI_MOVEMENT, motormask)
+        for motor in self._motors_in(motormask):
+            motor._start_pending_move()
 
-        return None
+        return sent
+
+    def _linear_targets(self, targets):
+        """
+        Converts {motor or motno: targetpos} into {motor: targetpos}
+        """
+
+        moves = {}
+        for motor, targetpos in targets.items():
+            if not isinstance(motor, Sixpack2Motor):
+                motor = self[motor]
+            elif motor._ctrl is not self:
+                raise ValueError('motor {} belongs to another controller'
+                                 .format(motor._motno))
+            moves[motor] = targetpos
+
+        return moves
+
+    def _limits(self, command, motno):
+        """
+        Ramp setting of motor motno as given by the user (not the scaled
+        one of a linear move), None if unknown
+        """
+
+        key = command.key((motno,))
+
+        return self._nominal.get(key, self._written.get(key))
+
+    def _linear_frames(self, moves):
+        """
+        Plans a linear move, moves = {motor: (startpos, targetpos)}.
+        All axes follow one ramp of the path (0...1), limited by the
+        tightest axis, scaled by their distances. Returns the frames
+        (command, params) of the scaled ramp settings, the user's
+        settings they replace and the predicted duration (s).
+        """
+
+        velocity = self._written.get(SET_VELOCITY.key(()))
+        axes = []
+        for motor, (startpos, targetpos) in moves.items():
+            startvel = self._limits(SET_STARTVEL, motor._motno)
+            velacc = self._limits(SET_VELACC, motor._motno)
+            if None in (velocity, startvel, velacc):
+                raise ValueError('ramp settings of motor {} unknown, write'
+                                 ' them with set_velocity, set_startvel and'
+                                 ' set_velacc first'.format(motor._motno))
+            distance = abs(targetpos - startpos)
+            if distance:
+                axes.append((motor._motno, distance, startvel, velacc))
+
+        if not axes:
+            return [], {}, 0.0
+
+        # velocities and acceleration of the path per step of each axis
+        clkdiv, = velocity
+        limits = [ramp_params(vstart, vmax, amax, clkdiv, divi)
+                  for _, _, (_, _, vstart, divi), (_, amax, vmax) in axes]
+        v1 = min(v / axis[1] for (_, v, _), axis in zip(limits, axes))
+        v0 = min(min(v / axis[1] for (v, _, _), axis in zip(limits, axes)),
+                 v1)
+        a = min(a / axis[1] for (_, _, a), axis in zip(limits, axes))
+
+        unit = _velocity_hz(1, clkdiv)
+        vmax_limit = PARAMETER_RANGES['vmax'][1] - 1
+        amax_limit = PARAMETER_RANGES['amax'][1] - 1
+        frames = []
+        nominal = {}
+        duration = 0.0
+        for motno, distance, startvel, velacc in axes:
+            vmax = min(max(int(round(v1 * distance / unit)), 1), vmax_limit)
+            vstart = min(int(round(v0 * distance / unit)), vmax)
+            # the finest acceleration unit which holds the acceleration
+            for divi in reversed(range(*PARAMETER_RANGES['divi'])):
+                amax = int(round(a * distance
+                                 / _acceleration_hz2(1, clkdiv, divi)))
+                if amax <= amax_limit:
+                    break
+            amax = max(amax, 1)
+            vmin = min(startvel[1], vstart)
+
+            frames.append((SET_STARTVEL, (motno, vmin, vstart, divi)))
+            frames.append((SET_VELACC, (motno, amax, vmax)))
+            nominal[SET_STARTVEL.key((motno,))] = startvel
+            nominal[SET_VELACC.key((motno,))] = velacc
+            ramp = Ramp(0, distance, 0.0,
+                        *ramp_params(vstart, vmax, amax, clkdiv, divi))
+            duration = max(duration, ramp.duration)
+
+        return frames, nominal, duration
+
+    def move_linear(self, targets):
+        """
+        Moves several motors on a straight line: all of them start
+        together (start_multi_movement) and arrive at the same time, within
+        the resolution of the ramp parameters.
+
+            ctrl.move_linear({0: 1000, 1: -500, 2: 250})
+
+        vmax, amax and vstart of each axis are scaled with its distance, so
+        that the move takes as long as the slowest axis needs. Scaled
+        settings, targets and the start are sent in one transaction
+        (unchanged settings are skipped). The motors keep the scaled
+        settings, restore_limits writes the user's ones back. Requires the
+        ramp settings to be known (set_velocity, set_startvel, set_velacc)
+        and the motors to stand still.
+
+        Returns the predicted duration (s) of the move.
+        """
+
+        targets = self._linear_targets(targets)
+
+        now = monotonic()
+        moves = {}
+        for motor, targetpos in targets.items():
+            startpos = motor._startpos(now)
+            if startpos is None:
+                startpos = motor.get_pos()[0]
+            moves[motor] = (startpos, targetpos)
+
+        frames, nominal, duration = self._linear_frames(moves)
+
+        mask = 0
+        with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+            for motor, targetpos in targets.items():
+                motor.set_targetpos(targetpos)
+                mask |= 1 << motor._motno
+            self.start_multi_movement(mask)
+
+        with self._encode_lock:
+            self._nominal.update(nominal)
+
+        return duration
+
+    def _nominal_frames(self, motors=None):
+
+        motnos = None
+        if motors is not None:
+            motnos = {getattr(motor, '_motno', motor) for motor in motors}
+
+        with self._encode_lock:
+            return [(COMMANDS[key[0]], params)
+                    for key, params in self._nominal.items()
+                    if motnos is None or key[1] in motnos]
+
+    def restore_limits(self, motors=None):
+        """
+        Writes the ramp settings replaced by move_linear back (of all
+        motors or of the given motors/motor numbers) in one transaction.
+        Returns the number of frames sent.
+        """
+
+        frames = self._nominal_frames(motors)
+        with self.transaction():
+            for command, params in frames:
+                self._send_command(command, *params)
+
+        return len(frames)
 
     # =============================================================================
     # Closing Serial Port
     # =============================================================================
 
     def __del__(self):
+        if getattr(self, '_poller', None) is not None:
+            self._poller.stop(join=False)
+        worker = getattr(self, '_worker', None)
+        if worker is not None and worker._ctrl is self:
+            worker.stop(join=False)
         self._ser.close()
@@ -1,46 +1,52 @@
 #!/usr/bin/env python
 
+from time import monotonic
 from weakref import ref
-from constants import *
+from constants import I_DICT, _decode_action, _debounce_bits
+from constants import JOG_BUS_SHARE, JOG_TIMEOUT
+from motion import Ramp, ramp_params
+from jog import JogChannel
+from codec import *
 
 
 class Sixpack2Motor(object):
 
     def __init__(self, ctrl, motno):
         self._motno = motno
+        self._key = 'motor{}'.format(motno)
         r = ref(ctrl)
         self._ctrl = r()
 
+        self._targetpos = None
+        self._pending_targetpos = None
+        self._ramp = None
+
     def get_pos(self):
         """
         Queries position and activity of given motor
         (motno: 0...num_motors)
         """
 
-        request = '200{0}{1}'.format(self._motno, self._ctrl._resp_addr)
-        request += 5 * '00'
+        return self._ctrl._send_request(GET_POS, self._motno,
+                                        self._ctrl._resp_addr,
+                                        parse=self._parse_pos)
 
-        reply = self._ctrl._send_request(request)
+    def _parse_pos(self, reply):
 
-        if self._motno != reply['p0']:
-            raise UserWarning('specified motornumber != response motornumber')
+        _, _, motno, posact, act, stop_status = reply
 
-        posact = _decode_param([reply['p1'], reply['p2'],
-                                reply['p3'], reply['p4']])
+        if self._motno != motno:
+            raise UserWarning('specified motornumber != response motornumber')
 
-        act = reply['p5']
-        if act in ACTION_DICT:
-            action = ACTION_DICT[act]
-        elif 20 <= act <= 29:
-            action = 'reference switch search'
-        else:
-            raise ValueError('reply action ({0}) seems to be incorrect'
-                             .format(act),
-                             'and was not found in ACTION_DICT')
+        action = _decode_action(act)
 
-        self._ctrl.status_dict['motor{}'.format(self._motno)] = action
+        self._observe(self._ctrl._sample_time(), action, posact)
 
-        stop_status = reply['p6']
+        status = self._ctrl.status_dict[self._key]
+        status['action'] = action
+        status['position'] = posact
+        self._ctrl._publish_status(self._motno, position=posact,
+                                   action=action)
 
         return posact, action, stop_status
 
@@ -50,26 +56,79 @@ class Sixpack2Motor(object):
         (motno: 0...num_motors)
         """
 
-        request = '210{0}{1}'.format(self._motno, self._ctrl._resp_addr)
-        request += 5 * '00'
-        reply = self._ctrl._send_request(request)
+        return self._ctrl._send_request(GET_VEL, self._motno,
+                                        self._ctrl._resp_addr,
+                                        parse=self._parse_vel)
 
-        velact = _decode_param([reply['p1'], reply['p2']], signed=True)
+    def _parse_vel(self, reply):
 
-        act = reply['p3']
-        if act in ACTION_DICT:
-            action = ACTION_DICT[act]
-        elif 20 <= act <= 29:
-            action = 'reference switch search'
-        else:
-            raise ValueError('reply action ({0}) seems to be incorrect'
-                             .format(act),
-                             'and was not found in ACTION_DICT')
+        _, _, _, velact, act = reply
+
+        action = _decode_action(act)
 
-        self._ctrl.status_dict['motor{}'.format(self._motno)] = action
+        status = self._ctrl.status_dict[self._key]
+        status['action'] = action
+        status['velocity'] = velact
+        self._ctrl._publish_status(self._motno, velocity=velact,
+                                   action=action)
 
         return self._motno, velact, action
 
+    # =============================================================================
+    # Cached status
+    # =============================================================================
+
+    def _cached(self, field, max_age):
+        """
+        Returns the cached value of field if it is at most max_age seconds
+        old (any age if max_age is None), otherwise None
+        """
+
+        status = self._ctrl._snapshot[self._motno]
+        stamp = getattr(status, field + '_time')
+        if stamp is None:
+            return None
+        if max_age is not None and monotonic() - stamp > max_age:
+            return None
+
+        return getattr(status, field)
+
+    def position(self, max_age=0):
+        """
+        Returns the actual position from the status cache if it is not older
+        than max_age seconds, otherwise queries it from the PACK
+        """
+
+        value = self._cached('position', max_age)
+        if value is None:
+            value = self.get_pos()[0]
+
+        return value
+
+    def velocity(self, max_age=0):
+        """
+        Returns the actual velocity from the status cache if it is not older
+        than max_age seconds, otherwise queries it from the PACK
+        """
+
+        value = self._cached('velocity', max_age)
+        if value is None:
+            value = self.get_vel()[1]
+
+        return value
+
+    def action(self, max_age=0):
+        """
+        Returns the activity from the status cache if it is not older
+        than max_age seconds, otherwise queries it from the PACK
+        """
+
+        value = self._cached('action', max_age)
+        if value is None:
+            value = self.get_pos()[1]
+
+        return value
+
     # =============================================================================
     # Moving the motor
     # =============================================================================
@@ -80,63 +139,231 @@ class Sixpack2Motor(object):
         Starts search of reference switch
         """
 
-        cmd = '220{}'.format(self._motno) + 6 * '00'
-        self._ctrl._send_command(cmd)
+        sent = self._ctrl._send_command(START_REF_SEARCH, self._motno)
+        self._targetpos = None
+        self._ramp = None
 
-        return None
+        return sent
 
     def start_ramp(self, targetpos):
 
-        targetpos = _encode_param(targetpos, 'targetpos', num_bytes=4)
-
-        cmd = '230{0}{1}'.format(self._motno, targetpos) + 2 * '00'
-        self._ctrl._send_command(cmd)
+        sent = self._ctrl._send_command(START_RAMP, self._motno, targetpos)
+        self._start_move(targetpos)
 
-        return None
+        return sent
 
     def activate_PI_on_targetpos(self, targetpos):
 
-        targetpos = _encode_param(targetpos, 'targetpos', num_bytes=4)
+        return self._ctrl._send_command(ACTIVATE_PI_ON_TARGETPOS, self._motno,
+                                        targetpos)
 
-        cmd = '240{0}{1}'.format(self._motno, targetpos) + 2 * '00'
-        self._ctrl._send_command(cmd)
+    def rotate(self, rotvel):
 
-        return None
+        sent = self._ctrl._send_command(ROTATE, self._motno, rotvel)
+        self._targetpos = None
+        self._ramp = None
 
-    def rotate(self, rotvel):
+        return sent
 
-        rotvel = _encode_param(rotvel, 'rotvel', num_bytes=2)
+    def jog(self, share=JOG_BUS_SHARE, timeout=JOG_TIMEOUT):
+        """
+        Opens a jog channel streaming rotation velocities with latest value
+        wins (see jog.JogChannel)
+        """
 
-        cmd = '250{0}{1}'.format(self._motno, rotvel) + 4 * '00'
-        self._ctrl._send_command(cmd)
+        channel = JogChannel(self, share, timeout)
+        channel.start()
 
-        return None
+        return channel
 
     def set_targetpos(self, targetpos):
 
-        targetpos = _encode_param(targetpos, 'targetpos', num_bytes=4)
+        sent = self._ctrl._send_command(SET_TARGETPOS, self._motno, targetpos)
+        self._pending_targetpos = targetpos
+
+        return sent
+
+    def set_actualpos(self, posact):
+
+        sent = self._ctrl._send_command(SET_ACTUALPOS, self._motno, posact)
+        if self._ramp is not None and self._ramp.distance == 0:
+            self._ramp = Ramp.at_rest(posact, monotonic())
+        else:
+            self._ramp = None
+        self._targetpos = None
+
+        return sent
+
+    def abort_ref_search(self):
+        """
+        Aborts reference search of the specified motor
+        """
+
+        return self._ctrl._send_command(ABORT_REF_SEARCH, self._motno)
+
+    # =========================================================================
+    # Motion model (see motion.py)
+    # =========================================================================
+
+    def _ramp_params(self):
+        """
+        Start velocity, maximum velocity and acceleration of a ramp from the
+        settings written to the PACK; None if they are not known
+        """
+
+        written = self._ctrl._written
+        velacc = written.get(SET_VELACC.key((self._motno,)))
+        startvel = written.get(SET_STARTVEL.key((self._motno,)))
+        velocity = written.get(SET_VELOCITY.key(()))
+        if None in (velacc, startvel, velocity):
+            return None
+
+        _, amax, vmax = velacc
+        _, _, vstart, divi = startvel
+        clkdiv, = velocity
+
+        return ramp_params(vstart, vmax, amax, clkdiv, divi)
+
+    def _startpos(self, now):
+        """
+        Best known position from which a new move starts
+        """
 
-        cmd = '260{0}{1}'.format(self._motno, targetpos) + 2 * '00'
-        self._ctrl._send_command(cmd)
+        position = self.estimated_pos(now)
+        if position is None:
+            position = self._targetpos
+        if position is None:
+            position = self._ctrl._snapshot[self._motno].position
+
+        return position
+
+    def predicted_move_time(self, targetpos, startpos=None):
+        """
+        Predicts the duration (s) of a ramp from startpos (default: last
+        known position) to targetpos from the ramp parameters written to the
+        PACK; None if they are not known
+        """
+
+        params = self._ramp_params()
+        if startpos is None:
+            startpos = self._startpos(monotonic())
+        if params is None or startpos is None:
+            return None
+
+        return Ramp(startpos, targetpos, 0.0, *params).duration
+
+    def predicted_arrival(self):
+        """
+        Time (monotonic) at which the current move is predicted to end
+        (in the past if it has ended), None if unknown
+        """
+
+        if self._ramp is None:
+            return None
+
+        return self._ramp.end
+
+    def remaining_move_time(self):
+        """
+        Predicted time (s) until the current move is finished,
+        None if unknown
+        """
+
+        arrival = self.predicted_arrival()
+        if arrival is None:
+            return None
+
+        return max(0.0, arrival - monotonic())
+
+    def estimated_pos(self, now=None):
+        """
+        Position (steps) at time now (monotonic, default: now) estimated from
+        the current ramp without talking to the PACK, None if unknown (e.g.
+        ramp parameters not written, rotation or reference search).
+        Every get_pos reply corrects the estimate.
+        """
+
+        if self._ramp is None:
+            return None
+        if now is None:
+            now = monotonic()
+
+        return int(round(self._ramp.state(now)[0]))
+
+    def estimated_vel(self, now=None):
+        """
+        Velocity (steps/s) at time now estimated like estimated_pos
+        """
+
+        if self._ramp is None:
+            return None
+        if now is None:
+            now = monotonic()
+
+        return self._ramp.state(now)[1]
+
+    def _start_move(self, targetpos):
+
+        # the PACK starts once it has received the frame
+        now = monotonic()
+        start = now + self._ctrl._frame_time()
+        params = self._ramp_params()
+        startpos = self._startpos(now)
+        if params is None or startpos is None:
+            self._ramp = None
+        else:
+            self._ramp = Ramp(startpos, targetpos, start, *params)
+        self._targetpos = targetpos
 
         return None
 
-    def set_actualpos(self, posact):
+    def _move_unpredicted(self):
+        """
+        True if the motor moves to a known target but its ramp is unknown
+        because the move started from an unknown position
+        """
+
+        return (self._ramp is None and self._targetpos is not None
+                and self._ramp_params() is not None)
 
-        posact = _encode_param(posact, 'posact', num_bytes=4)
+    def _start_pending_move(self):
 
-        cmd = '270{0}{1}'.format(self._motno, posact) + 2 * '00'
-        self._ctrl._send_command(cmd)
+        if self._pending_targetpos is None:
+            self._targetpos = None
+            self._ramp = None
+        else:
+            self._start_move(self._pending_targetpos)
+            self._pending_targetpos = None
 
         return None
 
-    def abort_ref_search(self):
+    def _observe(self, when, action, position=None):
         """
-        Aborts reference search of the specified motor
+        Corrects the motion model with the action and (if known) position
+        the PACK reported for time when
         """
 
-        cmd = '2B0{}'.format(self._motno) + 6 * '00'
-        self._ctrl._send_command(cmd)
+        ramp = self._ramp
+        if action == 'inactive':
+            # a ramp ends at its target unless stopped (which clears it)
+            if position is None and ramp is not None:
+                position = ramp.targetpos
+            if position is None:
+                self._ramp = None
+            else:
+                self._ramp = Ramp.at_rest(position, when)
+        elif (action == 'ramping' and ramp is None and position is not None
+              and self._targetpos is not None):
+            # a move started from an unknown position: the rest of it takes
+            # at most as long as a ramp from rest at this position
+            params = self._ramp_params()
+            if params is not None:
+                self._ramp = Ramp(position, self._targetpos, when, *params)
+        elif action != 'ramping' or ramp is None or ramp.distance == 0:
+            # moving in a way the model does not know
+            self._ramp = None
+        elif position is not None:
+            ramp.align(position, when)
 
         return None
 
@@ -146,12 +373,8 @@ class Sixpack2Motor(object):
 
     def set_peak_current(self, peak_current):
 
-        peak_current = _encode_param(peak_current, 'peak_current', num_bytes=1)
-
-        command = '100{0}{1}'.format(self._motno, peak_current) + 5 * '00'
-        self._send_command(command)
-
-        return None
+        return self._ctrl._send_command(SET_PEAK_CURRENT, self._motno,
+                                        peak_current)
 
     def control_current(self, T0, currentlist=[0, 50, 75, 100]):
 
@@ -166,97 +389,51 @@ class Sixpack2Motor(object):
         for i in currentlist:
             try:
                 I_list.append(I_DICT[i])
-            except KeyError as e:
-                print('given percentage of current ({}%) is not in allowed',
-                      'values'.format(i),
-                      '(allowed values: {}; given current list: {})'
-                      .format(I_DICT.keys(), currentlist),
-                      '(error msg: {})'.format(e))
-
-        T0 = _encode_param(T0, 'T0', num_bytes=2)
-        command = '110{0}0{1}0{2}0{3}0{4}{5}' % (self._motno, *I_list, T0)
-        self._send_command(command)
+            except KeyError:
+                raise ValueError('given percentage of current ({}%) is not in'
+                                 ' allowed values (allowed values: {};'
+                                 ' given current list: {})'
+                                 .format(i, list(I_DICT), currentlist))
 
-        return None
+        return self._ctrl._send_command(CONTROL_CURRENT, self._motno,
+                                        *I_list, T0)
 
     def set_startvel(self, vmin, vstart, divi):
 
-        vmin = _encode_param(vmin, 'vmin', num_bytes=2)
-        vstart = _encode_param(vstart, 'vstart', num_bytes=2)
-        divi = _encode_param(divi, 'divi', num_bytes=1)
-
-        command = '130{0}{1}{2}{3}00'.format(self._motno, vmin, vstart, divi)
-        self._send_command(command)
-
-        return None
+        return self._ctrl._send_command(SET_STARTVEL, self._motno,
+                                        vmin, vstart, divi)
 
     def set_velacc(self, amax, vmax):
 
-        amax = _encode_param(amax, 'amax', num_bytes=2)
-        vmax = _encode_param(vmax, 'vmax', num_bytes=2)
-
-        command = '140{0}{1}{2}0000'.format(self._motno, amax, vmax)
-        self._send_command(command)
-
-        return None
+        return self._ctrl._send_command(SET_VELACC, self._motno, amax, vmax)
 
     def set_motparams(self, poslimit, mottype, other):
 
-        poslimit = _encode_param(poslimit, 'poslimit', num_bytes=4)
-
-        cmd = '150{0}{1}{2}{3}'.format(self._motno, poslimit, mottype, other)
-        self._send_command(cmd)
-
-        return None
+        return self._ctrl._send_command(SET_MOTPARAMS, self._motno,
+                                        poslimit, mottype, other)
 
     def ref_search_params(self, vrefmax, debounce, stop_after=0):
         """
         change parameters for fast reference search
-        (change only with motors standing still)
+        (only possible with motors standing still, waits until all motors
+         are inactive)
         """
 
-        wait = True
-        counter = 0
-        while wait:
-            self._ctrl.query_all_motor_activities()
-            checksum = sum(i for i in self._ctrl.status_dict.values())
-            if checksum == 0:
-                wait = False
-            else:
-                counter += 1
-                print('waiting for all motors to become inactive'
-                      + counter * '.')
+        self._ctrl.wait_until_idle('111111')
 
-        vrefmax = _encode_param(vrefmax, 'vrefmax', num_bytes=2)
         # 511 >= vmax >= vrefmax >= vstart
+        debounce = _debounce_bits(debounce)
 
-        debounce = _encode_debounce(debounce)
-
-        cmd = '160{0}{1}{2}0{3}'.format(self._motno, vrefmax,
-                                        debounce, stop_after)
-        self._send_command(cmd)
-
-        return None
+        return self._ctrl._send_command(REF_SEARCH_PARAMS, self._motno,
+                                        vrefmax, debounce, stop_after)
 
     def set_nulloffset_nullrange(self, nulloffset, nullrange):
 
-        nulloffset = _encode_param(nulloffset, 'nulloffset', num_bytes=4)
-        nullrange = _encode_param(nullrange, 'nullrange', num_bytes=2)
-
-        cmd = '180{0}{1}{2}'.format(self._motno, nulloffset, nullrange)
-        self._send_command(cmd)
-
-        return None
+        return self._ctrl._send_command(SET_NULLOFFSET_NULLRANGE,
+                                        self._motno, nulloffset, nullrange)
 
     def set_PI_parameter(self, propdiv, intdiv, intclip, intinpclip):
 
-        propdiv = _encode_param(propdiv, 'propdiv', num_bytes=1)
-        intdiv = _encode_param(intdiv, 'intdiv', num_bytes=2)
-        intclip = _encode_param(intclip, 'intclip', num_bytes=2)
-        intinpclip = _encode_param(intinpclip, 'intinpclip', num_bytes=1)
-
-        cmd = '190{0}{1}{2}{3}{4}'.format(self._motno, propdiv, intdiv,
-                                          intclip, intinpclip)
-        self._send_command(cmd)
-
-        return None
+        return self._ctrl._send_command(SET_PI_PARAMETER, self._motno,
+                                        propdiv, intdiv, intclip,
+                                        intinpclip)
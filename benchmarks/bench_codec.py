@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Encoding/decoding throughput: legacy hex-string helpers of constants.py
+(_encode_param, _decode_param, _encode_mask) versus the precompiled codec.
+
+usage: python benchmarks/bench_codec.py [number]
+"""
+
+import sys
+from timeit import repeat
+
+import common  # noqa: F401 (sets up sys.path)
+from common import result
+from constants import _encode_param, _decode_param, _encode_mask
+from codec import FRAME_LENGTH, START_RAMP, GET_POS
+
+_REPLY = bytes([0, 0x20, 1, 0x18, 0xFC, 0xFF, 0xFF, 5, 0])
+_buffer = bytearray(FRAME_LENGTH)
+
+
+def legacy_encode():
+    targetpos = _encode_param(-1000, 'targetpos', num_bytes=4)
+    cmd = '00' + '230{0}{1}'.format(1, targetpos) + 2 * '00'
+    return bytes.fromhex(cmd)
+
+
+def legacy_decode(reply=_REPLY):
+    reply_hex = reply.hex()
+    p = [int(reply_hex[2*i:2*i+2], 16) for i in range(9)]
+    return _decode_param(p[3:7]), p[7]
+
+
+def codec_encode():
+    START_RAMP.pack_into(_buffer, 0, 1, -1000)
+    return _buffer
+
+
+def codec_decode(reply=_REPLY):
+    _, _, _, posact, act, _ = GET_POS.unpack_reply(reply)
+    return posact, act
+
+
+CASES = [('encode_param', lambda: _encode_param(-1000, 'targetpos')),
+         ('decode_param', lambda: _decode_param([0x18, 0xFC, 0xFF, 0xFF])),
+         ('encode_mask', lambda: _encode_mask('101101')),
+         ('legacy_encode_frame', legacy_encode),
+         ('legacy_decode_frame', legacy_decode),
+         ('codec_encode_frame', codec_encode),
+         ('codec_decode_frame', codec_decode)]
+
+
+def run(args=None, number=100000):
+
+    if args is not None and args.quick:
+        number //= 10
+
+    results = {}
+    for name, func in CASES:
+        best = min(repeat(func, number=number, repeat=5))
+        results['codec.' + name] = result(number / best, 'ops/s', 'higher')
+
+    return results
+
+
+def main(number=100000):
+    for name, res in run(number=number).items():
+        print('{0:32s} {1:12.0f} {2}'.format(name, res['value'], res['unit']))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Request round-trip latency percentiles of get_pos, get_vel and query_all
+"""
+
+from time import perf_counter
+
+from common import result, percentile, make_controller
+
+PERCENTILES = (50, 90, 99)
+
+
+def run(args):
+
+    samples = 50 if args.quick else 500
+    ctrl, _ = make_controller(args)
+
+    requests = [('get_pos', ctrl[0].get_pos),
+                ('get_vel', ctrl[0].get_vel),
+                ('query_all', ctrl.query_all)]
+
+    results = {}
+    for name, request in requests:
+        times = []
+        for _ in range(samples):
+            start = perf_counter()
+            request()
+            times.append(perf_counter() - start)
+        for p in PERCENTILES:
+            key = 'latency.{0}.p{1}'.format(name, p)
+            results[key] = result(1e3 * percentile(times, p), 'ms', 'lower')
+
+    return results
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Multi-axis start skew: time between the first and the last motor starting
+its ramp, measured on the simulated PACK, for sequential start_ramp calls
+versus set_targetpos + start_parallel_ramp (with and without transaction)
+"""
+
+from common import result, make_controller
+
+
+def _skew(device):
+
+    started = [m.started for m in device.motors]
+
+    return max(started) - min(started)
+
+
+def sequential(ctrl):
+    for i, motor in enumerate(ctrl):
+        motor.start_ramp(1000 * (i + 1))
+
+
+def parallel(ctrl):
+    for i, motor in enumerate(ctrl):
+        motor.set_targetpos(1000 * (i + 1))
+    ctrl.start_parallel_ramp('111111')
+
+
+def sequential_transaction(ctrl):
+    with ctrl.transaction():
+        sequential(ctrl)
+
+
+def parallel_transaction(ctrl):
+    with ctrl.transaction():
+        parallel(ctrl)
+
+
+def run(args):
+
+    if args.port:
+        # start times can only be observed on the simulated PACK
+        return {}
+
+    results = {}
+    for name, start in [('sequential', sequential), ('parallel', parallel),
+                        ('sequential_transaction', sequential_transaction),
+                        ('parallel_transaction', parallel_transaction)]:
+        ctrl, device = make_controller(args)
+        start(ctrl)
+        ctrl.get_unit_info()   # wait until all frames are on the line
+        key = 'skew.{}'.format(name)
+        results[key] = result(1e3 * _skew(device), 'ms', 'lower')
+
+    return results
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Sustained commands per second at each baud rate: bursts of set_targetpos
+commands, each burst closed by a request to wait for the line
+"""
+
+from time import perf_counter
+
+from common import result, make_controller, BAUDRATES
+
+
+def run(args):
+
+    bursts = 5 if args.quick else 20
+    burst = 20
+    baudrates = BAUDRATES if not args.port else (19200,)
+
+    results = {}
+    for baudrate in baudrates:
+        ctrl, _ = make_controller(args, baudrate=baudrate)
+        motors = list(ctrl)
+
+        start = perf_counter()
+        for _ in range(bursts):
+            for i in range(burst):
+                motors[i % len(motors)].set_targetpos(i)
+            ctrl.query_all()
+        elapsed = perf_counter() - start
+
+        frames = bursts * (burst + 1)
+        key = 'throughput.{}baud'.format(baudrate)
+        results[key] = result(frames / elapsed, 'frames/s', 'higher')
+
+    return results
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Helpers shared by the benchmark suites
+"""
+
+import os
+import sys
+from math import ceil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from simulator import SimulatedSerial, VirtualSixpack2  # noqa: E402
+
+BAUDRATES = (9600, 19200, 38400, 57600)
+
+
+def result(value, unit, better):
+    """
+    Single benchmark result; better is 'higher' or 'lower'
+    """
+
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def percentile(samples, p):
+    """
+    p-th percentile (0...100) of the samples, nearest rank
+    """
+
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, ceil(p / 100.0 * len(ordered)) - 1))
+
+    return ordered[rank]
+
+
+def make_controller(args, baudrate=19200, num_motors=6):
+    """
+    Controller on the simulator, or on the serial port given with --port
+    """
+
+    from Sixpack2Controller import Sixpack2Controller
+
+    if args.port:
+        return Sixpack2Controller(port=args.port, baudrate=baudrate,
+                                  timeout=1.0, num_motors=num_motors), None
+
+    device = VirtualSixpack2(num_motors=num_motors)
+    device.baudrate = baudrate
+    transport = SimulatedSerial(device, baudrate=baudrate)
+    ctrl = Sixpack2Controller(transport=transport, baudrate=baudrate,
+                              timeout=1.0, num_motors=num_motors)
+
+    return ctrl, device
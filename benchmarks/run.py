@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Benchmark runner for the serial protocol stack.
+
+    python benchmarks/run.py -o results.json
+    python benchmarks/run.py -o new.json --compare results.json
+
+Runs against the simulator unless --port is given. With --compare, the
+results are compared with a previous run and the exit status is 1 if any
+benchmark got worse by more than --threshold (relative).
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+
+import bench_codec
+import bench_latency
+import bench_throughput
+import bench_skew
+
+SUITES = {'codec': bench_codec, 'latency': bench_latency,
+          'throughput': bench_throughput, 'skew': bench_skew}
+
+
+def run_suites(args):
+
+    results = {}
+    for name in args.suites:
+        print('running {} ...'.format(name), file=sys.stderr)
+        results.update(SUITES[name].run(args))
+
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'port': args.port or 'simulator'},
+            'results': results}
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns a list of (name, old, new, change) for all benchmarks present
+    in both runs; change > 0 means worse. Changes smaller than 5 us are
+    ignored for time based results (timer resolution).
+    """
+
+    rows = []
+    for name, new in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None or not old['value']:
+            continue
+        change = (new['value'] - old['value']) / old['value']
+        if new['better'] == 'higher':
+            change = -change
+        if (new['unit'] == 'ms'
+                and abs(new['value'] - old['value']) < 5e-3):
+            change = 0.0
+        rows.append((name, old['value'], new['value'], change,
+                     change > threshold))
+
+    return rows
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='suites to run ({}; default: all)'.format(
+                            ', '.join(sorted(SUITES))))
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change flagged as regression')
+    parser.add_argument('--port', help='run against a real PACK')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer iterations')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suite(s): {}'.format(', '.join(unknown)))
+    args.suites = args.suites or sorted(SUITES)
+
+    run = run_suites(args)
+
+    for name, res in sorted(run['results'].items()):
+        print('{0:40s} {1:14.3f} {2}'.format(name, res['value'],
+                                             res['unit']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        rows = compare(run['results'], baseline, args.threshold)
+        regressions = [row for row in rows if row[4]]
+        print()
+        for name, old, new, change, regression in rows:
+            print('{0:40s} {1:14.3f} -> {2:14.3f} {3:+7.1%}{4}'.format(
+                name, old, new, -change, '  REGRESSION' if regression
+                else ''))
+        if regressions:
+            print('\n{} regression(s)'.format(len(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import struct
+from time import time, monotonic, sleep
+from threading import Lock
+
+# =============================================================================
+# File format: MAGIC, wall clock time of the start (HEADER), then one RECORD
+# (seconds since the start, direction, length) followed by the data for every
+# write of the host and every non-empty read
+# =============================================================================
+
+MAGIC = b'SIXPACK2CAP1'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<dBH')
+
+TX = 0      # host -> PACK
+RX = 1      # PACK -> host
+
+
+def read_capture(path):
+    """
+    Yields the records (time, direction, data) of a capture file
+    """
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a Sixpack2 capture file'.format(path))
+        f.read(HEADER.size)
+
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            t, direction, length = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield t, direction, data
+
+
+# =============================================================================
+# Capture
+# =============================================================================
+
+
+class CaptureTransport(object):
+    """
+    Wraps a serial port (or any transport) and appends everything written
+    to and read from it to a capture file. Used by
+    Sixpack2Controller.start_capture().
+    """
+
+    def __init__(self, ser, path):
+
+        self.ser = ser
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER.pack(time()))
+        self._start = monotonic()
+        self._lock = Lock()
+
+    def _log(self, direction, data):
+
+        with self._lock:
+            self._file.write(RECORD.pack(monotonic() - self._start,
+                                         direction, len(data)))
+            self._file.write(data)
+
+        return None
+
+    def write(self, data):
+
+        self._log(TX, bytes(data))
+
+        return self.ser.write(data)
+
+    def read(self, size=1):
+
+        data = self.ser.read(size)
+        if data:
+            self._log(RX, data)
+
+        return data
+
+    def readinto(self, buffer):
+
+        n = self.ser.readinto(buffer)
+        if n:
+            self._log(RX, bytes(buffer[:n]))
+
+        return n
+
+    def close_capture(self):
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+        return None
+
+    def close(self):
+
+        self.close_capture()
+
+        return self.ser.close()
+
+    # the remaining interface of the port is passed through
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.ser.baudrate = baudrate
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ser.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+# =============================================================================
+# Replay
+# =============================================================================
+
+
+class ReplayTransport(object):
+    """
+    Serial port replaying a capture file: after each write, the bytes the
+    host read in the recording until its next write become available with
+    their original delays divided by speed (speed=None: immediately).
+
+        ctrl = Sixpack2Controller(transport=ReplayTransport('wire.cap'))
+
+    With strict, writes differing from the recording raise ValueError, so
+    the replay stops where the behaviour of the library diverges.
+    """
+
+    def __init__(self, path, speed=1.0, strict=True, timeout=None):
+
+        self.path = path
+        self.port = 'replay://' + str(path)
+        self.speed = speed
+        self.strict = strict
+        self.timeout = timeout
+        self.baudrate = None
+        self.is_open = True
+
+        self._records = list(read_capture(path))
+        self._cursor = 0
+        self._rx = bytearray()
+        self._schedule = []
+
+    @property
+    def finished(self):
+        return self._cursor >= len(self._records) and not self._schedule
+
+    def write(self, data):
+
+        data = bytes(data)
+        records = self._records
+
+        while self._cursor < len(records) and records[self._cursor][1] != TX:
+            self._cursor += 1
+        if self._cursor >= len(records):
+            raise EOFError('capture {} exhausted'.format(self.path))
+
+        start, _, recorded = records[self._cursor]
+        self._cursor += 1
+        if self.strict and data != recorded:
+            raise ValueError('replay diverged from capture at record {0}:'
+                             ' wrote {1} instead of {2}'
+                             .format(self._cursor - 1, data.hex().upper(),
+                                     recorded.hex().upper()))
+
+        # replies not read before the next write are dropped
+        now = monotonic()
+        self._rx.clear()
+        self._schedule = []
+        while self._cursor < len(records) and records[self._cursor][1] == RX:
+            t, _, reply = records[self._cursor]
+            delay = 0.0 if not self.speed else (t - start) / self.speed
+            self._schedule.append((now + delay, reply))
+            self._cursor += 1
+
+        return len(data)
+
+    def _collect(self, now):
+
+        while self._schedule and self._schedule[0][0] <= now:
+            self._rx += self._schedule.pop(0)[1]
+
+        return None
+
+    def read(self, size=1):
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = monotonic() + self.timeout
+
+        now = monotonic()
+        self._collect(now)
+        while len(self._rx) < size and self._schedule:
+            due = self._schedule[0][0]
+            if deadline is not None and due > deadline:
+                break
+            sleep(max(0.0, due - now))
+            now = monotonic()
+            self._collect(now)
+
+        if len(self._rx) < size and deadline is not None:
+            sleep(max(0.0, deadline - monotonic()))
+
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+
+        return data
+
+    def readinto(self, buffer):
+
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    @property
+    def in_waiting(self):
+
+        self._collect(monotonic())
+
+        return len(self._rx)
+
+    def reset_input_buffer(self):
+        # the capture only holds bytes read after the reset
+        return None
+
+    def reset_output_buffer(self):
+        return None
+
+    def flush(self):
+        return None
+
+    def close(self):
+        self.is_open = False
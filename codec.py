@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+
+from numbers import Real
+from struct import Struct, error as StructError
+from constants import PARAMETER_RANGES, _decode_action
+
+# =============================================================================
+# Every frame exchanged with the PACK is 9 bytes long:
+# unit address, command number and 7 parameter bytes (little endian)
+# =============================================================================
+
+FRAME_LENGTH = 9
+
+_HEADER = '<BB'
+
+
+def _build_struct(fields):
+    """
+    Build precompiled struct for the given (name, format) fields, padded
+    to the full frame length
+    """
+
+    fmt = _HEADER + ''.join(f for _, f in fields)
+    pad = FRAME_LENGTH - Struct(fmt).size
+    if pad < 0:
+        raise ValueError('fields {} do not fit into a frame'.format(fields))
+
+    return Struct(fmt + pad * 'x')
+
+
+def _field_offsets(fields):
+    """
+    Offsets and formats of the (first occurrence of the) named fields
+    within the frame
+    """
+
+    offsets = {}
+    fmt = _HEADER
+    for name, f in fields:
+        offsets.setdefault(name, (Struct(fmt).size, f))
+        fmt += f
+
+    return offsets
+
+
+def _build_echo(fields, reply_fields):
+    """
+    Offsets in the request frame of the leading bytes of the reply: the
+    response address (the unit address if there is none), the command
+    number and the single byte request parameters repeated at the start
+    of the reply
+    """
+
+    offsets = _field_offsets(fields)
+    echo = [offsets.get('resp_addr', (0, 'B'))[0], 1]
+    for name, f in reply_fields:
+        if f != 'B' or offsets.get(name, (None, None))[1] != 'B':
+            break
+        echo.append(offsets[name][0])
+
+    return tuple(echo)
+
+
+def _build_limits(fields):
+    """
+    Look up the allowed values of each field in PARAMETER_RANGES. Tuples of
+    length two are half-open ranges, longer tuples enumerate allowed values.
+    """
+
+    limits = []
+    for name, _ in fields:
+        allowed = PARAMETER_RANGES[name]
+        if len(allowed) == 2:
+            limits.append((name, allowed[0], allowed[1], None))
+        else:
+            limits.append((name, None, None, frozenset(allowed)))
+
+    return tuple(limits)
+
+
+def _build_packer(command):
+    """
+    Compile pack_into(buffer, addr, *params) for a command: the range
+    checks of all parameters are unrolled into a single expression against
+    the bounds of _build_limits, so that encoding a valid frame costs one
+    comparison per parameter and one struct call. Parameters out of range
+    are reported by Command.check.
+    """
+
+    namespace = {'command': command, 'opcode': command.opcode,
+                 'struct_pack_into': command._struct.pack_into,
+                 'StructError': StructError}
+    # arguments are named after the fields (numbered if repeated)
+    names = []
+    tests = []
+    for i, (name, lo, hi, allowed) in enumerate(command._limits):
+        if name in names or name in namespace or name in ('buffer', 'addr'):
+            name = '{}_{}'.format(name, i)
+        names.append(name)
+        if allowed is None:
+            tests.append('{0!r} <= {1} < {2!r}'.format(lo, name, hi))
+        else:
+            namespace['allowed_{}'.format(i)] = allowed
+            tests.append('{0} in allowed_{1}'.format(name, i))
+    params = ''.join(', ' + name for name in names)
+    args = '({},)'.format(', '.join(names)) if names else '()'
+
+    source = ('def pack_into(buffer, addr{params}):\n'
+              '    if not ({tests}):\n'
+              '        command.check({args})\n'
+              '    try:\n'
+              '        struct_pack_into(buffer, 0, addr, opcode{params})\n'
+              '    except StructError:\n'
+              '        command._pack_coerced(buffer, addr, {args})\n'
+              .format(params=params, args=args,
+                      tests=' and '.join(tests) or 'True'))
+    exec(source, namespace)
+
+    packer = namespace['pack_into']
+    packer.__qualname__ = '{}.pack_into'.format(command.name)
+    packer.__doc__ = 'Check parameters and write the frame into buffer'
+
+    return packer
+
+
+# =============================================================================
+# Command description
+# =============================================================================
+
+
+class Command(object):
+    """
+    Declarative description of a Sixpack2 command: opcode, parameter fields
+    (name and struct format character) and, for requests, the fields of the
+    reply. The frame layouts are compiled into struct.Struct objects once.
+
+    Commands writing a setting give the number of leading parameters
+    identifying what is set (keys, e.g. 1 for the motor number), the
+    controller keeps the last written values under that key.
+
+    Requests which can be repeated without side effects are idempotent
+    (get_unit_info is not: it clears the reset flag).
+
+    A reply starts with the response address and the command number of
+    its request, followed by the echoed motor or channel number for some
+    requests (see reply_prefix).
+
+    pack_into(buffer, addr, *params) checks the parameters and writes the
+    frame into buffer; it is compiled per command (see _build_packer).
+    """
+
+    __slots__ = ('name', 'opcode', 'fields', 'reply_fields', 'keys',
+                 'idempotent', '_struct', '_limits', 'reply', '_reply_type',
+                 '_echo', 'pack_into')
+
+    def __init__(self, name, opcode, fields=(), reply_fields=None,
+                 keys=None, idempotent=False):
+
+        self.name = name
+        self.opcode = opcode
+        self.fields = tuple(fields)
+        self.reply_fields = reply_fields
+        self.keys = keys
+        self.idempotent = idempotent
+
+        self._struct = _build_struct(self.fields)
+        self._limits = _build_limits(self.fields)
+        self.pack_into = _build_packer(self)
+
+        if reply_fields is None:
+            self.reply = None
+            self._reply_type = None
+            self._echo = None
+        else:
+            self.reply = _build_struct(reply_fields)
+            self._reply_type = _reply_type(self, reply_fields)
+            self._echo = _build_echo(self.fields, reply_fields)
+
+    def __repr__(self):
+        return 'Command({0!r}, 0x{1:02X})'.format(self.name, self.opcode)
+
+    @property
+    def is_request(self):
+        return self.reply is not None
+
+    @property
+    def is_setting(self):
+        return self.keys is not None
+
+    def key(self, params):
+        """
+        Key under which the parameters of a setting are recorded
+        """
+
+        return (self.opcode,) + tuple(params[:self.keys])
+
+    def check(self, params):
+        """
+        Check number and ranges of the given parameters
+        """
+
+        if len(params) != len(self._limits):
+            raise TypeError('{0} takes {1} parameters ({2} given)'
+                            .format(self.name, len(self._limits),
+                                    len(params)))
+
+        for value, (name, lo, hi, allowed) in zip(params, self._limits):
+            if allowed is None:
+                if not lo <= value < hi:
+                    raise ValueError('parameter {} not in range ({}, {})'
+                                     .format(name, lo, hi))
+            elif value not in allowed:
+                raise ValueError('parameter {} not in allowed values {}'
+                                 .format(name, sorted(allowed)))
+
+        return None
+
+    def _pack_coerced(self, buffer, addr, params):
+        """
+        Write a frame whose parameters struct does not take: other real
+        numbers (float, numpy scalars) are truncated to int like the
+        legacy encoder did
+        """
+
+        self.check(params)
+        if not all(isinstance(value, Real) for value in params):
+            raise TypeError('cannot encode parameters {0} for {1}'
+                            .format(params, self.name))
+        self._struct.pack_into(buffer, 0, addr, self.opcode,
+                               *[int(value) for value in params])
+
+        return None
+
+    def pack(self, addr, *params):
+        """
+        Check parameters and return the frame as bytes
+        """
+
+        buffer = bytearray(FRAME_LENGTH)
+        self.pack_into(buffer, addr, *params)
+
+        return bytes(buffer)
+
+    def unpack(self, frame):
+        """
+        Decode a command frame into (addr, opcode, *params)
+        """
+
+        return self._struct.unpack_from(frame)
+
+    def reply_prefix(self, frame):
+        """
+        Leading bytes of the reply to the given request frame
+        """
+
+        return bytes(frame[i] for i in self._echo)
+
+    def unpack_reply(self, frame, offset=0):
+        """
+        Decode a reply frame (any buffer, e.g. a memoryview of the receive
+        buffer) into a Reply (addr, cmd, *reply_params)
+        """
+
+        return self._reply_type(self.reply.unpack_from(frame, offset))
+
+
+# =============================================================================
+# Replies
+# =============================================================================
+
+
+def _reply_field(name):
+
+    def get(self):
+        try:
+            return self[self._index[name]]
+        except KeyError:
+            raise AttributeError('{0} reply has no {1}'
+                                 .format(self.command.name, name))
+
+    return property(get, doc='{} field of the reply'.format(name))
+
+
+class Reply(tuple):
+    """
+    Decoded reply: a plain tuple (addr, cmd, *reply_params) with typed
+    accessors for the fields. Every request has its own subclass (see
+    Command.unpack_reply); the accessors only index into the tuple.
+    """
+
+    __slots__ = ()
+
+    command = None
+    _index = {}
+
+    addr = _reply_field('addr')
+    motno = _reply_field('motno')
+    position = _reply_field('posact')
+    velocity = _reply_field('velact')
+    stop_status = _reply_field('stop_status')
+    channel = _reply_field('channelno')
+    analogue_value = _reply_field('analogue_value')
+    firmware = _reply_field('firmware')
+    reset_flag = _reply_field('reset_flag')
+    temperature = _reply_field('pack_temp')
+    serial = _reply_field('serial')
+
+    @property
+    def action(self):
+        """
+        Action code of the (first) motor in the reply
+        """
+
+        try:
+            return self[self._index['action']]
+        except KeyError:
+            raise AttributeError('{0} reply has no action'
+                                 .format(self.command.name))
+
+    @property
+    def action_name(self):
+        return _decode_action(self.action)
+
+    def __repr__(self):
+        return '{0}Reply{1}'.format(self.command.name,
+                                    tuple.__repr__(self))
+
+    def __reduce__(self):
+        return _rebuild_reply, (self.command.opcode, tuple(self))
+
+
+def _rebuild_reply(opcode, values):
+    return COMMANDS[opcode]._reply_type(values)
+
+
+def _reply_type(command, reply_fields):
+    """
+    Reply subclass of a request, indexing its fields by name
+    (the first occurrence of repeated names)
+    """
+
+    index = {}
+    for i, (name, _) in enumerate([('addr', 'B'), ('cmd', 'B')]
+                                  + list(reply_fields)):
+        index.setdefault(name, i)
+
+    return type(command.name + '_reply', (Reply,),
+                {'__slots__': (), 'command': command, '_index': index})
+
+
+# =============================================================================
+# Receive buffer
+# =============================================================================
+
+
+class FrameBuffer(object):
+    """
+    Receive buffer for the byte stream from the PACK. Replies are looked
+    up by their leading bytes (see Command.reply_prefix) and decoded in
+    place; whatever precedes them (late replies of earlier requests, line
+    noise, torn frames) is discarded and counted in discarded. So a
+    disturbance costs the reply it hits, not the following ones.
+    """
+
+    def __init__(self, capacity=64 * FRAME_LENGTH):
+
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """
+        Moves the buffered bytes to the front if fewer than size bytes are
+        free behind them, returns the number of free bytes
+        """
+
+        free = len(self._buf) - self._end
+        if free < size and self._start:
+            pending = bytes(self._view[self._start:self._end])
+            self._start, self._end = 0, len(pending)
+            self._buf[:self._end] = pending
+            free = len(self._buf) - self._end
+
+        return free
+
+    def fill(self, ser, size):
+        """
+        Reads size bytes (fewer if the timeout of ser expires), or all
+        bytes already waiting if there are more; returns the number read
+        """
+
+        size = max(size, ser.in_waiting)
+        size = min(size, self._reserve(size))
+        received = ser.readinto(self._view[self._end:self._end + size])
+        self._end += received
+
+        return received
+
+    def feed(self, data):
+        """
+        Appends received bytes, dropping the oldest ones on overflow
+        """
+
+        free = self._reserve(len(data))
+        if free < len(data):
+            overflow = min(len(data) - free, len(self))
+            self.discarded += overflow
+            self._start += overflow
+            free = self._reserve(len(data))
+            if free < len(data):
+                self.discarded += len(data) - free
+                data = data[len(data) - free:]
+
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+        return None
+
+    def take(self, command, prefix):
+        """
+        Decodes and removes the first reply to command starting with
+        prefix, discarding the bytes before it. Returns None while no
+        complete reply has been received.
+        """
+
+        buf, start, end = self._buf, self._start, self._end
+        i = buf.find(prefix, start, end)
+        if i < 0:
+            # the tail may be the beginning of the reply
+            i = max(start, end - len(prefix) + 1)
+        self.discarded += i - start
+        self._start = i
+
+        if end - i < FRAME_LENGTH:
+            if i == end:
+                self._start = self._end = 0
+            return None
+
+        self._start = i + FRAME_LENGTH
+
+        return command.unpack_reply(buf, i)
+
+    def discard(self, ser=None):
+        """
+        Drops the buffered bytes and those waiting at ser (bytes no
+        request is waiting for), returns their number
+        """
+
+        dropped = len(self)
+        self._start = self._end = 0
+
+        if ser is not None:
+            waiting = ser.in_waiting
+            while waiting:
+                received = ser.readinto(
+                    self._view[:min(waiting, len(self._buf))])
+                if not received:
+                    break
+                dropped += received
+                waiting = ser.in_waiting
+
+        self.discarded += dropped
+
+        return dropped
+
+
+# =============================================================================
+# Command table
+# =============================================================================
+
+_MOT = ('motno', 'B')
+_MASK = ('mask', 'B')
+_RESP = ('resp_addr', 'B')
+
+# setting motor parameters
+SET_PEAK_CURRENT = Command('set_peak_current', 0x10,
+                           [_MOT, ('peak_current', 'B')], keys=1)
+CONTROL_CURRENT = Command('control_current', 0x11,
+                          [_MOT] + 4 * [('current_code', 'B')] + [('T0', 'H')],
+                          keys=1)
+SET_VELOCITY = Command('set_velocity', 0x12, [('clkdiv', 'B')], keys=0)
+SET_STARTVEL = Command('set_startvel', 0x13,
+                       [_MOT, ('vmin', 'H'), ('vstart', 'H'), ('divi', 'B')],
+                       keys=1)
+SET_VELACC = Command('set_velacc', 0x14, [_MOT, ('amax', 'H'), ('vmax', 'H')],
+                     keys=1)
+SET_MOTPARAMS = Command('set_motparams', 0x15,
+                        [_MOT, ('poslimit', 'I'), ('mottype', 'B'),
+                         ('motparams', 'B')], keys=1)
+REF_SEARCH_PARAMS = Command('ref_search_params', 0x16,
+                            [_MOT, ('vrefmax', 'H'), ('debounce', 'H'),
+                             ('stop_after', 'B')], keys=1)
+WRITE_MOTOR_CHAR_TABLE = Command('write_motor_char_table', 0x17,
+                                 [('table_pointer', 'B')]
+                                 + 4 * [('table_entry', 'B')], keys=1)
+SET_NULLOFFSET_NULLRANGE = Command('set_nulloffset_nullrange', 0x18,
+                                   [_MOT, ('nulloffset', 'i'),
+                                    ('nullrange', 'H')], keys=1)
+SET_PI_PARAMETER = Command('set_PI_parameter', 0x19,
+                           [_MOT, ('propdiv', 'B'), ('intdiv', 'H'),
+                            ('intclip', 'H'), ('intinpclip', 'B')],
+                           keys=1)
+
+# moving the motors
+GET_POS = Command('get_pos', 0x20, [_MOT, _RESP],
+                  [('motno', 'B'), ('posact', 'i'), ('action', 'B'),
+                   ('stop_status', 'B')], idempotent=True)
+GET_VEL = Command('get_vel', 0x21, [_MOT, _RESP],
+                  [('motno', 'B'), ('velact', 'h'), ('action', 'B')],
+                  idempotent=True)
+START_REF_SEARCH = Command('start_ref_search', 0x22, [_MOT])
+START_RAMP = Command('start_ramp', 0x23, [_MOT, ('targetpos', 'i')])
+ACTIVATE_PI_ON_TARGETPOS = Command('activate_PI_on_targetpos', 0x24,
+                                   [_MOT, ('targetpos', 'i')])
+ROTATE = Command('rotate', 0x25, [_MOT, ('rotvel', 'h')])
+SET_TARGETPOS = Command('set_targetpos', 0x26, [_MOT, ('targetpos', 'i')])
+SET_ACTUALPOS = Command('set_actualpos', 0x27, [_MOT, ('posact', 'i')])
+QUERY_ALL = Command('query_all', 0x28, [_RESP, _MASK],
+                    6 * [('action', 'B')], idempotent=True)
+START_PARALLEL_RAMP = Command('start_parallel_ramp', 0x29, [_MASK])
+STOP_MOTORS = Command('stop_motors', 0x2A, [_MASK])
+ABORT_REF_SEARCH = Command('abort_ref_search', 0x2B, [_MOT])
+
+# additional inputs/outputs
+READ_INPUT_CHANNELS = Command('read_input_channels', 0x30,
+                              [('channelno', 'B'), _RESP],
+                              [('channelno', 'B'), ('analogue_value', 'H'),
+                               ('ref_input', 'B'), ('all_ref_inputs', 'B'),
+                               ('logic_state_TTLIO1', 'B')], idempotent=True)
+SET_LIMITS_STOP_FUNC = Command('set_limits_stop_func', 0x31,
+                               [('channelno', 'B'),
+                                ('stop_func_limits', 'H'),
+                                ('stop_func_limits', 'H')], keys=1)
+SET_ADD_OUTPUTS = Command('set_add_outputs', 0x32,
+                          4 * [('logic_state', 'B')], keys=0)
+SET_READY_OUTPUT_FUNC = Command('set_ready_output_func', 0x33,
+                                [_MASK, _MASK], keys=0)
+
+# other settings
+ADJUST_BAUDRATE = Command('adjust_baudrate', 0x40,
+                          [('baudratedivisor', 'H'),
+                           ('transmitter_delay', 'H')])
+SET_ABORT_TIMEOUT = Command('set_abort_timeout', 0x41,
+                            [('abort_timeout', 'H')], keys=0)
+CHANGE_UNIT_ADDRESS = Command('change_unit_address', 0x42,
+                              [('unit_address', 'B')])
+GET_UNIT_INFO = Command('get_unit_info', 0x43, [_RESP],
+                        [('firmware', 'B'), ('reset_flag', 'B'),
+                         ('pack_temp', 'b'), ('serial', 'I')])
+
+# multi-dimensional movement
+START_MULTI_MOVEMENT = Command('start_multi_movement', 0x50, [_MASK])
+
+COMPLETE_HWRESET = Command('complete_hwreset', 0xCC)
+
+
+COMMANDS = {c.opcode: c for c in (
+    SET_PEAK_CURRENT, CONTROL_CURRENT, SET_VELOCITY, SET_STARTVEL,
+    SET_VELACC, SET_MOTPARAMS, REF_SEARCH_PARAMS, WRITE_MOTOR_CHAR_TABLE,
+    SET_NULLOFFSET_NULLRANGE, SET_PI_PARAMETER,
+    GET_POS, GET_VEL, START_REF_SEARCH, START_RAMP, ACTIVATE_PI_ON_TARGETPOS,
+    ROTATE, SET_TARGETPOS, SET_ACTUALPOS, QUERY_ALL, START_PARALLEL_RAMP,
+    STOP_MOTORS, ABORT_REF_SEARCH,
+    READ_INPUT_CHANNELS, SET_LIMITS_STOP_FUNC, SET_ADD_OUTPUTS,
+    SET_READY_OUTPUT_FUNC,
+    ADJUST_BAUDRATE, SET_ABORT_TIMEOUT, CHANGE_UNIT_ADDRESS, GET_UNIT_INFO,
+    START_MULTI_MOVEMENT, COMPLETE_HWRESET)}
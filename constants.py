@@ -71,10 +71,98 @@ PARAMETER_RANGES = {'peak_current': R_8u,
                     'baudratedivisor': R_16u1,
                     'abort_timeout': (2, 2**16),
                     'unit_address': R_8u,
-                    'debounce': R_16u
+                    'debounce': R_16u,
+                    'motno': (0, 6),
+                    'resp_addr': R_8u,
+                    'mask': (0, 64),
+                    'current_code': (0, 9),
+                    'mottype': R_8u,
+                    'motparams': R_8u,
+                    'stop_after': R_8u,
+                    'logic_state': (0, 2)
                     }
 
 
+# =============================================================================
+# Serial line: baud rate of the PACK = BAUDRATE_CLOCK / baudratedivisor,
+# transmitter_delay is given in units of TRANSMITTER_DELAY_UNIT seconds.
+# A frame takes 9 * BITS_PER_BYTE bit times on the line.
+# =============================================================================
+
+BAUDRATE_CLOCK = 1250000
+TRANSMITTER_DELAY_UNIT = 1e-3
+DEFAULT_TRANSMITTER_DELAY = 3
+BITS_PER_BYTE = 10
+
+# baud rates supported by the PACK (baud: divisor, from the vendor software)
+BAUDRATE_DIVISORS = {300: 4166, 1200: 1041, 2400: 520, 4800: 260,
+                     9600: 130, 19200: 65, 38400: 32, 57600: 21}
+
+DEFAULT_BAUDRATE = 19200
+
+# reply timeout (s, on top of the frame times) and number of get_unit_info
+# probes which have to succeed before a baud rate or delay is accepted
+PROBE_TIMEOUT = 0.1
+PROBE_ATTEMPTS = 3
+
+# adaptive reply timeouts (s, see rtt.py): timeout before the first round
+# trip of a command was measured (on top of the frame times) and bounds of
+# the learned timeouts; number of repetitions of idempotent requests whose
+# reply is missing or garbled
+RTO_INITIAL = 0.25
+RTO_MIN = 0.05
+RTO_MAX = 2.0
+REPLY_RETRIES = 2
+
+# discovery (see Sixpack2Controller.discover): reply timeout (s, on top of
+# the frame times) of the probes and number of motor channels of a PACK
+DISCOVERY_TIMEOUT = 0.05
+MAX_MOTORS = 6
+
+# time (s) before the predicted end of a trajectory segment at which its
+# end is awaited with a delayed query_all (see trajectory.py)
+TRAJECTORY_LEAD = 0.02
+
+# share of the line used for telemetry by the bus scheduler (see
+# scheduler.py), the rest is kept free for commands
+TELEMETRY_SHARE = 0.8
+
+# jog channels (see jog.py): share of the line's frame rate used for
+# rotate frames and time (s) without input after which the motor is stopped
+JOG_BUS_SHARE = 0.25
+JOG_TIMEOUT = 0.5
+
+# interval (s) at which a long wait for a delayed reply checks for frames
+# to be sent meanwhile (emergency stops, see worker.py)
+PREEMPT_INTERVAL = 0.01
+
+# time (s) a client of sixpack-daemon waits for an answer on top of the
+# reply timeouts of its frames (see Sixpack2Client)
+DAEMON_TIMEOUT_MARGIN = 1.0
+
+# =============================================================================
+# Ramp generator: conversion of internal units into full steps/s and
+# full steps/s^2 (TMC428 style ramp generator running at PACK_CLOCK)
+# =============================================================================
+
+PACK_CLOCK = 16e6
+
+# waiting for motors: timeout = factor * predicted move time + margin
+WAIT_TIMEOUT_FACTOR = 1.5
+WAIT_TIMEOUT_MARGIN = 0.5
+DEFAULT_WAIT_TIMEOUT = 60.0
+
+
+def _velocity_hz(v, clkdiv):
+
+    return PACK_CLOCK * v / (2**clkdiv * 2048 * 32)
+
+
+def _acceleration_hz2(a, clkdiv, divi):
+
+    return PACK_CLOCK**2 * a / 2**(clkdiv + divi + 29)
+
+
 # =============================================================================
 # Check parameter range, encode and decode parameter
 # =============================================================================
@@ -137,30 +225,89 @@ def _decode_param(param, signed=True):
     return value
 
 
+def _parse_mask(mask):
+    """
+    Convert a motor mask given as binary string (bit 0 = motor 0 is the
+    rightmost character) or as integer into an integer.
+    """
+
+    if isinstance(mask, str):
+        mask = int(mask, 2)
+    if not 0 <= mask < 64:
+        raise ValueError('given mask is ambiguous ({})'.format(mask))
+
+    return mask
+
+
+def _parse_addr(addr):
+    """
+    Convert a unit/response address given as hex string or integer
+    into an integer.
+    """
+
+    if isinstance(addr, str):
+        addr = int(addr, 16)
+    if not 0 <= addr < 256:
+        raise ValueError('address {} not in range (0, 256)'.format(addr))
+
+    return addr
+
+
+def _check_baudrate(baudrate):
+    """
+    Raise ValueError if the PACK does not support baudrate
+    """
+
+    if baudrate not in BAUDRATE_DIVISORS:
+        raise ValueError('baud rate {0} not supported by the PACK, use'
+                         ' one of {1}'
+                         .format(baudrate, sorted(BAUDRATE_DIVISORS)))
+
+    return None
+
+
+def _decode_action(act):
+    """
+    Decode action code of a reply into human readable string
+    """
+
+    if act in ACTION_DICT:
+        return ACTION_DICT[act]
+    elif 20 <= act <= 29:
+        return 'reference switch search'
+    raise ValueError('reply action ({0}) seems to be incorrect and was not'
+                     ' found in ACTION_DICT'.format(act))
+
+
 def _encode_mask(mask):
 
-    try:
-        maskint = int(mask, 2)
-        if maskint >= 64:
-            raise ValueError('given mask is ambiguous ({})'.format(mask))
-        return '{:02X}'.format(maskint)
-    except TypeError as error:
-        print('the given mask has to be of type string (error: {})'
-              .format(repr(error)))
+    if not isinstance(mask, str):
+        raise TypeError('the given mask has to be of type string ({!r})'
+                        .format(mask))
+    maskint = int(mask, 2)
+    if maskint >= 64:
+        raise ValueError('given mask is ambiguous ({})'.format(mask))
 
+    return '{:02X}'.format(maskint)
 
-def _encode_debounce(debounce):
+
+def _debounce_bits(debounce):
+    """
+    Convert reference switch de-bouncing time into the bit pattern
+    expected by the PACK
+    """
 
     debounce = int(debounce)
     if debounce not in range(0, 32, 2):
-        raise ValueError('Error: reference switch de-bouncing time is',
-                         'not in range ( 0, 32, 2)')
+        raise ValueError('Error: reference switch de-bouncing time is'
+                         ' not in range ( 0, 32, 2)')
+
+    return (1 << (debounce // 2 + 1)) - 1
 
-    i = int(debounce/2 + 1)
-    debounce = 0
-    for j in range(i):
-        debounce += 2**j
 
+def _encode_debounce(debounce):
+
+    debounce = _debounce_bits(debounce)
     debounce = _encode_param(debounce, 'debounce', num_bytes=2)
 
     return debounce
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+from time import monotonic
+from threading import Thread, Condition
+from asyncio import iscoroutinefunction
+from codec import ROTATE, FRAME_LENGTH
+from constants import (BITS_PER_BYTE, DEFAULT_BAUDRATE, JOG_BUS_SHARE,
+                       JOG_TIMEOUT)
+
+
+class JogChannel(Thread):
+    """
+    Streams rotation velocities of a motor (jog pendant, joystick) with
+    latest value wins: set() only stores the velocity, the channel's
+    thread sends the newest one with rotate() at most as often as share
+    (0...1) of the line's frame rate allows. Values set meanwhile replace
+    each other instead of queueing up, so the motor follows the input
+    without lag at any input rate.
+
+    If set() is not called for timeout seconds (the input stopped
+    sending), the motor is stopped with stop_motors; the next set()
+    starts it again. close() stops the motor and ends the channel.
+
+        with ctrl[0].jog() as jog:
+            for rotvel in pendant:
+                jog.set(rotvel)
+    """
+
+    def __init__(self, motor, share=JOG_BUS_SHARE, timeout=JOG_TIMEOUT):
+
+        Thread.__init__(self, name='Sixpack2Jog{}'.format(motor._motno),
+                        daemon=True)
+
+        if iscoroutinefunction(motor._ctrl._flush):
+            raise TypeError('JogChannel needs a blocking controller')
+        if not 0 < share <= 1:
+            raise ValueError('bus share has to be in (0, 1] ({})'
+                             .format(share))
+        if timeout <= 0:
+            raise ValueError('timeout has to be positive ({})'
+                             .format(timeout))
+
+        self.motor = motor
+        self.share = share
+        self.timeout = timeout
+
+        self._cond = Condition()
+        # newest velocity not sent yet, time of the last set()
+        self._value = None
+        self._updated = monotonic()
+        self._closed = False
+
+        self.sent = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def interval(self):
+        """
+        Minimum time (s) between two rotate frames
+        """
+
+        frame_time = self.motor._ctrl._frame_time()
+        if not frame_time:
+            frame_time = FRAME_LENGTH * BITS_PER_BYTE / DEFAULT_BAUDRATE
+
+        return frame_time / self.share
+
+    def set(self, rotvel):
+        """
+        Sets the rotation velocity (internal units, see rotate); returns at
+        once. Raises RuntimeError if the channel is closed.
+        """
+
+        ROTATE.check((self.motor._motno, rotvel))
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('jog channel of motor {} is closed ({!r})'
+                                   .format(self.motor._motno, self.error))
+            if self._value is not None:
+                self.coalesced += 1
+            self._value = rotvel
+            self._updated = monotonic()
+            self._cond.notify()
+
+        return None
+
+    def close(self):
+        """
+        Stops the motor and ends the channel
+        """
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+        return None
+
+    def _stop_motor(self):
+
+        self.motor._ctrl.stop_motors(1 << self.motor._motno)
+
+        return None
+
+    def _next(self, last, slot):
+        """
+        Waits for a velocity to send (the newest one, differing from last,
+        not before slot); returns None if the channel was closed, False
+        if the input timed out
+        """
+
+        with self._cond:
+            while not self._closed:
+                now = monotonic()
+                if self._value == last:
+                    self._value = None
+                idle = self._updated + self.timeout - now
+                if last is not None and idle <= 0:
+                    return False
+                if self._value is not None and now >= slot:
+                    value, self._value = self._value, None
+                    return value
+                wait = idle if last is not None else None
+                if self._value is not None:
+                    wait = slot - now if wait is None else min(wait,
+                                                               slot - now)
+                self._cond.wait(wait)
+
+        return None
+
+    def run(self):
+
+        # last velocity sent, None while the motor is stopped
+        last = None
+        slot = 0.0
+        try:
+            while True:
+                value = self._next(last, slot)
+                if value is None:
+                    break
+                if value is False:
+                    self.timeouts += 1
+                    self._stop_motor()
+                    last = None
+                    continue
+                self.motor.rotate(value)
+                self.sent += 1
+                last = value
+                slot = monotonic() + self.interval
+        except Exception as error:
+            self.error = error
+
+        with self._cond:
+            self._closed = True
+        try:
+            self._stop_motor()
+        except Exception as error:
+            if self.error is None:
+                self.error = error
+
+        return None
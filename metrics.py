@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+from time import monotonic
+from bisect import bisect_left
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from codec import COMMANDS, FRAME_LENGTH
+
+# upper bounds (s) of the round trip time histogram buckets
+RTT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+               2.0, 5.0)
+
+
+# =============================================================================
+# Counters of a single opcode
+# =============================================================================
+
+
+class OpcodeMetrics(object):
+    """
+    Frames, bytes, round trip times and errors of one opcode
+    """
+
+    __slots__ = ('frames', 'bytes_sent', 'bytes_received', 'replies',
+                 'rtt_sum', 'rtt_buckets', 'timeouts', 'mismatches',
+                 'retries', 'suppressed', 'discarded')
+
+    def __init__(self, buckets):
+
+        self.frames = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.replies = 0
+        self.rtt_sum = 0.0
+        self.rtt_buckets = [0] * (len(buckets) + 1)
+        self.timeouts = 0
+        self.mismatches = 0
+        self.retries = 0
+        self.suppressed = 0
+        self.discarded = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# =============================================================================
+# Metrics of a controller
+# =============================================================================
+
+
+class Metrics(object):
+    """
+    Per-opcode instrumentation of the frames exchanged with the PACK,
+    enabled with Sixpack2Controller.enable_metrics().
+
+    before hooks are called as hook(frame) before a frame is written, after
+    hooks as hook(frame, reply, rtt, error) once its reply was received (or
+    failed with error); for commands reply and rtt are None. frame is only
+    valid during the call.
+    """
+
+    def __init__(self, buckets=RTT_BUCKETS, before=(), after=()):
+
+        self.buckets = tuple(buckets)
+        self.opcodes = {}
+        self.before_hooks = list(before)
+        self.after_hooks = list(after)
+        self.started = monotonic()
+
+    def _opcode(self, opcode):
+
+        metrics = self.opcodes.get(opcode)
+        if metrics is None:
+            metrics = self.opcodes[opcode] = OpcodeMetrics(self.buckets)
+
+        return metrics
+
+    # ------------------------------------------------------------------------
+    # recording, called by the controller
+    # ------------------------------------------------------------------------
+
+    def before(self, frame):
+        """
+        Counts a frame about to be written, returns its start time
+        """
+
+        metrics = self._opcode(frame[1])
+        metrics.frames += 1
+        metrics.bytes_sent += len(frame)
+
+        for hook in self.before_hooks:
+            hook(frame)
+
+        return monotonic()
+
+    def after(self, frame, reply, start, error=None):
+        """
+        Records the outcome of a frame written at start
+        """
+
+        rtt = None
+        metrics = self._opcode(frame[1])
+        if error is not None:
+            if isinstance(error, TimeoutError):
+                metrics.timeouts += 1
+            elif isinstance(error, UserWarning):
+                metrics.mismatches += 1
+        elif reply is not None:
+            rtt = monotonic() - start
+            metrics.replies += 1
+            metrics.bytes_received += FRAME_LENGTH
+            metrics.rtt_sum += rtt
+            metrics.rtt_buckets[bisect_left(self.buckets, rtt)] += 1
+
+        for hook in self.after_hooks:
+            hook(frame, reply, rtt, error)
+
+        return None
+
+    def retry(self, opcode):
+        self._opcode(opcode).retries += 1
+
+    def suppress(self, opcode):
+        self._opcode(opcode).suppressed += 1
+
+    def discard(self, opcode, count):
+        self._opcode(opcode).discarded += count
+
+    # ------------------------------------------------------------------------
+    # export
+    # ------------------------------------------------------------------------
+
+    def snapshot(self):
+        """
+        Returns the counters per command name (plain dicts), rtt_buckets
+        counting the round trips up to each bound of buckets (last: more)
+        """
+
+        snapshot = {}
+        for opcode, metrics in sorted(list(self.opcodes.items())):
+            command = COMMANDS.get(opcode)
+            name = command.name if command else '0x{:02X}'.format(opcode)
+            snapshot[name] = metrics.as_dict()
+
+        return snapshot
+
+    def reset(self):
+
+        self.opcodes = {}
+        self.started = monotonic()
+
+        return None
+
+
+# =============================================================================
+# Prometheus text format
+# =============================================================================
+
+_COUNTERS = [('frames', 'frames_total', 'Frames sent to the PACK'),
+             ('bytes_sent', 'bytes_sent_total', 'Bytes sent to the PACK'),
+             ('bytes_received', 'bytes_received_total',
+              'Bytes received from the PACK'),
+             ('timeouts', 'timeouts_total', 'Replies not received in time'),
+             ('mismatches', 'mismatches_total',
+              'Replies with unexpected command number'),
+             ('retries', 'retries_total', 'Repeated requests'),
+             ('suppressed', 'suppressed_total',
+              'Settings not sent because the PACK already holds them'),
+             ('discarded', 'discarded_bytes_total',
+              'Received bytes not belonging to a reply')]
+
+
+def prometheus_text(metrics, prefix='sixpack2'):
+    """
+    Renders the metrics in the Prometheus text exposition format
+    """
+
+    snapshot = metrics.snapshot()
+    lines = []
+
+    for field, name, text in _COUNTERS:
+        lines.append('# HELP {0}_{1} {2}'.format(prefix, name, text))
+        lines.append('# TYPE {0}_{1} counter'.format(prefix, name))
+        for command, values in snapshot.items():
+            lines.append('{0}_{1}{{command="{2}"}} {3}'
+                         .format(prefix, name, command, values[field]))
+
+    name = prefix + '_rtt_seconds'
+    lines.append('# HELP {0} Round trip time of requests'.format(name))
+    lines.append('# TYPE {0} histogram'.format(name))
+    bounds = [repr(bound) for bound in metrics.buckets] + ['+Inf']
+    for command, values in snapshot.items():
+        if not values['replies']:
+            continue
+        total = 0
+        for bound, count in zip(bounds, values['rtt_buckets']):
+            total += count
+            lines.append('{0}_bucket{{command="{1}",le="{2}"}} {3}'
+                         .format(name, command, bound, total))
+        lines.append('{0}_sum{{command="{1}"}} {2!r}'
+                     .format(name, command, values['rtt_sum']))
+        lines.append('{0}_count{{command="{1}"}} {2}'
+                     .format(name, command, values['replies']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_http_exporter(ctrl, port=9464, addr=''):
+    """
+    Serves the metrics of the controller for Prometheus at
+    http://addr:port/metrics from a daemon thread. Returns the server,
+    stop it with server.shutdown().
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            metrics = ctrl._metrics
+            if self.path.split('?')[0] != '/metrics' or metrics is None:
+                self.send_error(404)
+                return
+            body = prometheus_text(metrics).encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((addr, port), Handler)
+    Thread(target=server.serve_forever, name='Sixpack2MetricsExporter',
+           daemon=True).start()
+
+    return server
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Model of the ramp generator of the PACK: predicts duration, position and
+velocity of a ramp from the parameters written to the PACK, so that the
+position of a moving motor can be estimated between get_pos samples.
+"""
+
+from constants import _velocity_hz, _acceleration_hz2
+
+
+# =============================================================================
+# Ramp parameters
+# =============================================================================
+
+
+def ramp_params(vstart, vmax, amax, clkdiv, divi):
+    """
+    Converts the ramp settings of a motor (internal units) into start
+    velocity, maximum velocity (steps/s) and acceleration (steps/s^2)
+    """
+
+    v0 = _velocity_hz(vstart, clkdiv)
+    v1 = _velocity_hz(max(vmax, vstart), clkdiv)
+    a = _acceleration_hz2(amax, clkdiv, divi)
+
+    return v0, v1, a
+
+
+# =============================================================================
+# Trapezoidal ramp
+# =============================================================================
+
+
+class Ramp(object):
+    """
+    Move from startpos to targetpos beginning at start (monotonic time):
+    jumps to v0, accelerates with a up to v1 (or less, triangular profile),
+    cruises and decelerates so that it arrives at v0, as the PACK does.
+    A ramp with startpos == targetpos describes a motor at rest.
+    """
+
+    __slots__ = ('startpos', 'targetpos', 'start', 'v0', 'vpeak', 'a',
+                 't_acc', 't_cruise', 'duration')
+
+    def __init__(self, startpos, targetpos, start, v0=0.0, v1=0.0, a=0.0):
+
+        self.startpos = startpos
+        self.targetpos = targetpos
+        self.start = start
+        self.v0 = v0
+        self.a = a
+
+        distance = abs(targetpos - startpos)
+        if distance == 0:
+            self.vpeak = v0
+            self.t_acc = self.t_cruise = 0.0
+        elif v1 <= 0:
+            raise ValueError('ramp with maximum velocity {}'.format(v1))
+        elif a <= 0 or v1 == v0:
+            self.vpeak = v1
+            self.t_acc = 0.0
+            self.t_cruise = distance / v1
+        elif (v1**2 - v0**2) / a >= distance:
+            # triangular profile, v1 is not reached
+            self.vpeak = (v0**2 + a * distance)**0.5
+            self.t_acc = (self.vpeak - v0) / a
+            self.t_cruise = 0.0
+        else:
+            self.vpeak = v1
+            self.t_acc = (v1 - v0) / a
+            self.t_cruise = (distance - (v1**2 - v0**2) / a) / v1
+        self.duration = 2 * self.t_acc + self.t_cruise
+
+    @classmethod
+    def at_rest(cls, position, when):
+        """
+        Motor standing at position since when
+        """
+
+        return cls(position, position, when)
+
+    @property
+    def distance(self):
+        return abs(self.targetpos - self.startpos)
+
+    @property
+    def direction(self):
+        return 1 if self.targetpos >= self.startpos else -1
+
+    @property
+    def end(self):
+        """
+        Time (monotonic) at which the motor arrives at targetpos
+        """
+
+        return self.start + self.duration
+
+    def _travelled(self, t):
+        """
+        Distance covered and speed t seconds after the start
+        """
+
+        if t <= 0:
+            return 0.0, 0.0
+        if t >= self.duration:
+            return float(self.distance), 0.0
+
+        v0, vpeak, a, t_acc = self.v0, self.vpeak, self.a, self.t_acc
+        if t < t_acc:
+            return v0 * t + a * t * t / 2, v0 + a * t
+
+        d_acc = (v0 + vpeak) / 2 * t_acc
+        t -= t_acc
+        if t < self.t_cruise:
+            return d_acc + vpeak * t, vpeak
+
+        # deceleration is the acceleration backwards in time
+        t = self.duration - t_acc - t
+        return self.distance - (v0 * t + a * t * t / 2), v0 + a * t
+
+    def _elapsed(self, travelled):
+        """
+        Time after the start at which the given distance is covered
+        (inverse of _travelled)
+        """
+
+        if travelled <= 0:
+            return 0.0
+        if travelled >= self.distance:
+            return self.duration
+
+        v0, vpeak, a, t_acc = self.v0, self.vpeak, self.a, self.t_acc
+        d_acc = (v0 + vpeak) / 2 * t_acc
+        if travelled < d_acc:
+            return ((v0**2 + 2 * a * travelled)**0.5 - v0) / a
+        if travelled < d_acc + vpeak * self.t_cruise:
+            return t_acc + (travelled - d_acc) / vpeak
+
+        left = self.distance - travelled
+        return self.duration - ((v0**2 + 2 * a * left)**0.5 - v0) / a
+
+    def state(self, when):
+        """
+        Position (steps) and velocity (steps/s) at time when (monotonic)
+        """
+
+        travelled, speed = self._travelled(when - self.start)
+        direction = self.direction
+
+        return (self.startpos + direction * travelled, direction * speed)
+
+    def align(self, position, when):
+        """
+        Shifts the ramp in time so that it passes position at time when
+        (correction by a sampled position)
+        """
+
+        travelled = self.direction * (position - self.startpos)
+        self.start = when - self._elapsed(travelled)
+
+        return None
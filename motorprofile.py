@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import os
+import json
+from constants import I_DICT, _debounce_bits
+from codec import *
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+
+# =============================================================================
+# Sections of a profile and the commands writing them
+# =============================================================================
+
+# controller-wide settings
+CONTROLLER_SETTINGS = {'clkdiv': SET_VELOCITY,
+                       'abort_timeout': SET_ABORT_TIMEOUT}
+
+# settings of a single motor; the values are given by the field names of the
+# command (see codec.py), single-valued settings also as plain numbers
+MOTOR_SETTINGS = {'peak_current': SET_PEAK_CURRENT,
+                  'current': CONTROL_CURRENT,
+                  'startvel': SET_STARTVEL,
+                  'velacc': SET_VELACC,
+                  'motparams': SET_MOTPARAMS,
+                  'nulloffset_nullrange': SET_NULLOFFSET_NULLRANGE,
+                  'PI_parameter': SET_PI_PARAMETER,
+                  'ref_search': REF_SEARCH_PARAMS}
+
+DEFAULTS = {'stop_after': 0}
+
+
+# =============================================================================
+# Profile
+# =============================================================================
+
+
+class Profile(object):
+    """
+    Declarative description of the settings of a PACK and its motors,
+    e.g. as TOML:
+
+        clkdiv = 5
+
+        [motors.0]
+        peak_current = 100
+        current = {T0 = 1000, levels = [0, 50, 75, 100]}
+        startvel = {vmin = 1, vstart = 10, divi = 3}
+        velacc = {amax = 100, vmax = 300}
+        ref_search = {vrefmax = 100, debounce = 4}
+
+    or the same structure as JSON. Motors are numbered like the motors of
+    the controller. current gives the current levels in percent (see
+    Sixpack2Motor.control_current), debounce the de-bouncing time in ms.
+
+    All values are checked when the profile is created, before anything
+    is sent to the PACK.
+    """
+
+    def __init__(self, settings=None, motors=None):
+
+        self.settings = dict(settings or {})
+        self.motors = {int(motno): dict(values)
+                       for motno, values in (motors or {}).items()}
+
+        self._frames = self._compile()
+
+    @classmethod
+    def from_dict(cls, data):
+
+        data = dict(data)
+        motors = data.pop('motors', {})
+        if isinstance(motors, list):
+            motors = dict(enumerate(motors))
+
+        return cls(data, motors)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a profile from a .json or .toml file
+        """
+
+        path = os.fspath(path)
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise ImportError('reading TOML profiles requires Python 3.11'
+                                  ' or later (tomllib)')
+            with open(path, 'rb') as f:
+                return cls.from_dict(tomllib.load(f))
+
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def __repr__(self):
+        return 'Profile({0} settings, motors {1})'.format(
+            len(self.settings), sorted(self.motors))
+
+    # ------------------------------------------------------------------------
+    # translation into frames
+    # ------------------------------------------------------------------------
+
+    def _compile(self):
+
+        frames = []
+
+        for name, value in self.settings.items():
+            if name not in CONTROLLER_SETTINGS:
+                raise ValueError('unknown controller setting {!r} (known: {})'
+                                 .format(name, sorted(CONTROLLER_SETTINGS)))
+            frames.append(_frame(CONTROLLER_SETTINGS[name], (), value, name))
+
+        for motno in sorted(self.motors):
+            for name, value in self.motors[motno].items():
+                if name not in MOTOR_SETTINGS:
+                    raise ValueError('unknown setting {!r} of motor {} (known:'
+                                     ' {})'.format(name, motno,
+                                                   sorted(MOTOR_SETTINGS)))
+                frames.append(_frame(MOTOR_SETTINGS[name], (motno,), value,
+                                     'motor {} {}'.format(motno, name)))
+
+        return frames
+
+    def frames(self, num_motors=None):
+        """
+        Returns the (command, params) pairs writing the profile,
+        controller settings first
+        """
+
+        if num_motors is not None and self.motors \
+                and max(self.motors) >= num_motors:
+            raise ValueError('profile configures motor {} but only {} motors'
+                             ' are initialized'
+                             .format(max(self.motors), num_motors))
+
+        return list(self._frames)
+
+
+def _frame(command, keys, value, where):
+    """
+    Translates the value of a setting into the parameters of command
+    """
+
+    fields = [name for name, _ in command.fields[len(keys):]]
+
+    if not isinstance(value, dict):
+        if len(fields) != 1:
+            raise ValueError('{} needs the values {}'.format(where, fields))
+        value = {fields[0]: value}
+    else:
+        value = dict(value)
+
+    if command is CONTROL_CURRENT:
+        levels = value.pop('levels', None)
+        if levels is None or len(levels) != 4:
+            raise ValueError('{} needs 4 current levels'.format(where))
+        for i, level in enumerate(levels):
+            if level not in I_DICT:
+                raise ValueError('current level {}% of {} not in allowed'
+                                 ' values {}'.format(level, where,
+                                                     list(I_DICT)))
+            value['current_code{}'.format(i)] = I_DICT[level]
+        fields = ['current_code{}'.format(i) for i in range(4)] + ['T0']
+
+    if 'debounce' in value:
+        value['debounce'] = _debounce_bits(value['debounce'])
+
+    params = []
+    for name in fields:
+        if name in value:
+            params.append(value.pop(name))
+        elif name in DEFAULTS:
+            params.append(DEFAULTS[name])
+        else:
+            raise ValueError('{} misses the value {!r}'.format(where, name))
+    if value:
+        raise ValueError('unknown values {} for {}'
+                         .format(sorted(value), where))
+
+    params = tuple(keys) + tuple(params)
+    command.check(params)
+
+    return command, params
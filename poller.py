@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+from time import monotonic
+from threading import Thread, Event
+from collections import namedtuple
+
+
+# =============================================================================
+# Immutable status record of a single motor
+# =============================================================================
+
+
+class MotorStatus(namedtuple('MotorStatus',
+                             ['position', 'velocity', 'action',
+                              'position_time', 'velocity_time',
+                              'action_time'])):
+    """
+    Last known position, velocity and action of a motor together with the
+    monotonic time each value was received (None: never received)
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def empty(cls):
+        return cls(None, None, None, None, None, None)
+
+    def updated(self, now, **fields):
+        """
+        Returns a copy with the given fields replaced and time stamped
+        """
+
+        for name in list(fields):
+            fields[name + '_time'] = now
+
+        return self._replace(**fields)
+
+
+# =============================================================================
+# Background poller
+# =============================================================================
+
+
+class StatusPoller(Thread):
+    """
+    Daemon thread refreshing position, velocity and action of the given
+    motors rate times per second. The replies are published by the
+    controller as immutable snapshots (Sixpack2Controller.status).
+    """
+
+    def __init__(self, ctrl, motors, rate=20.0):
+
+        Thread.__init__(self, name='Sixpack2StatusPoller', daemon=True)
+
+        if rate <= 0:
+            raise ValueError('poll rate has to be positive ({})'.format(rate))
+
+        self._ctrl = ctrl
+        self.motors = motors
+        self.period = 1.0 / rate
+        self._stopped = Event()
+
+        self.cycles = 0
+        self.errors = 0
+        self.last_error = None
+
+    def poll(self):
+        """
+        Refreshes the status of all motors once
+        """
+
+        for motor in self.motors:
+            motor.get_pos()
+            motor.get_vel()
+
+        return None
+
+    def run(self):
+
+        deadline = monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception as error:
+                self.errors += 1
+                self.last_error = error
+            self.cycles += 1
+
+            deadline += self.period
+            delay = deadline - monotonic()
+            if delay < 0:
+                # overrun: do not try to catch up with missed cycles
+                deadline = monotonic()
+                delay = 0
+            self._stopped.wait(delay)
+
+        return None
+
+    def stop(self, join=True):
+
+        self._stopped.set()
+        if join and self.is_alive():
+            self.join()
+
+        return None
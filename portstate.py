@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import json
+from threading import Lock
+
+# =============================================================================
+# Persistent per-port state (negotiated baud rate, discovered units, ...)
+# stored as JSON; the location can be changed with PYSIXPACK_STATE
+# =============================================================================
+
+STATE_FILE = os.environ.get(
+    'PYSIXPACK_STATE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pysixpack',
+                 'ports.json'))
+
+_lock = Lock()
+
+
+def port_identity(port):
+    """
+    Identity of a serial port: the resolved device path, so that
+    symlinks like /dev/ttySIXPACK and the underlying device match
+    """
+
+    if isinstance(port, str) and os.path.exists(port):
+        return os.path.realpath(port)
+
+    return str(port)
+
+
+def _load():
+
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store(state):
+
+    # written to a temporary file first, so readers never see a partial one
+    directory = os.path.dirname(STATE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = STATE_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, STATE_FILE)
+
+    return None
+
+
+def load_port_state(port):
+    """
+    Returns the stored state of the given port (empty dict if unknown)
+    """
+
+    with _lock:
+        return _load().get(port_identity(port), {})
+
+
+def save_port_state(port, **values):
+    """
+    Updates the stored state of the given port with values
+    """
+
+    with _lock:
+        state = _load()
+        state.setdefault(port_identity(port), {}).update(values)
+        _store(state)
+
+    return None
+
+
+def clear_port_state(port, *keys):
+    """
+    Removes the given keys (all if none given) from the stored state
+    """
+
+    with _lock:
+        state = _load()
+        entry = state.get(port_identity(port))
+        if entry is None:
+            return None
+        if keys:
+            for key in keys:
+                entry.pop(key, None)
+        else:
+            del state[port_identity(port)]
+        _store(state)
+
+    return None
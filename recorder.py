@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+import os
+from time import monotonic
+from threading import Thread, Event, Lock
+from asyncio import iscoroutinefunction
+from codec import GET_POS, GET_VEL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# =============================================================================
+# Sample layout
+# =============================================================================
+
+# columns of the recorder and layout of the records in the spill file
+SAMPLE_FIELDS = [('time', '<f8'), ('motor', 'u1'), ('posact', '<i4'),
+                 ('velact', '<i2'), ('action', 'u1')]
+
+
+def sample_dtype():
+    """
+    Structured dtype of the records in a spill file
+    """
+
+    return np.dtype(SAMPLE_FIELDS)
+
+
+def load_trace(path):
+    """
+    Opens a spill file read-only as memory-mapped structured array
+    (no copy), columns are accessed as trace['posact'] etc.
+    """
+
+    if np is None:
+        raise ImportError('loading traces requires numpy')
+
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=sample_dtype())
+
+    return np.memmap(path, dtype=sample_dtype(), mode='r')
+
+
+# =============================================================================
+# Recorder
+# =============================================================================
+
+
+class TelemetryRecorder(Thread):
+    """
+    Daemon thread sampling posact, velact and action of the given motors
+    as fast as the bus allows (or rate cycles per second). Each cycle sends
+    get_pos and get_vel for all motors in one transaction.
+
+    Samples are stored in preallocated columnar NumPy ring buffers holding
+    the last capacity samples (samples()). With spill, every sample is also
+    appended to that file, which load_trace() maps for analysis.
+    Memory use does not grow with the length of the recording.
+
+        rec = TelemetryRecorder(ctrl, spill='trace.bin')
+        rec.start()
+        ...
+        rec.stop()
+        trace = load_trace('trace.bin')
+    """
+
+    def __init__(self, ctrl, motors=None, capacity=65536, spill=None,
+                 rate=None):
+
+        Thread.__init__(self, name='Sixpack2TelemetryRecorder', daemon=True)
+
+        if np is None:
+            raise ImportError('TelemetryRecorder requires numpy')
+        if iscoroutinefunction(ctrl._flush):
+            raise TypeError('TelemetryRecorder needs a blocking controller')
+        if capacity <= 0:
+            raise ValueError('capacity has to be positive ({})'
+                             .format(capacity))
+        if rate is not None and rate <= 0:
+            raise ValueError('rate has to be positive ({})'.format(rate))
+
+        self._ctrl = ctrl
+        self.motors = list(ctrl) if motors is None else list(motors)
+        self.capacity = capacity
+        self.period = None if rate is None else 1.0 / rate
+
+        self.columns = {name: np.zeros(capacity, dtype=dtype)
+                        for name, dtype in SAMPLE_FIELDS}
+        self._lock = Lock()
+        self._stopped = Event()
+        self.count = 0
+
+        self.spill = spill
+        self._file = None
+        self._spilled = 0
+        self._staging = None
+        if spill is not None:
+            self._file = open(spill, 'ab')
+            self._staging = np.zeros(capacity, dtype=sample_dtype())
+
+        self.cycles = 0
+        self.errors = 0
+        self.last_error = None
+
+    # ------------------------------------------------------------------------
+    # sampling
+    # ------------------------------------------------------------------------
+
+    def sample(self):
+        """
+        Requests position and velocity of all motors once and stores
+        the samples. A motor whose replies are missing is left out of the
+        cycle (counted in errors).
+        """
+
+        ctrl = self._ctrl
+        resp_addr = ctrl._resp_addr
+        requests = []
+
+        t0 = monotonic()
+        with ctrl.transaction():
+            for motor in self.motors:
+                requests.append(
+                    (ctrl._send_request(GET_POS, motor._motno, resp_addr),
+                     ctrl._send_request(GET_VEL, motor._motno, resp_addr)))
+        t1 = monotonic()
+
+        # replies arrive evenly spread over the cycle
+        step = (t1 - t0) / len(requests)
+        with self._lock:
+            for i, (pos, vel) in enumerate(requests):
+                try:
+                    _, _, motno, posact, action, _ = pos.result()
+                    velact = vel.result()[3]
+                except Exception as error:
+                    self.errors += 1
+                    self.last_error = error
+                    continue
+                self._append(t0 + (i + 1) * step, motno, posact, velact,
+                             action)
+
+        if self._file is not None and \
+                self.count - self._spilled >= self.capacity // 2:
+            self.flush()
+
+        return None
+
+    def _append(self, now, motno, posact, velact, action):
+
+        i = self.count % self.capacity
+        columns = self.columns
+        columns['time'][i] = now
+        columns['motor'][i] = motno
+        columns['posact'][i] = posact
+        columns['velact'][i] = velact
+        columns['action'][i] = action
+        self.count += 1
+
+        return None
+
+    def run(self):
+
+        deadline = monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except Exception as error:
+                self.errors += 1
+                self.last_error = error
+            self.cycles += 1
+
+            if self.period is not None:
+                deadline += self.period
+                delay = deadline - monotonic()
+                if delay < 0:
+                    deadline = monotonic()
+                    delay = 0
+                self._stopped.wait(delay)
+
+        self.flush()
+
+        return None
+
+    def stop(self, join=True):
+
+        self._stopped.set()
+        if join and self.is_alive():
+            self.join()
+        if self._file is not None and not self.is_alive():
+            self.flush()
+            self._file.close()
+            self._file = None
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # access to the samples
+    # ------------------------------------------------------------------------
+
+    def _order(self, start, stop):
+        """
+        Ring indices of the samples start..stop (counted since the start)
+        """
+
+        return np.arange(start, stop) % self.capacity
+
+    def samples(self, last=None):
+        """
+        Returns copies of the columns with the last samples (all buffered
+        ones by default) in chronological order
+        """
+
+        with self._lock:
+            stop = self.count
+            start = max(0, stop - self.capacity)
+            if last is not None:
+                start = max(start, stop - last)
+            index = self._order(start, stop)
+            return {name: column[index]
+                    for name, column in self.columns.items()}
+
+    def flush(self):
+        """
+        Appends the samples not yet written to the spill file
+        """
+
+        if self._file is None:
+            return None
+
+        with self._lock:
+            start = max(self._spilled, self.count - self.capacity)
+            n = self.count - start
+            if n == 0:
+                return None
+            staging = self._staging[:n]
+            index = self._order(start, self.count)
+            for name, column in self.columns.items():
+                staging[name] = column[index]
+            self._spilled = self.count
+
+            staging.tofile(self._file)
+            self._file.flush()
+
+        return None
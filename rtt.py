@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+from codec import COMMANDS, FRAME_LENGTH
+from constants import BITS_PER_BYTE, RTO_INITIAL, RTO_MIN, RTO_MAX
+
+# gains of the smoothed round trip time and of its variation, weight of the
+# variation in the timeout (as in RFC 6298)
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+
+class RoundTripTimer(object):
+    """
+    Learns the round trip time of every command at the current baud rate
+    and derives reply timeouts from it like TCP's retransmission timer:
+    timeout = SRTT + 4 * RTTVAR, clipped to [minimum, maximum]. Before the
+    first round trip of a command has been measured, the timeout is the
+    time of request and reply on the line plus initial. A timeout doubles
+    the timeout of the command until the next measurement.
+    """
+
+    def __init__(self, baudrate=None, initial=RTO_INITIAL, minimum=RTO_MIN,
+                 maximum=RTO_MAX):
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.reset(baudrate)
+
+    def reset(self, baudrate=None):
+        """
+        Forgets the measurements, e.g. after the baud rate changed
+        """
+
+        self.baudrate = baudrate
+        line = 0.0
+        if baudrate:
+            line = 2 * FRAME_LENGTH * BITS_PER_BYTE / baudrate
+        self._default = min(line + self.initial, self.maximum)
+        # opcode: [srtt, rttvar, timeout]
+        self._estimates = {}
+
+        return None
+
+    def timeout(self, opcode):
+
+        estimate = self._estimates.get(opcode)
+        if estimate is None:
+            return self._default
+
+        return estimate[2]
+
+    def sample(self, opcode, rtt):
+        """
+        Updates the estimate with a measured round trip time (only of
+        replies to requests sent once: replies to repeated requests
+        cannot be attributed)
+        """
+
+        estimate = self._estimates.get(opcode)
+        if estimate is None or estimate[0] is None:
+            srtt, rttvar = rtt, rtt / 2
+        else:
+            srtt, rttvar, _ = estimate
+            rttvar += BETA * (abs(srtt - rtt) - rttvar)
+            srtt += ALPHA * (rtt - srtt)
+
+        timeout = min(max(srtt + K * rttvar, self.minimum), self.maximum)
+        self._estimates[opcode] = [srtt, rttvar, timeout]
+
+        return None
+
+    def backoff(self, opcode):
+        """
+        Doubles the timeout of a command after a timeout
+        """
+
+        estimate = self._estimates.get(opcode)
+        if estimate is None:
+            estimate = self._estimates[opcode] = [None, None, self._default]
+        estimate[2] = min(2 * estimate[2], self.maximum)
+
+        return None
+
+    def snapshot(self):
+        """
+        Returns srtt, rttvar and timeout per command name
+        """
+
+        snapshot = {}
+        for opcode, (srtt, rttvar, timeout) in sorted(
+                list(self._estimates.items())):
+            command = COMMANDS.get(opcode)
+            name = command.name if command else '0x{:02X}'.format(opcode)
+            snapshot[name] = {'srtt': srtt, 'rttvar': rttvar,
+                              'timeout': timeout}
+
+        return snapshot
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+import asyncio
+from time import monotonic
+from inspect import isawaitable
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Event
+from collections import namedtuple
+from codec import FRAME_LENGTH
+from constants import (BITS_PER_BYTE, DEFAULT_BAUDRATE,
+                       TRANSMITTER_DELAY_UNIT, TELEMETRY_SHARE)
+
+
+# =============================================================================
+# Time slots on the line
+# =============================================================================
+
+
+def slot_times(ctrl):
+    """
+    Time (s) a command and a request with its reply occupy the line at the
+    baud rate and transmitter delay of the controller
+    """
+
+    baudrate = ctrl._ser.baudrate or DEFAULT_BAUDRATE
+    frame = FRAME_LENGTH * BITS_PER_BYTE / baudrate
+    turnaround = ctrl.transmitter_delay * TRANSMITTER_DELAY_UNIT
+
+    return frame, 2 * frame + turnaround
+
+
+# =============================================================================
+# Traffic classes
+# =============================================================================
+
+
+class TrafficClass(namedtuple('TrafficClass',
+                              ['name', 'rate', 'request', 'items',
+                               'active'])):
+    """
+    Telemetry of one kind: request(item) is issued rate times per second
+    for every item for which active(item) is true (active None: always)
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, name, rate, request, items, active=None):
+
+        if rate <= 0:
+            raise ValueError('rate of traffic class {} has to be positive'
+                             ' ({})'.format(name, rate))
+
+        return super().__new__(cls, name, rate, request, tuple(items),
+                               active)
+
+    def selected(self):
+        """
+        Items currently belonging to the class
+        """
+
+        if self.active is None:
+            return list(self.items)
+
+        return [item for item in self.items if self.active(item)]
+
+
+def _moving(motor):
+    """
+    True if the motor is reported or predicted to be moving
+    """
+
+    action = motor._ctrl._snapshot[motor._motno].action
+    if action is not None and action != 'inactive':
+        return True
+    arrival = motor.predicted_arrival()
+
+    return arrival is not None and arrival > monotonic()
+
+
+def _get_pos(motor):
+    return motor.get_pos()
+
+
+def default_classes(ctrl, motors=None, moving=50.0, idle=2.0, channels=(),
+                    inputs=10.0):
+    """
+    Positions of moving motors at moving Hz and of idle motors at idle Hz,
+    the given analogue input channels at inputs Hz
+    """
+
+    motors = list(ctrl) if motors is None else list(motors)
+    classes = [TrafficClass('moving', moving, _get_pos, motors, _moving),
+               TrafficClass('idle', idle, _get_pos, motors,
+                            lambda motor: not _moving(motor))]
+    if channels:
+        classes.append(TrafficClass('inputs', inputs,
+                                    ctrl.read_input_channels, channels))
+
+    return classes
+
+
+# =============================================================================
+# Scheduler
+# =============================================================================
+
+
+class _Scheduler(object):
+    """
+    Traffic classes within a budget of the line, see BusScheduler
+    """
+
+    def __init__(self, ctrl, classes, share=TELEMETRY_SHARE):
+
+        if not 0 < share <= 1:
+            raise ValueError('telemetry share has to be in (0, 1] ({})'
+                             .format(share))
+
+        self._ctrl = ctrl
+        self.classes = list(classes)
+        self.share = share
+
+        self.scale = 1.0
+        self.sent = {cls.name: 0 for cls in self.classes}
+        self.errors = 0
+        self.last_error = None
+        # time the last request was issued (see _plan)
+        self._issued = None
+
+    def budget(self):
+        """
+        Returns the requests per second the line allows for telemetry,
+        the demand of the classes and the resulting rate per class and
+        item: (capacity, demand, {name: rate})
+        """
+
+        _, slot = slot_times(self._ctrl)
+        capacity = self.share / slot
+        demand = sum(cls.rate * len(cls.selected()) for cls in self.classes)
+        scale = min(1.0, capacity / demand) if demand else 1.0
+
+        return capacity, demand, {cls.name: cls.rate * scale
+                                  for cls in self.classes}
+
+    def _plan(self):
+        """
+        Yields (time, request) in turn: wait until time (monotonic), then
+        issue request, a (class, item), unless it is None. The requests
+        are issued with _issue.
+        """
+
+        # (due time, sequence, class, item); every item of every class is
+        # visited at the class rate, inactive items are skipped
+        queue = []
+        seq = count()
+        now = monotonic()
+        for cls in self.classes:
+            for item in cls.items:
+                heappush(queue, (now, next(seq), cls, item))
+
+        free = now
+        while queue:
+            capacity, demand, _ = self.budget()
+            self.scale = min(1.0, capacity / demand) if demand else 1.0
+
+            due, _, cls, item = heappop(queue)
+            yield due, None
+            period = 1.0 / (cls.rate * self.scale)
+            if cls.active is not None and not cls.active(item):
+                heappush(queue, (max(due, monotonic()) + period, next(seq),
+                                 cls, item))
+                continue
+
+            yield free, (cls, item)
+
+            now = monotonic()
+            free = self._issued + 1.0 / capacity
+            # overrun: do not try to catch up with missed requests
+            heappush(queue, (max(due + period, now), next(seq), cls, item))
+
+        return None
+
+    def _count(self, cls, error=None):
+
+        if error is None:
+            self.sent[cls.name] += 1
+        else:
+            self.errors += 1
+            self.last_error = error
+
+        return None
+
+
+class BusScheduler(_Scheduler, Thread):
+    """
+    Daemon thread issuing the telemetry of the given traffic classes
+    within a budget of the line: requests are spaced by at least one
+    request slot (see slot_times) divided by share, so that the remaining
+    1 - share of the line is free for commands. If the classes ask for
+    more than the budget, the rates of all classes are scaled down by the
+    same factor.
+
+    Only one telemetry request is on the line at a time and commands take
+    precedence by priority in the I/O worker (started by
+    Sixpack2Controller.start_scheduler), so a command waits at most one
+    request slot for the line.
+    """
+
+    def __init__(self, ctrl, classes, share=TELEMETRY_SHARE):
+
+        Thread.__init__(self, name='Sixpack2BusScheduler', daemon=True)
+        _Scheduler.__init__(self, ctrl, classes, share)
+
+        self._stopped = Event()
+
+    def run(self):
+
+        for when, request in self._plan():
+            delay = when - monotonic()
+            if (self._stopped.wait(delay) if delay > 0
+                    else self._stopped.is_set()):
+                break
+            if request is None:
+                continue
+            cls, item = request
+            self._issued = monotonic()
+            try:
+                cls.request(item)
+            except Exception as error:
+                self._count(cls, error)
+            else:
+                self._count(cls)
+
+        return None
+
+    def stop(self, join=True):
+
+        self._stopped.set()
+        if join and self.is_alive():
+            self.join()
+
+        return None
+
+
+class AsyncBusScheduler(_Scheduler):
+    """
+    BusScheduler as a task of the running event loop (see
+    AsyncSixpack2Controller.start_scheduler); requests of the classes may
+    return awaitables
+    """
+
+    def __init__(self, ctrl, classes, share=TELEMETRY_SHARE):
+
+        _Scheduler.__init__(self, ctrl, classes, share)
+
+        self._task = None
+
+    def start(self):
+
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+        return None
+
+    async def _run(self):
+
+        for when, request in self._plan():
+            delay = when - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if request is None:
+                continue
+            cls, item = request
+            self._issued = monotonic()
+            try:
+                result = cls.request(item)
+                if isawaitable(result):
+                    await result
+            except Exception as error:
+                self._count(cls, error)
+            else:
+                self._count(cls)
+
+        return None
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def stop(self, join=True):
+        """
+        Cancels the task (join is ignored, the task ends at its next
+        await)
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+
+        return None
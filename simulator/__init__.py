@@ -0,0 +1,14 @@
+"""
+Virtual Sixpack2 for tests and benchmarks without hardware.
+
+VirtualSixpack2 models the protocol and the motion of the motors,
+SerialLine the timing of the half-duplex line (baud rate, transmitter
+delay) and fault injection (Faults). The line is reachable either
+in-process (SimulatedSerial, passed as transport to the controller) or
+through a pseudo-terminal (PtySimulator).
+"""
+
+from simulator.device import VirtualSixpack2, VirtualMotor
+from simulator.line import SerialLine, Faults
+from simulator.transport import SimulatedSerial
+from simulator.terminal import PtySimulator
@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+
+from codec import COMMANDS, FRAME_LENGTH, QUERY_ALL
+from constants import (BAUDRATE_CLOCK, _velocity_hz, _acceleration_hz2)
+
+# =============================================================================
+# Action codes (see constants.ACTION_DICT)
+# =============================================================================
+
+INACTIVE = 0
+RAMPING = 5
+PI_CONTROLLER = 10
+ROTATION = 15
+REFERENCE_SEARCH = 20
+
+# integration step of the kinematic model (s)
+TIME_STEP = 1e-3
+
+# power-on parameters of each motor
+DEFAULT_PARAMS = {'peak_current': 128, 'current_codes': (8, 2, 1, 0),
+                  'T0': 1000, 'vmin': 1, 'vstart': 10, 'divi': 0,
+                  'amax': 100, 'vmax': 200, 'poslimit': 0, 'mottype': 0,
+                  'motparams': 0, 'vrefmax': 100, 'debounce': 0,
+                  'stop_after': 0, 'nulloffset': 0, 'nullrange': 0,
+                  'propdiv': 1, 'intdiv': 1, 'intclip': 1, 'intinpclip': 0}
+
+
+# =============================================================================
+# Virtual motor
+# =============================================================================
+
+
+class VirtualMotor(object):
+    """
+    Kinematic model of one axis: trapezoidal ramps between vstart and vmax
+    with acceleration amax, rotation and a reference switch at position 0.
+    Positions are in steps, velocities in steps/s.
+    """
+
+    def __init__(self, device, motno):
+        self._device = device
+        self.motno = motno
+        self.reset()
+
+    def reset(self):
+
+        self.params = dict(DEFAULT_PARAMS)
+        self.position = 0.0
+        self.velocity = 0.0
+        self.target = 0
+        self.rotvel = 0.0
+        self.action = INACTIVE
+        self.stop_status = 0
+        self.started = None
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # unit conversion
+    # ------------------------------------------------------------------------
+
+    def _hz(self, v):
+        return _velocity_hz(v, self._device.clkdiv)
+
+    def _acceleration(self):
+        return _acceleration_hz2(self.params['amax'], self._device.clkdiv,
+                                 self.params['divi'])
+
+    def velocity_units(self):
+        """
+        Actual velocity in internal units
+        """
+
+        unit = self._hz(1)
+        return int(round(self.velocity / unit))
+
+    # ------------------------------------------------------------------------
+    # commands
+    # ------------------------------------------------------------------------
+
+    def start_ramp(self, targetpos, action=RAMPING):
+
+        self.target = targetpos
+        self.action = action
+        self.started = self._device.time
+
+        return None
+
+    def rotate(self, rotvel):
+
+        self.rotvel = self._hz(rotvel)
+        self.action = ROTATION
+
+        return None
+
+    def stop(self):
+
+        if self.action != INACTIVE:
+            self.start_ramp(int(round(self.position)))
+
+        return None
+
+    def start_ref_search(self):
+
+        self.action = REFERENCE_SEARCH
+
+        return None
+
+    def set_actualpos(self, posact):
+
+        self.position = float(posact)
+        self.target = posact
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # kinematics
+    # ------------------------------------------------------------------------
+
+    def advance(self, dt):
+        """
+        Advances the motor by dt seconds
+        """
+
+        while dt > 0 and self.action != INACTIVE:
+            step = min(dt, TIME_STEP)
+            dt -= step
+            if self.action == ROTATION:
+                self._rotate(step)
+            elif self.action == REFERENCE_SEARCH:
+                self._ref_search(step)
+            else:
+                self._ramp(step)
+
+        return None
+
+    def _ramp(self, dt):
+
+        v0 = self._hz(self.params['vstart'])
+        vlim = max(self._hz(self.params['vmax']), v0)
+        acc = self._acceleration()
+
+        distance = self.target - self.position
+        if abs(distance) < 0.5 and abs(self.velocity) <= v0:
+            self._arrive()
+            return None
+
+        direction = 1 if distance > 0 else -1
+        speed = direction * self.velocity
+
+        if speed < 0:
+            # moving away from the target, decelerate first
+            speed = min(speed + acc * dt, v0)
+        elif abs(distance) <= (speed**2 - v0**2) / (2 * acc):
+            speed = max(v0, speed - acc * dt)
+        else:
+            speed = min(vlim, max(v0, speed + acc * dt))
+
+        if speed >= 0 and speed * dt >= abs(distance):
+            self._arrive()
+            return None
+
+        self.velocity = direction * speed
+        self.position += self.velocity * dt
+
+        return None
+
+    def _arrive(self):
+
+        self.position = float(self.target)
+        self.velocity = 0.0
+        if self.action != PI_CONTROLLER:
+            self.action = INACTIVE
+
+        return None
+
+    def _rotate(self, dt):
+
+        v0 = self._hz(self.params['vstart'])
+        acc = self._acceleration()
+
+        dv = self.rotvel - self.velocity
+        if abs(dv) <= acc * dt:
+            self.velocity = self.rotvel
+        else:
+            self.velocity += acc * dt if dv > 0 else -acc * dt
+
+        if self.rotvel == 0 and abs(self.velocity) <= v0:
+            self.velocity = 0.0
+            self.action = INACTIVE
+            self.target = int(round(self.position))
+            return None
+
+        self.position += self.velocity * dt
+
+        return None
+
+    def _ref_search(self, dt):
+
+        self.velocity = -self._hz(self.params['vrefmax'])
+        self.position += self.velocity * dt
+        if self.position <= 0:
+            self.position = 0.0
+            self.velocity = 0.0
+            self.target = 0
+            self.action = INACTIVE
+
+        return None
+
+
+# =============================================================================
+# Virtual PACK
+# =============================================================================
+
+
+class VirtualSixpack2(object):
+    """
+    Protocol level model of a Sixpack2 unit. Frames are passed in with
+    the (simulated) time they were received; replies are returned as bytes.
+    Delayed responses of query_all are kept pending and handed out by
+    poll() once the masked motors are inactive.
+    """
+
+    def __init__(self, address=0, num_motors=6, firmware=21,
+                 serial_number=20190307, temperature=30):
+
+        self.num_motors = num_motors
+        self.firmware = firmware
+        self.serial_number = serial_number
+        self.temperature = temperature
+
+        self.address = address
+        self.baudrate = 19200
+        self.transmitter_delay = 3
+        self.motors = [VirtualMotor(self, i) for i in range(num_motors)]
+        self.analogue_values = 8 * [512]
+        self.ref_inputs = 0
+        self.frames = 0
+
+        self._time = None
+        self._pending = []
+        self.reset()
+
+    def reset(self):
+        """
+        Complete hardware reset: motion state and parameters are lost
+        """
+
+        for motor in self.motors:
+            motor.reset()
+        self.clkdiv = 5
+        self.settings = {}
+        self.reset_flag = 1
+        self._pending = []
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # time
+    # ------------------------------------------------------------------------
+
+    @property
+    def time(self):
+        """
+        Time of the last received frame or poll
+        """
+
+        return self._time
+
+    def advance(self, now):
+        """
+        Advances all motors to the given time
+        """
+
+        if self._time is not None and now > self._time:
+            dt = now - self._time
+            for motor in self.motors:
+                motor.advance(dt)
+        if self._time is None or now > self._time:
+            self._time = now
+
+        return None
+
+    def busy(self):
+        return bool(self._pending)
+
+    def poll(self, now):
+        """
+        Returns the delayed replies which are ready at the given time
+        """
+
+        self.advance(now)
+        ready = []
+        for entry in list(self._pending):
+            mask, reply = entry
+            if not any(m.action != INACTIVE for m in self._masked(mask)):
+                self._pending.remove(entry)
+                ready.append(reply())
+
+        return ready
+
+    def _masked(self, mask):
+        return [m for m in self.motors if mask >> m.motno & 1]
+
+    # ------------------------------------------------------------------------
+    # frames
+    # ------------------------------------------------------------------------
+
+    def receive(self, frame, now):
+        """
+        Processes a frame received at time now. Returns the reply
+        (bytes), or None if there is no (immediate) reply.
+        """
+
+        self.advance(now)
+
+        if len(frame) != FRAME_LENGTH or frame[0] != self.address:
+            return None
+        command = COMMANDS.get(frame[1])
+        if command is None:
+            return None
+
+        self.frames += 1
+        params = command.unpack(frame)[2:]
+        handler = getattr(self, '_' + command.name)
+
+        try:
+            return handler(*params)
+        except IndexError:
+            # motor not fitted: the frame is ignored
+            return None
+
+    def _reply(self, command, resp_addr, *values):
+        return command.reply.pack(resp_addr, command.opcode, *values)
+
+    def _setting(self, motno, **params):
+        self.motors[motno].params.update(params)
+
+    # setting motor parameters
+
+    def _set_peak_current(self, motno, peak_current):
+        self._setting(motno, peak_current=peak_current)
+
+    def _control_current(self, motno, i0, i1, i2, i3, T0):
+        self._setting(motno, current_codes=(i0, i1, i2, i3), T0=T0)
+
+    def _set_velocity(self, clkdiv):
+        self.clkdiv = clkdiv
+
+    def _set_startvel(self, motno, vmin, vstart, divi):
+        self._setting(motno, vmin=vmin, vstart=vstart, divi=divi)
+
+    def _set_velacc(self, motno, amax, vmax):
+        self._setting(motno, amax=amax, vmax=vmax)
+
+    def _set_motparams(self, motno, poslimit, mottype, motparams):
+        self._setting(motno, poslimit=poslimit, mottype=mottype,
+                      motparams=motparams)
+
+    def _ref_search_params(self, motno, vrefmax, debounce, stop_after):
+        self._setting(motno, vrefmax=vrefmax, debounce=debounce,
+                      stop_after=stop_after)
+
+    def _write_motor_char_table(self, pointer, *entries):
+        self.settings[('char_table', pointer)] = entries
+
+    def _set_nulloffset_nullrange(self, motno, nulloffset, nullrange):
+        self._setting(motno, nulloffset=nulloffset, nullrange=nullrange)
+
+    def _set_PI_parameter(self, motno, propdiv, intdiv, intclip, intinpclip):
+        self._setting(motno, propdiv=propdiv, intdiv=intdiv,
+                      intclip=intclip, intinpclip=intinpclip)
+
+    # moving the motors
+
+    def _get_pos(self, motno, resp_addr):
+        motor = self.motors[motno]
+        return self._reply(COMMANDS[0x20], resp_addr, motno,
+                           int(round(motor.position)), motor.action,
+                           motor.stop_status)
+
+    def _get_vel(self, motno, resp_addr):
+        motor = self.motors[motno]
+        return self._reply(COMMANDS[0x21], resp_addr, motno,
+                           motor.velocity_units(), motor.action)
+
+    def _start_ref_search(self, motno):
+        self.motors[motno].start_ref_search()
+
+    def _start_ramp(self, motno, targetpos):
+        self.motors[motno].start_ramp(targetpos)
+
+    def _activate_PI_on_targetpos(self, motno, targetpos):
+        self.motors[motno].start_ramp(targetpos, action=PI_CONTROLLER)
+
+    def _rotate(self, motno, rotvel):
+        self.motors[motno].rotate(rotvel)
+
+    def _set_targetpos(self, motno, targetpos):
+        motor = self.motors[motno]
+        motor.target = targetpos
+        if motor.action == RAMPING:
+            motor.start_ramp(targetpos)
+
+    def _set_actualpos(self, motno, posact):
+        self.motors[motno].set_actualpos(posact)
+
+    def _query_all(self, resp_addr, mask):
+
+        def reply():
+            actions = [m.action for m in self.motors]
+            actions += (6 - len(actions)) * [INACTIVE]
+            return self._reply(QUERY_ALL, resp_addr, *actions[:6])
+
+        if any(m.action != INACTIVE for m in self._masked(mask)):
+            self._pending.append((mask, reply))
+            return None
+
+        return reply()
+
+    def _start_parallel_ramp(self, mask):
+        for motor in self._masked(mask):
+            motor.start_ramp(motor.target)
+
+    _start_multi_movement = _start_parallel_ramp
+
+    def _stop_motors(self, mask):
+        for motor in self._masked(mask):
+            motor.stop()
+
+    def _abort_ref_search(self, motno):
+        motor = self.motors[motno]
+        if motor.action == REFERENCE_SEARCH:
+            motor.velocity = 0.0
+            motor.action = RAMPING
+            motor.stop()
+
+    # additional inputs/outputs
+
+    def _read_input_channels(self, channelno, resp_addr):
+        return self._reply(COMMANDS[0x30], resp_addr, channelno,
+                           self.analogue_values[channelno % 8],
+                           self.ref_inputs >> channelno & 1,
+                           self.ref_inputs, 0)
+
+    def _set_limits_stop_func(self, channelno, lo, hi):
+        self.settings[('stop_func', channelno)] = (lo, hi)
+
+    def _set_add_outputs(self, *states):
+        self.settings['outputs'] = states
+
+    def _set_ready_output_func(self, motormask, refsearchmask):
+        self.settings['ready_output'] = (motormask, refsearchmask)
+
+    # other settings
+
+    def _adjust_baudrate(self, baudratedivisor, transmitter_delay):
+        self.baudrate = BAUDRATE_CLOCK / baudratedivisor
+        self.transmitter_delay = transmitter_delay
+
+    def _set_abort_timeout(self, abort_timeout):
+        self.settings['abort_timeout'] = abort_timeout
+
+    def _change_unit_address(self, unit_address):
+        self.address = unit_address
+
+    def _get_unit_info(self, resp_addr):
+        reset_flag, self.reset_flag = self.reset_flag, 0
+        return self._reply(COMMANDS[0x43], resp_addr, self.firmware,
+                           reset_flag, self.temperature, self.serial_number)
+
+    def _complete_hwreset(self):
+        self.reset()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import random
+from heapq import heappush, heappop
+from constants import BITS_PER_BYTE, TRANSMITTER_DELAY_UNIT
+from codec import FRAME_LENGTH
+
+# relative baud rate mismatch the UARTs still tolerate
+BAUDRATE_TOLERANCE = 0.04
+
+# idle time (in byte times) after which a partial frame is discarded
+FRAME_GAP = 3
+
+# time the PACK needs to process a frame before answering (s)
+PROCESSING_TIME = 2e-4
+
+
+# =============================================================================
+# Fault injection
+# =============================================================================
+
+
+class Faults(object):
+    """
+    Probabilities of faults injected into the replies of the PACK:
+    drop_reply (whole reply lost), drop_byte (single byte lost),
+    corrupt_byte (single byte flipped), late_reply (reply delayed by
+    late_delay seconds) and garbage (random bytes before the reply).
+    """
+
+    def __init__(self, drop_reply=0.0, drop_byte=0.0, corrupt_byte=0.0,
+                 late_reply=0.0, late_delay=0.1, garbage=0.0, seed=None):
+
+        self.drop_reply = drop_reply
+        self.drop_byte = drop_byte
+        self.corrupt_byte = corrupt_byte
+        self.late_reply = late_reply
+        self.late_delay = late_delay
+        self.garbage = garbage
+        self._random = random.Random(seed)
+
+    def apply(self, reply):
+        """
+        Returns (delay, bytes) of the reply after injecting faults
+        """
+
+        rnd = self._random.random
+        if rnd() < self.drop_reply:
+            return 0.0, b''
+
+        reply = bytearray(reply)
+        if rnd() < self.drop_byte:
+            del reply[self._random.randrange(len(reply))]
+        if rnd() < self.corrupt_byte:
+            reply[self._random.randrange(len(reply))] ^= \
+                1 << self._random.randrange(8)
+        if rnd() < self.garbage:
+            noise = bytes(self._random.randrange(256)
+                          for _ in range(self._random.randint(1, 4)))
+            reply[:0] = noise
+
+        delay = self.late_delay if rnd() < self.late_reply else 0.0
+
+        return delay, bytes(reply)
+
+
+# =============================================================================
+# Half-duplex serial line with one or more PACKs
+# =============================================================================
+
+
+class SerialLine(object):
+    """
+    Timing model of the RS-485/RS-232 line between host and PACK(s).
+
+    Bytes written by the host occupy the line for BITS_PER_BYTE bit times
+    each; a PACK processes a frame once it is completely received and
+    answers after its transmitter delay. Reply bytes become available to
+    the host one by one, as they arrive. Frames sent with a baud rate the
+    PACK does not expect are lost, as are replies read with the wrong baud
+    rate (they arrive as garbage).
+    """
+
+    def __init__(self, devices, baudrate=19200, faults=None):
+
+        self.devices = list(devices)
+        self.baudrate = baudrate
+        self.faults = faults
+
+        self._line_free = 0.0
+        self._rx = bytearray()
+        self._last_byte = None
+        self._deliveries = []
+        self._seq = 0
+
+    def byte_time(self, baudrate=None):
+        return BITS_PER_BYTE / (baudrate or self.baudrate)
+
+    def _matches(self, device):
+        return (abs(device.baudrate - self.baudrate)
+                <= BAUDRATE_TOLERANCE * self.baudrate)
+
+    # ------------------------------------------------------------------------
+    # host -> PACK
+    # ------------------------------------------------------------------------
+
+    def host_write(self, data, now):
+        """
+        Host writes data at time now. Returns the time the last byte
+        has left the host.
+        """
+
+        byte_time = self.byte_time()
+        start = max(now, self._line_free)
+
+        for i, byte in enumerate(data):
+            arrival = start + (i + 1) * byte_time
+            if (self._last_byte is not None
+                    and arrival - self._last_byte > FRAME_GAP * byte_time
+                    + byte_time):
+                self._rx.clear()
+            self._last_byte = arrival
+            self._rx.append(byte)
+            if len(self._rx) == FRAME_LENGTH:
+                frame = bytes(self._rx)
+                self._rx.clear()
+                self._dispatch(frame, arrival)
+
+        self._line_free = max(self._line_free,
+                              start + len(data) * byte_time)
+
+        return start + len(data) * byte_time
+
+    def _dispatch(self, frame, now):
+
+        for device in self.devices:
+            if not self._matches(device):
+                continue
+            reply = device.receive(frame, now)
+            if reply is not None:
+                self._transmit(device, reply, now + PROCESSING_TIME)
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # PACK -> host
+    # ------------------------------------------------------------------------
+
+    def _transmit(self, device, reply, ready):
+
+        delay = 0.0
+        if self.faults is not None:
+            delay, reply = self.faults.apply(reply)
+
+        start = max(ready + device.transmitter_delay * TRANSMITTER_DELAY_UNIT
+                    + delay, self._line_free)
+        byte_time = self.byte_time(device.baudrate)
+        garbled = not self._matches(device)
+
+        for i, byte in enumerate(reply):
+            if garbled:
+                byte ^= 0x55
+            self._seq += 1
+            heappush(self._deliveries,
+                     (start + (i + 1) * byte_time, self._seq, byte))
+
+        self._line_free = start + len(reply) * byte_time
+
+        return None
+
+    def _poll_devices(self, now):
+
+        for device in self.devices:
+            if device.busy():
+                for reply in device.poll(now):
+                    self._transmit(device, reply, now)
+
+        return None
+
+    def read_due(self, now):
+        """
+        Returns all bytes which have arrived at the host until now
+        """
+
+        self._poll_devices(now)
+
+        data = bytearray()
+        while self._deliveries and self._deliveries[0][0] <= now:
+            data.append(heappop(self._deliveries)[2])
+
+        return bytes(data)
+
+    def next_due(self, now, poll_interval=1e-3):
+        """
+        Time at which the next byte arrives at the host, None if nothing
+        is expected
+        """
+
+        self._poll_devices(now)
+
+        if self._deliveries:
+            return self._deliveries[0][0]
+        if any(device.busy() for device in self.devices):
+            return now + poll_interval
+
+        return None
+
+    def discard(self):
+        """
+        Drops all bytes in transit to the host
+        """
+
+        self._deliveries = []
+
+        return None
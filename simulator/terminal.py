@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import os
+import tty
+import termios
+from select import select
+from time import monotonic
+from threading import Thread, Event
+from simulator.device import VirtualSixpack2
+from simulator.line import SerialLine
+
+# termios speed constants -> baud rate
+_SPEEDS = {getattr(termios, 'B{}'.format(b)): b
+           for b in (300, 1200, 2400, 4800, 9600, 19200, 38400, 57600,
+                     115200, 230400) if hasattr(termios, 'B{}'.format(b))}
+
+
+class PtySimulator(object):
+    """
+    Virtual PACK(s) behind a pseudo-terminal. Any serial library can open
+    PtySimulator.port like a real device:
+
+        sim = PtySimulator()
+        sim.start()
+        ctrl = Sixpack2Controller(port=sim.port, num_motors=6)
+
+    A background thread feeds the bytes written by the host into the line
+    model and writes the replies back when they are due. The baud rate the
+    host configured on the terminal is taken into account.
+    """
+
+    def __init__(self, devices=None, faults=None):
+
+        if devices is None:
+            devices = [VirtualSixpack2()]
+        elif isinstance(devices, VirtualSixpack2):
+            devices = [devices]
+
+        self.line = SerialLine(devices, faults=faults)
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._stopped = Event()
+        self._thread = None
+
+    @property
+    def devices(self):
+        return self.line.devices
+
+    def _host_baudrate(self):
+
+        try:
+            speed = termios.tcgetattr(self._slave)[5]
+        except termios.error:
+            return self.line.baudrate
+
+        return _SPEEDS.get(speed, self.line.baudrate)
+
+    def start(self):
+
+        self._thread = Thread(target=self._run, name='PtySimulator',
+                              daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+        return None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+
+        while not self._stopped.is_set():
+            now = monotonic()
+            due = self.line.next_due(now)
+            wait = 0.05 if due is None else max(0.0, min(0.05, due - now))
+
+            readable, _, _ = select([self._master], [], [], wait)
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    break
+                self.line.baudrate = self._host_baudrate()
+                self.line.host_write(data, monotonic())
+
+            reply = self.line.read_due(monotonic())
+            if reply:
+                os.write(self._master, reply)
+
+        return None
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import os
+from time import monotonic
+from threading import Thread, Condition
+from simulator.device import VirtualSixpack2
+from simulator.line import SerialLine
+
+
+class SimulatedSerial(object):
+    """
+    In-process replacement of serial.Serial talking to virtual PACK(s) over
+    a simulated line (see SerialLine), to be passed as transport to
+    Sixpack2Controller:
+
+        ctrl = Sixpack2Controller(transport=SimulatedSerial(), num_motors=6)
+
+    Reads block (up to timeout) until the simulated reply bytes arrive.
+    fileno() returns a pipe which becomes readable when bytes have arrived,
+    so the transport can be used with event loops as well.
+    """
+
+    def __init__(self, devices=None, baudrate=19200, timeout=None,
+                 faults=None):
+
+        if devices is None:
+            devices = [VirtualSixpack2()]
+        elif isinstance(devices, VirtualSixpack2):
+            devices = [devices]
+
+        self.port = 'sim://sixpack2'
+        self.timeout = timeout
+        self.write_timeout = None
+        self.line = SerialLine(devices, baudrate, faults)
+        self.is_open = True
+
+        self._rx = bytearray()
+        self._cond = Condition()
+        self._pipe = None
+        self._notifier = None
+
+    @property
+    def devices(self):
+        return self.line.devices
+
+    @property
+    def baudrate(self):
+        return self.line.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.line.baudrate = baudrate
+
+    # ------------------------------------------------------------------------
+    # serial.Serial interface
+    # ------------------------------------------------------------------------
+
+    def write(self, data):
+
+        with self._cond:
+            self.line.host_write(bytes(data), monotonic())
+            self._cond.notify_all()
+
+        return len(data)
+
+    def _collect(self):
+
+        data = self.line.read_due(monotonic())
+        if data:
+            self._rx += data
+
+        return len(data)
+
+    def read(self, size=1):
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = monotonic() + self.timeout
+
+        with self._cond:
+            self._collect()
+            while len(self._rx) < size:
+                now = monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                due = self.line.next_due(now)
+                wait = None if due is None else due - now
+                if deadline is not None:
+                    wait = deadline - now if wait is None \
+                        else min(wait, deadline - now)
+                if wait is None or wait > 0:
+                    self._cond.wait(wait)
+                self._collect()
+
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            self._drain_pipe()
+
+        return data
+
+    def readinto(self, buffer):
+
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    @property
+    def in_waiting(self):
+
+        with self._cond:
+            self._collect()
+            if not self._rx:
+                self._drain_pipe()
+            return len(self._rx)
+
+    def reset_input_buffer(self):
+
+        with self._cond:
+            self._collect()
+            self._rx.clear()
+            self._drain_pipe()
+
+        return None
+
+    def reset_output_buffer(self):
+        return None
+
+    def flush(self):
+        return None
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+
+        self.is_open = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # readiness notification for event loops
+    # ------------------------------------------------------------------------
+
+    def fileno(self):
+
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            os.set_blocking(self._pipe[0], False)
+            self._notifier = Thread(target=self._notify,
+                                    name='SimulatedSerialNotifier',
+                                    daemon=True)
+            self._notifier.start()
+
+        return self._pipe[0]
+
+    def _drain_pipe(self):
+
+        if self._pipe is not None and not self._rx:
+            try:
+                os.read(self._pipe[0], 4096)
+            except BlockingIOError:
+                pass
+
+        return None
+
+    def _notify(self):
+
+        while self.is_open and self._pipe is not None:
+            with self._cond:
+                if self._collect() and self._pipe is not None:
+                    os.write(self._pipe[1], b'\0')
+                now = monotonic()
+                due = self.line.next_due(now)
+                wait = 0.05 if due is None else min(0.05, due - now)
+                if wait > 0:
+                    self._cond.wait(wait)
+
+        return None
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+sixpack-daemon: owns the serial port of a PACK and shares it with any number
+of local processes over a Unix domain socket (see Sixpack2Client).
+
+    python sixpack_daemon.py --port /dev/ttySIXPACK --num-motors 6
+
+Client frames are pipelined onto the bus through the controller's I/O
+worker (emergency stops first), settings are filtered by the daemon's
+parameter shadow, and the status cache fed by the daemon's poller is
+served to and pushed to the clients.
+"""
+
+import os
+import math
+import struct
+import argparse
+import socketserver
+from threading import Thread, Lock, Event
+from concurrent.futures import Future
+from constants import ACTION_DICT, _decode_action
+from poller import MotorStatus
+from codec import *
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                              'sixpack.sock')
+
+# =============================================================================
+# Protocol: every message is HEADER (type, id, payload length) + payload.
+# Replies carry the id of the message they answer, pushed status updates 0.
+# =============================================================================
+
+HEADER = struct.Struct('<BIH')
+
+HELLO = 0x00        # -> REPLY num_motors, sixpack_addr, resp_addr
+FRAME = 0x01        # frame, timeout -> REPLY (reply frame of requests)
+BATCH = 0x02        # gap, frames -> REPLY (result per request)
+STATUS = 0x03       # -> REPLY status of all motors
+SUBSCRIBE = 0x04    # -> REPLY, then UPDATE whenever the status changes
+UNSUBSCRIBE = 0x05
+NEGOTIATE = 0x06    # baud rate, delay, persist -> REPLY (those in use)
+CAPTURE = 0x07      # path (empty: stop capturing) -> REPLY
+
+REPLY = 0x80
+ERROR = 0x81
+UPDATE = 0x82
+
+HELLO_REPLY = struct.Struct('<BBB')
+BAUDRATE = struct.Struct('<IBB')
+TIMEOUT = struct.Struct('<f')           # negative: default timeout
+MOTOR_STATUS = struct.Struct('<BihBddd')
+RESULT_OK = 0xFF
+
+# errors are transferred as (kind, message)
+ERRORS = [TimeoutError, UserWarning, ValueError, TypeError, RuntimeError]
+
+_ACTION_CODES = {name: code if isinstance(code, int) else code[0]
+                 for code, name in ACTION_DICT.items()}
+
+
+def encode_error(error):
+
+    kind = len(ERRORS) - 1
+    for i, cls in enumerate(ERRORS):
+        if isinstance(error, cls):
+            kind = i
+            break
+    message = str(error).encode('utf-8', 'replace')[:4096]
+
+    return bytes([kind]) + struct.pack('<H', len(message)) + message
+
+
+def decode_error(payload, offset=0):
+    """
+    Returns the exception encoded at offset and the offset behind it
+    """
+
+    kind = payload[offset]
+    length, = struct.unpack_from('<H', payload, offset + 1)
+    start = offset + 3
+    message = bytes(payload[start:start + length]).decode('utf-8')
+
+    return ERRORS[kind](message), start + length
+
+
+def encode_status(snapshot):
+
+    parts = []
+    for status in snapshot:
+        flags = ((status.position is not None)
+                 | (status.velocity is not None) << 1
+                 | (status.action is not None) << 2)
+        parts.append(MOTOR_STATUS.pack(
+            flags, status.position or 0, status.velocity or 0,
+            _ACTION_CODES.get(status.action, 0),
+            *(math.nan if t is None else t
+              for t in (status.position_time, status.velocity_time,
+                        status.action_time))))
+
+    return b''.join(parts)
+
+
+def decode_status(payload):
+
+    snapshot = []
+    for values in MOTOR_STATUS.iter_unpack(payload):
+        flags, position, velocity, action = values[:4]
+        times = [None if math.isnan(t) else t for t in values[4:]]
+        snapshot.append(MotorStatus(
+            position if flags & 1 else None,
+            velocity if flags & 2 else None,
+            _decode_action(action) if flags & 4 else None,
+            *times))
+
+    return tuple(snapshot)
+
+
+def recv_message(sock):
+    """
+    Reads one message, returns (type, id, payload) or None at EOF
+    """
+
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    kind, msg_id, length = HEADER.unpack(header)
+    payload = _recv_exactly(sock, length) if length else b''
+    if payload is None:
+        return None
+
+    return kind, msg_id, payload
+
+
+def _recv_exactly(sock, size):
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+
+    return buffer
+
+
+def pack_message(kind, msg_id, payload=b''):
+    return HEADER.pack(kind, msg_id, len(payload)) + payload
+
+
+# =============================================================================
+# Server
+# =============================================================================
+
+
+class _Connection(socketserver.BaseRequestHandler):
+    """
+    One client connection: frames are handed to the I/O worker without
+    waiting, replies are sent back as they complete
+    """
+
+    def setup(self):
+
+        self._send_lock = Lock()
+
+    def send(self, kind, msg_id, payload=b''):
+
+        message = pack_message(kind, msg_id, payload)
+        with self._send_lock:
+            try:
+                self.request.sendall(message)
+            except OSError:
+                pass
+
+        return None
+
+    def handle(self):
+
+        daemon = self.server.sixpack
+        try:
+            while True:
+                message = recv_message(self.request)
+                if message is None:
+                    break
+                kind, msg_id, payload = message
+                try:
+                    daemon.dispatch(self, kind, msg_id, payload)
+                except Exception as error:
+                    self.send(ERROR, msg_id, encode_error(error))
+        finally:
+            daemon.unsubscribe(self)
+
+        return None
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Sixpack2Daemon(object):
+    """
+    Serves a controller (with running I/O worker) on a Unix domain socket
+    """
+
+    def __init__(self, ctrl, path=DEFAULT_SOCKET, publish_rate=20.0):
+
+        self.ctrl = ctrl
+        self.path = path
+        self.period = 1.0 / publish_rate
+
+        if ctrl._worker is None:
+            ctrl.start_worker()
+
+        # replies updating the status cache and the shadow of the daemon
+        self._parsers = {GET_POS.opcode: self._parse_pos,
+                         GET_VEL.opcode: self._parse_vel,
+                         QUERY_ALL.opcode: ctrl._parse_query_all,
+                         GET_UNIT_INFO.opcode: ctrl._parse_unit_info}
+
+        self._subscribers = set()
+        self._subscribers_lock = Lock()
+        self._stopped = Event()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = _Server(path, _Connection)
+        self.server.sixpack = self
+
+    def _parse_pos(self, reply):
+        return self.ctrl[reply[2]]._parse_pos(reply)
+
+    def _parse_vel(self, reply):
+        return self.ctrl[reply[2]]._parse_vel(reply)
+
+    # ------------------------------------------------------------------------
+    # requests
+    # ------------------------------------------------------------------------
+
+    def dispatch(self, conn, kind, msg_id, payload):
+
+        ctrl = self.ctrl
+
+        if kind == HELLO:
+            conn.send(REPLY, msg_id, HELLO_REPLY.pack(
+                ctrl.num_motors, ctrl._sixpack_addr, ctrl._resp_addr))
+        elif kind == FRAME:
+            timeout, = TIMEOUT.unpack_from(payload, FRAME_LENGTH)
+            self._frame(conn, msg_id, bytes(payload[:FRAME_LENGTH]),
+                        None if timeout < 0 else timeout)
+        elif kind == BATCH:
+            gap, = TIMEOUT.unpack_from(payload)
+            frames = payload[TIMEOUT.size:]
+            self._batch(conn, msg_id, gap,
+                        [bytes(frames[i:i + FRAME_LENGTH])
+                         for i in range(0, len(frames), FRAME_LENGTH)])
+        elif kind == STATUS:
+            conn.send(REPLY, msg_id, encode_status(ctrl.status()))
+        elif kind == SUBSCRIBE:
+            with self._subscribers_lock:
+                self._subscribers.add(conn)
+            conn.send(REPLY, msg_id)
+        elif kind == UNSUBSCRIBE:
+            self.unsubscribe(conn)
+            conn.send(REPLY, msg_id)
+        elif kind == NEGOTIATE:
+            target, delay, persist = BAUDRATE.unpack(payload)
+            baudrate, delay = ctrl.negotiate_baudrate(target, delay,
+                                                      bool(persist))
+            conn.send(REPLY, msg_id, BAUDRATE.pack(baudrate, delay, persist))
+        elif kind == CAPTURE:
+            if payload:
+                ctrl.start_capture(bytes(payload).decode('utf-8'))
+            else:
+                ctrl.stop_capture()
+            conn.send(REPLY, msg_id)
+        else:
+            raise ValueError('unknown message type {:02X}'.format(kind))
+
+        return None
+
+    def _command(self, frame):
+        """
+        Command of a frame; None if it is a setting the PACK already holds
+        """
+
+        command = COMMANDS.get(frame[1])
+        if command is None:
+            raise ValueError('unknown command nr {:02X}'.format(frame[1]))
+
+        if command is COMPLETE_HWRESET:
+            # the PACK loses all settings, later ones are written again
+            self.ctrl.invalidate()
+        elif command.keys is not None:
+            params = command.unpack(frame)[2:]
+            with self.ctrl._encode_lock:
+                if not self.ctrl._record(command, params):
+                    return None
+
+        return command
+
+    def _frame(self, conn, msg_id, frame, timeout):
+
+        command = self._command(frame)
+        if command is None:
+            conn.send(REPLY, msg_id)
+            return None
+
+        request = command if command.is_request else None
+        future = self.ctrl._worker.submit(frame, request, timeout)
+
+        def done(future):
+            # every message is answered, even if the reply cannot be used
+            try:
+                reply = future.result()
+                if request is None:
+                    payload = b''
+                else:
+                    parser = self._parsers.get(request.opcode)
+                    if parser is not None:
+                        parser(reply)
+                    payload = request.reply.pack(*reply)
+            except Exception as error:
+                conn.send(ERROR, msg_id, encode_error(error))
+            else:
+                conn.send(REPLY, msg_id, payload)
+
+        future.add_done_callback(done)
+
+        return None
+
+    def _batch(self, conn, msg_id, gap, frames):
+
+        batch = []
+        for frame in frames:
+            command = self._command(frame)
+            if command is None:
+                continue
+            if command.is_request:
+                batch.append((frame, command, None, Future()))
+            else:
+                batch.append((frame, None, None, None))
+
+        # replies are reported for all requests, skipped settings are none
+        requests = [(request, future)
+                    for _, request, _, future in batch if request is not None]
+
+        def done(future):
+            try:
+                future.result()
+            except Exception as error:
+                conn.send(ERROR, msg_id, encode_error(error))
+                return
+            results = []
+            for request, reply in requests:
+                try:
+                    reply = reply.result()
+                    parser = self._parsers.get(request.opcode)
+                    if parser is not None:
+                        parser(reply)
+                    frame = request.reply.pack(*reply)
+                except Exception as error:
+                    results.append(encode_error(error))
+                else:
+                    results.append(bytes([RESULT_OK]) + frame)
+            conn.send(REPLY, msg_id, b''.join(results))
+
+        self.ctrl._worker.submit_batch(batch, gap).add_done_callback(done)
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # subscriptions
+    # ------------------------------------------------------------------------
+
+    def unsubscribe(self, conn):
+
+        with self._subscribers_lock:
+            self._subscribers.discard(conn)
+
+        return None
+
+    def _publish(self):
+
+        last = None
+        while not self._stopped.wait(self.period):
+            snapshot = self.ctrl.status()
+            if snapshot is last:
+                continue
+            last = snapshot
+            with self._subscribers_lock:
+                subscribers = list(self._subscribers)
+            if subscribers:
+                payload = encode_status(snapshot)
+                for conn in subscribers:
+                    conn.send(UPDATE, 0, payload)
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # running
+    # ------------------------------------------------------------------------
+
+    def start(self):
+        """
+        Serves from background threads
+        """
+
+        Thread(target=self._publish, name='Sixpack2DaemonPublisher',
+               daemon=True).start()
+        Thread(target=self.server.serve_forever, name='Sixpack2Daemon',
+               daemon=True).start()
+
+        return self
+
+    def serve_forever(self):
+
+        Thread(target=self._publish, name='Sixpack2DaemonPublisher',
+               daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+
+        self._stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        return None
+
+
+# =============================================================================
+# Command line
+# =============================================================================
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='sixpack-daemon',
+        description='share the serial port of a Sixpack2 between processes')
+    parser.add_argument('--port', default='/dev/ttySIXPACK',
+                        help='serial port of the PACK')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='path of the Unix domain socket (default: %('
+                             'default)s)')
+    parser.add_argument('--baudrate', type=int, default=19200)
+    parser.add_argument('--negotiate', type=int, metavar='BAUDRATE',
+                        help='switch PACK and port to this baud rate')
+    parser.add_argument('--num-motors', type=int, default=6)
+    parser.add_argument('--sixpack-addr', default='00')
+    parser.add_argument('--resp-addr', default='00')
+    parser.add_argument('--poll-rate', type=float, default=20.0,
+                        help='status polls per second (0: no polling)')
+    parser.add_argument('--simulate', action='store_true',
+                        help='serve a virtual PACK instead of --port')
+    args = parser.parse_args(argv)
+
+    from Sixpack2Controller import Sixpack2Controller
+
+    transport = None
+    if args.simulate:
+        from simulator import SimulatedSerial, VirtualSixpack2
+        transport = SimulatedSerial(VirtualSixpack2(
+            num_motors=args.num_motors), baudrate=args.baudrate)
+
+    ctrl = Sixpack2Controller(port=args.port, baudrate=args.baudrate,
+                              timeout=1.0, sixpack_addr=args.sixpack_addr,
+                              resp_addr=args.resp_addr,
+                              num_motors=args.num_motors,
+                              transport=transport)
+    if args.negotiate:
+        ctrl.negotiate_baudrate(args.negotiate)
+    ctrl.start_worker()
+    if args.poll_rate > 0:
+        ctrl.start_poller(rate=args.poll_rate)
+
+    daemon = Sixpack2Daemon(ctrl, args.socket,
+                            publish_rate=max(args.poll_rate, 1.0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ctrl.stop_poller()
+        ctrl.stop_worker()
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
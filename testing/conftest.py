@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Fixtures of the test suite: controllers talking to the virtual PACK of the
+simulator package instead of a serial port
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import pytest  # noqa: E402
+
+import portstate  # noqa: E402
+from codec import FRAME_LENGTH  # noqa: E402
+from simulator import Faults, SimulatedSerial  # noqa: E402
+from Sixpack2Controller import Sixpack2Controller  # noqa: E402
+
+
+class CountingSerial(SimulatedSerial):
+    """
+    SimulatedSerial keeping the written chunks; fail makes the next writes
+    raise OSError
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        SimulatedSerial.__init__(self, *args, **kwargs)
+        self.written = []
+        self.fail = False
+
+    def write(self, data):
+
+        if self.fail:
+            raise OSError('line down')
+        self.written.append(bytes(data))
+
+        return SimulatedSerial.write(self, data)
+
+    def frames(self):
+        """
+        Command numbers of the written frames
+        """
+
+        data = b''.join(self.written)
+
+        return [data[i + 1] for i in range(0, len(data), FRAME_LENGTH)]
+
+
+class DropReplies(Faults):
+    """
+    Loses the next count replies of the PACK
+    """
+
+    def __init__(self, count):
+
+        Faults.__init__(self)
+        self.count = count
+
+    def apply(self, reply):
+
+        if self.count:
+            self.count -= 1
+            return 0.0, b''
+
+        return 0.0, reply
+
+
+@pytest.fixture(autouse=True)
+def state_file(tmp_path, monkeypatch):
+    """
+    Keeps the per-port state of the tests out of the user's cache
+    """
+
+    path = str(tmp_path / 'ports.json')
+    monkeypatch.setattr(portstate, 'STATE_FILE', path)
+
+    return path
+
+
+@pytest.fixture
+def line():
+    return CountingSerial(timeout=0.5)
+
+
+@pytest.fixture
+def ctrl(line):
+
+    ctrl = Sixpack2Controller(transport=line, num_motors=3, timeout=0.5)
+    yield ctrl
+    ctrl.stop_poller()
+    ctrl.stop_worker()
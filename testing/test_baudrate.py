@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import asyncio
+
+import pytest
+
+from codec import GET_UNIT_INFO
+from constants import BAUDRATE_CLOCK
+from portstate import load_port_state
+from simulator import VirtualSixpack2
+from Sixpack2Controller import Sixpack2Controller
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from conftest import CountingSerial
+
+
+class SlowPack(VirtualSixpack2):
+    """
+    PACK whose UART does not work above 19200 baud: faster rates are
+    ignored
+    """
+
+    def _adjust_baudrate(self, baudratedivisor, transmitter_delay):
+
+        if BAUDRATE_CLOCK / baudratedivisor < 20000:
+            VirtualSixpack2._adjust_baudrate(self, baudratedivisor,
+                                             transmitter_delay)
+
+
+def _controller(device=None):
+
+    line = CountingSerial(device, timeout=0.5)
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.5)
+
+    return ctrl, line
+
+
+def test_negotiate_and_store():
+
+    ctrl, line = _controller()
+
+    baudrate, delay = ctrl.negotiate_baudrate(57600)
+
+    assert baudrate == 57600
+    assert 1 <= delay <= 3
+    assert line.baudrate == 57600
+    assert line.devices[0].baudrate == pytest.approx(57600, rel=0.04)
+    assert line.devices[0].transmitter_delay == delay
+    assert load_port_state(ctrl._port) == {'baudrate': 57600,
+                                           'transmitter_delay': delay}
+    ctrl[0].set_actualpos(5)
+    assert ctrl[0].get_pos()[0] == 5
+
+
+def test_finds_the_rate_of_the_pack():
+
+    device = VirtualSixpack2()
+    device.baudrate = 38400
+    ctrl, line = _controller(device)
+
+    assert ctrl.negotiate_baudrate(9600, persist=False)[0] == 9600
+    assert device.baudrate == pytest.approx(9600, rel=0.04)
+    assert load_port_state(ctrl._port) == {}
+
+
+def test_stored_rate_only_probes():
+
+    ctrl, line = _controller()
+    ctrl.negotiate_baudrate(38400)
+
+    # reconnect: the port opens at the power-on rate again
+    ctrl, line = _controller(line.devices[0])
+    del line.written[:]
+    assert ctrl.negotiate_baudrate(38400)[0] == 38400
+    assert set(line.frames()) == {GET_UNIT_INFO.opcode}
+
+
+def test_fall_back_to_the_previous_rate():
+
+    device = SlowPack()
+    ctrl, line = _controller(device)
+
+    baudrate, delay = ctrl.negotiate_baudrate(57600)
+
+    assert baudrate == 19200
+    assert line.baudrate == 19200
+    assert device.baudrate == pytest.approx(19200, rel=0.04)
+    assert ctrl.get_unit_info()[1] in (0, 1)
+
+
+def test_unsupported_rate():
+
+    ctrl, line = _controller()
+
+    with pytest.raises(ValueError):
+        ctrl.negotiate_baudrate(115200)
+    assert line.written == []
+
+
+def test_async_negotiate():
+
+    line = CountingSerial()
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line,
+                                           num_motors=1) as ctrl:
+            baudrate, _ = await ctrl.negotiate_baudrate(57600)
+            await ctrl[0].set_actualpos(9)
+            return baudrate, await ctrl[0].get_pos()
+
+    baudrate, pos = asyncio.run(main())
+
+    assert baudrate == line.baudrate == 57600
+    assert pos[0] == 9
+
+
+def test_async_probe_sees_a_reset():
+
+    line = CountingSerial()
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line,
+                                           num_motors=1) as ctrl:
+            await ctrl[0].set_peak_current(100)
+            # the PACK reports its reset to the first get_unit_info
+            await ctrl.negotiate_baudrate(19200)
+            await ctrl[0].set_peak_current(100)
+            return ctrl.suppressed
+
+    assert asyncio.run(main()) == 0
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import run  # noqa: E402
+from common import percentile, result  # noqa: E402
+
+
+def test_percentile():
+
+    samples = list(range(1, 101))
+
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 99) == 99
+    assert percentile(samples, 100) == 100
+    assert percentile([3], 90) == 3
+
+
+def test_compare_flags_regressions():
+
+    baseline = {'rate': result(1000.0, 'ops/s', 'higher'),
+                'latency': result(0.010, 'ms', 'lower'),
+                'skew': result(2.0, 'ms', 'lower'),
+                'gone': result(1.0, 'ms', 'lower')}
+    results = {'rate': result(800.0, 'ops/s', 'higher'),
+               'latency': result(0.012, 'ms', 'lower'),
+               'skew': result(1.0, 'ms', 'lower'),
+               'new': result(1.0, 'ms', 'lower')}
+
+    rows = {row[0]: row for row in run.compare(results, baseline, 0.1)}
+
+    assert sorted(rows) == ['latency', 'rate', 'skew']
+    assert rows['rate'][3] == 0.2 and rows['rate'][4]
+    # below the timer resolution
+    assert rows['latency'][3] == 0.0
+    assert rows['skew'][3] == -0.5 and not rows['skew'][4]
+
+
+def test_run_writes_and_compares_json(tmp_path, capsys):
+
+    path = str(tmp_path / 'results.json')
+
+    assert run.main(['--quick', 'codec', '-o', path]) == 0
+    with open(path) as f:
+        results = json.load(f)['results']
+    assert results['codec.codec_encode_frame']['unit'] == 'ops/s'
+
+    worse = {name: result(10 * res['value'], res['unit'], res['better'])
+             for name, res in results.items()}
+    with open(path, 'w') as f:
+        json.dump({'results': worse}, f)
+    assert run.main(['--quick', 'codec', '--compare', path]) == 1
+    assert 'REGRESSION' in capsys.readouterr().out
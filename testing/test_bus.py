@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import time
+
+import pytest
+
+from codec import GET_POS
+from simulator import VirtualSixpack2
+from Sixpack2Bus import Sixpack2Bus
+from Sixpack2Controller import Sixpack2Controller
+from conftest import CountingSerial
+
+
+@pytest.fixture
+def line():
+    return CountingSerial([VirtualSixpack2(address=0, num_motors=2),
+                           VirtualSixpack2(address=3, num_motors=1)],
+                          timeout=0.5)
+
+
+@pytest.fixture
+def bus(line):
+
+    bus = Sixpack2Bus(transport=line, timeout=0.5, units={0: 2, 3: 1})
+    yield bus
+    bus.close()
+
+
+def test_replies_are_routed_by_address(bus, line):
+
+    bus[0][1].set_actualpos(100)
+    bus[3][0].set_actualpos(300)
+
+    assert bus[0][1].get_pos()[0] == 100
+    assert bus[3][0].get_pos()[0] == 300
+    # each unit answers at its own response address
+    assert [chunk[3] for chunk in line.written[-2:]] == [0, 3]
+
+
+def test_units_take_turns(bus, line):
+
+    bus.start_worker()
+    with bus._io_lock:
+        futures = [bus[address].submit(GET_POS, 0, address)
+                   for address in (0, 0, 0, 3, 3, 3)]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert [chunk[0] for chunk in line.written] == [0, 3, 0, 3, 0, 3]
+
+
+def test_units_from_the_cache(line):
+
+    Sixpack2Controller(transport=line, num_motors=1,
+                       timeout=0.5).discover(range(5))
+    line.written.clear()
+
+    bus = Sixpack2Bus(transport=line, timeout=0.5)
+    try:
+        assert sorted(bus) == [0, 3]
+        assert len(bus[0]) == 2 and len(bus[3]) == 1
+        assert line.written == []
+    finally:
+        bus.close()
+
+
+def test_turnaround_after_a_reply(line):
+
+    bus = Sixpack2Bus(transport=line, timeout=0.5, units={0: 2},
+                      turnaround=0.05)
+    try:
+        bus[0][0].get_pos()
+        start = time.monotonic()
+        bus[0][0].set_actualpos(1)
+        assert time.monotonic() - start >= 0.04
+    finally:
+        bus.close()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import pytest
+
+from capture import RX, TX, ReplayTransport, read_capture
+from Sixpack2Controller import Sixpack2Controller
+
+
+def _session(ctrl):
+
+    ctrl[1].set_actualpos(1234)
+    with ctrl.transaction():
+        first = ctrl[0].get_pos()
+        second = ctrl[1].get_pos()
+
+    return first.result(), second.result(), ctrl.get_unit_info()
+
+
+def test_capture_and_replay(ctrl, tmp_path):
+
+    path = tmp_path / 'wire.cap'
+    ctrl.start_capture(path)
+    with pytest.raises(RuntimeError):
+        ctrl.start_capture(path)
+    recorded = _session(ctrl)
+    ctrl.stop_capture()
+
+    records = list(read_capture(path))
+    assert [direction for _, direction, _ in records[:2]] == [TX, TX]
+    assert b''.join(data for _, direction, data in records
+                    if direction == RX) != b''
+    assert all(t1 <= t2 for (t1, _, _), (t2, _, _)
+               in zip(records, records[1:]))
+
+    replay = ReplayTransport(path, speed=None, timeout=0.5)
+    copy = Sixpack2Controller(transport=replay, num_motors=3, timeout=0.5)
+
+    assert _session(copy) == recorded
+    assert replay.finished
+
+
+def test_replay_diverges(ctrl, tmp_path):
+
+    path = tmp_path / 'wire.cap'
+    ctrl.start_capture(path)
+    ctrl[0].set_actualpos(5)
+    ctrl.stop_capture()
+
+    copy = Sixpack2Controller(transport=ReplayTransport(path, speed=None),
+                              num_motors=3)
+
+    with pytest.raises(ValueError, match='diverged'):
+        copy[0].set_actualpos(6)
+
+
+def test_not_a_capture(tmp_path):
+
+    path = tmp_path / 'wire.cap'
+    path.write_bytes(b'garbage')
+
+    with pytest.raises(ValueError):
+        list(read_capture(path))
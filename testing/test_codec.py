@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import pickle
+import random
+
+import pytest
+
+from codec import (COMMANDS, FRAME_LENGTH, START_RAMP, SET_VELACC,
+                   WRITE_MOTOR_CHAR_TABLE, GET_POS, GET_UNIT_INFO, Reply,
+                   FrameBuffer)
+from constants import _encode_mask
+
+
+def _valid_params(command, rnd):
+
+    params = []
+    for _, lo, hi, allowed in command._limits:
+        if allowed is None:
+            params.append(rnd.choice((lo, hi - 1, rnd.randrange(lo, hi))))
+        else:
+            params.append(rnd.choice(sorted(allowed)))
+
+    return tuple(params)
+
+
+@pytest.mark.parametrize('command', sorted(COMMANDS.values(),
+                                           key=lambda c: c.opcode),
+                         ids=lambda c: c.name)
+def test_round_trip(command):
+
+    rnd = random.Random(command.opcode)
+    buffer = bytearray(FRAME_LENGTH)
+    for _ in range(20):
+        params = _valid_params(command, rnd)
+        command.pack_into(buffer, 0x12, *params)
+        assert command.pack(0x12, *params) == bytes(buffer)
+        assert command.unpack(buffer) == (0x12, command.opcode) + params
+
+
+@pytest.mark.parametrize('params', [(6, 0), (-1, 0), (0, 2**31)])
+def test_range_error(params):
+
+    with pytest.raises(ValueError):
+        START_RAMP.pack(0, *params)
+
+
+def test_allowed_values():
+
+    WRITE_MOTOR_CHAR_TABLE.pack(0, 4, 1, 2, 3, 4)
+    with pytest.raises(ValueError, match='table_pointer'):
+        WRITE_MOTOR_CHAR_TABLE.pack(0, 5, 1, 2, 3, 4)
+
+
+def test_parameter_errors():
+
+    with pytest.raises(ValueError, match='vmax'):
+        SET_VELACC.pack(0, 0, 100, 1000)
+    with pytest.raises(TypeError):
+        START_RAMP.pack(0, 0, '1')
+    with pytest.raises(TypeError):
+        START_RAMP.pack(0, 0)
+    with pytest.raises(TypeError):
+        START_RAMP.pack(0, 0, 1, 2)
+    with pytest.raises(TypeError, match='takes 2 parameters'):
+        START_RAMP.check((0,))
+
+
+def test_encode_mask():
+
+    assert _encode_mask('101101') == '2D'
+    with pytest.raises(ValueError, match='ambiguous'):
+        _encode_mask('1000000')
+    with pytest.raises(TypeError, match='string'):
+        _encode_mask(45)
+
+
+def test_real_numbers_are_truncated():
+
+    assert SET_VELACC.pack(0, 1, 100.0, 300) == SET_VELACC.pack(0, 1, 100,
+                                                                300)
+    assert START_RAMP.pack(0, 1, -1000.7) == START_RAMP.pack(0, 1, -1000)
+    with pytest.raises(ValueError):
+        START_RAMP.pack(0, 1, 2.0**31)
+
+
+def test_numpy_scalars():
+
+    np = pytest.importorskip('numpy')
+
+    assert (START_RAMP.pack(0, np.int64(1), np.float64(2.5))
+            == START_RAMP.pack(0, 1, 2))
+
+
+def test_reply_round_trip():
+
+    frame = GET_POS.reply.pack(0x12, GET_POS.opcode, 3, -1000, 1, 2)
+    buffer = bytearray(b'xx' + frame)
+
+    reply = GET_POS.unpack_reply(memoryview(buffer), 2)
+
+    assert isinstance(reply, Reply)
+    assert reply == (0x12, GET_POS.opcode, 3, -1000, 1, 2)
+    assert (reply.motno, reply.position, reply.stop_status) == (3, -1000, 2)
+    assert reply.action == 1
+    assert pickle.loads(pickle.dumps(reply)) == reply
+    assert type(pickle.loads(pickle.dumps(reply))) is type(reply)
+    with pytest.raises(AttributeError, match='get_pos reply has no'):
+        reply.firmware
+
+    info = GET_UNIT_INFO.unpack_reply(
+        GET_UNIT_INFO.reply.pack(0, GET_UNIT_INFO.opcode, 21, 1, 30, 77))
+    assert (info.firmware, info.reset_flag, info.serial) == (21, 1, 77)
+
+
+def test_frame_buffer_skips_garbage():
+
+    request = GET_POS.pack(0x12, 1, 0x34)
+    prefix = GET_POS.reply_prefix(request)
+    other = GET_POS.reply.pack(0x34, GET_POS.opcode, 0, 5, 0, 0)
+    reply = GET_POS.reply.pack(0x34, GET_POS.opcode, 1, 7, 0, 0)
+
+    rx = FrameBuffer(capacity=4 * FRAME_LENGTH)
+    rx.feed(b'\x00\xff' + other + reply[:3])
+    assert rx.take(GET_POS, prefix) is None
+    rx.feed(reply[3:])
+
+    assert rx.take(GET_POS, prefix) == GET_POS.unpack_reply(reply)
+    assert rx.discarded == 2 + FRAME_LENGTH
+    assert len(rx) == 0
+
+
+def test_frame_buffer_overflow():
+
+    rx = FrameBuffer(capacity=2 * FRAME_LENGTH)
+    rx.feed(bytes(3 * FRAME_LENGTH))
+
+    assert len(rx) == 2 * FRAME_LENGTH
+    assert rx.discarded == FRAME_LENGTH
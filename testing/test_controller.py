@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+import time
+import asyncio
+
+import pytest
+
+from codec import (QUERY_ALL, SET_PEAK_CURRENT, SET_TARGETPOS, START_RAMP,
+                   GET_POS, START_PARALLEL_RAMP, SET_VELACC, GET_UNIT_INFO)
+from constants import (DEFAULT_WAIT_TIMEOUT, WAIT_TIMEOUT_FACTOR,
+                       WAIT_TIMEOUT_MARGIN)
+from simulator import Faults
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from Sixpack2Controller import Sixpack2Controller
+from conftest import CountingSerial, DropReplies
+
+
+def _fast_ramps(ctrl):
+    """
+    Ramp settings under which short moves take a few tenths of a second
+    """
+
+    ctrl.set_velocity(5)
+    for motor in ctrl:
+        motor.set_startvel(1, 10, 0)
+        motor.set_velacc(1000, 300)
+
+
+# =============================================================================
+# Transactions
+# =============================================================================
+
+
+def test_transaction_single_write(ctrl, line):
+
+    with ctrl.transaction():
+        ctrl[1].set_targetpos(500)
+        ctrl[2].set_targetpos(-500)
+        ctrl.start_parallel_ramp('110')
+        pos = ctrl[1].get_pos()
+        assert not pos.done()
+
+    assert len(line.written) == 1
+    assert line.frames() == [SET_TARGETPOS.opcode, SET_TARGETPOS.opcode,
+                             START_PARALLEL_RAMP.opcode, GET_POS.opcode]
+    assert pos.result()[1] == 'ramping'
+
+
+def test_transaction_gap(ctrl, line):
+
+    with ctrl.transaction(gap=0.001):
+        ctrl[0].set_targetpos(10)
+        ctrl[1].set_targetpos(20)
+
+    assert len(line.written) == 2
+
+
+def test_transaction_discarded_on_error(ctrl, line):
+
+    with pytest.raises(KeyError):
+        with ctrl.transaction():
+            ctrl[0].set_peak_current(50)
+            raise KeyError
+
+    assert line.written == []
+    ctrl[0].set_peak_current(50)
+    assert line.frames() == [SET_PEAK_CURRENT.opcode]
+
+
+def test_nested_transactions(ctrl, line):
+
+    with ctrl.transaction():
+        ctrl[0].set_targetpos(10)
+        with ctrl.transaction():
+            ctrl[1].set_targetpos(20)
+        assert line.written == []
+
+    assert len(line.written) == 1
+
+
+def test_missing_reply_fails_the_remaining_requests():
+
+    line = CountingSerial(faults=DropReplies(2))
+    ctrl = Sixpack2Controller(transport=line, num_motors=2, timeout=0.1)
+    ctrl.retries = 0
+    with ctrl.transaction():
+        first = ctrl[0].get_pos()
+        second = ctrl[1].get_pos()
+
+    with pytest.raises(TimeoutError):
+        first.result()
+    with pytest.raises(TimeoutError):
+        second.result()
+
+
+# =============================================================================
+# Parameter shadow
+# =============================================================================
+
+
+def test_shadow_suppresses_repeated_settings(ctrl, line):
+
+    for _ in range(3):
+        ctrl[0].set_peak_current(100)
+        ctrl[0].set_velacc(100, 300)
+
+    assert len(line.written) == 2
+    assert ctrl.suppressed == 4
+
+    ctrl[0].set_peak_current(101)
+    assert len(line.written) == 3
+
+
+def test_shadow_disabled(ctrl, line):
+
+    ctrl.shadow = False
+    ctrl[0].set_peak_current(100)
+    ctrl[0].set_peak_current(100)
+
+    assert len(line.written) == 2
+
+
+def test_invalidate(ctrl, line):
+
+    ctrl[0].set_peak_current(100)
+    ctrl[1].set_peak_current(100)
+    ctrl.invalidate(0)
+    ctrl[0].set_peak_current(100)
+    ctrl[1].set_peak_current(100)
+
+    assert len(line.written) == 3
+
+
+def test_hwreset_invalidates_and_resync(ctrl, line):
+
+    ctrl[0].set_peak_current(100)
+    ctrl[1].set_velacc(100, 300)
+    ctrl.complete_hwreset()
+    del line.written[:]
+
+    assert ctrl.resync() == 2
+    assert sorted(line.frames()) == [SET_PEAK_CURRENT.opcode,
+                                     SET_VELACC.opcode]
+    assert ctrl.resync() == 0
+
+
+def test_forget_on_write_failure(ctrl, line):
+
+    ctrl[0].set_peak_current(10)
+    line.fail = True
+    with pytest.raises(OSError):
+        ctrl[0].set_peak_current(20)
+    with pytest.raises(OSError):
+        with ctrl.transaction():
+            ctrl[1].set_peak_current(20)
+    line.fail = False
+
+    suppressed = ctrl.suppressed
+    ctrl[0].set_peak_current(20)
+    ctrl[1].set_peak_current(20)
+    assert ctrl.suppressed == suppressed
+    assert len(line.written) == 3
+
+
+def test_async_forget_on_write_failure():
+
+    async def main():
+        line = CountingSerial()
+        ctrl = AsyncSixpack2Controller(transport=line, num_motors=2)
+        async with ctrl:
+            # an awaitable that is never awaited does not count as sent
+            ctrl[0].set_peak_current(5).close()
+            await ctrl[0].set_peak_current(5)
+            assert ctrl.suppressed == 0
+            await ctrl[0].set_peak_current(5)
+            assert ctrl.suppressed == 1
+
+            line.fail = True
+            with pytest.raises(OSError):
+                await ctrl[0].set_peak_current(6)
+            with pytest.raises(OSError):
+                async with ctrl.transaction():
+                    ctrl[1].set_peak_current(6)
+            line.fail = False
+
+            await ctrl[0].set_peak_current(6)
+            await ctrl[1].set_peak_current(6)
+            assert ctrl.suppressed == 1
+
+    asyncio.run(main())
+
+
+# =============================================================================
+# Frame synchronization
+# =============================================================================
+
+
+def test_resync_after_garbage():
+
+    line = CountingSerial(faults=Faults(garbage=1.0, seed=1), timeout=0.5)
+    ctrl = Sixpack2Controller(transport=line, num_motors=2, timeout=0.5)
+    ctrl.enable_metrics()
+    ctrl.set_velocity(5)
+    ctrl[0].set_actualpos(1000)
+    ctrl[1].set_actualpos(-1000)
+
+    for _ in range(10):
+        assert ctrl[0].get_pos()[0] == 1000
+        assert ctrl[1].get_pos()[0] == -1000
+
+    assert ctrl.metrics()['get_pos']['discarded'] > 0
+    assert ctrl.metrics()['get_pos']['timeouts'] == 0
+
+
+def test_late_reply_is_skipped():
+
+    faults = Faults(late_reply=1.0, late_delay=0.3)
+    line = CountingSerial(faults=faults)
+    ctrl = Sixpack2Controller(transport=line, num_motors=2, timeout=0.1)
+    ctrl.retries = 0
+    ctrl[0].set_actualpos(1)
+    ctrl[1].set_actualpos(2)
+
+    with pytest.raises(TimeoutError):
+        ctrl[0].get_pos()
+    faults.late_reply = 0.0
+    time.sleep(0.3)
+    # the late reply of motor 0 is not taken for the one of motor 1
+    assert ctrl[1].get_pos()[0] == 2
+
+
+# =============================================================================
+# Retries and timeouts
+# =============================================================================
+
+
+def test_retry_idempotent_request():
+
+    faults = DropReplies(2)
+    line = CountingSerial(faults=faults)
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.05)
+
+    assert ctrl[0].get_pos()[1] == 'inactive'
+    assert line.frames() == 3 * [GET_POS.opcode]
+
+
+def test_transaction_repeats_missing_replies():
+
+    line = CountingSerial(faults=DropReplies(2))
+    ctrl = Sixpack2Controller(transport=line, num_motors=2, timeout=0.05)
+    with ctrl.transaction():
+        first = ctrl[0].get_pos()
+        second = ctrl[1].get_pos()
+
+    assert first.result()[1] == second.result()[1] == 'inactive'
+    assert line.frames() == 4 * [GET_POS.opcode]
+
+
+def test_timeout_after_retries():
+
+    line = CountingSerial(faults=DropReplies(100))
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.05)
+
+    with pytest.raises(TimeoutError):
+        ctrl[0].get_pos()
+    assert len(line.written) == 1 + ctrl.retries
+
+
+def test_get_unit_info_not_repeated():
+
+    line = CountingSerial(faults=DropReplies(1))
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.05)
+
+    with pytest.raises(TimeoutError):
+        ctrl.get_unit_info()
+    assert line.frames() == [GET_UNIT_INFO.opcode]
+
+
+def test_adaptive_timeout_detects_missing_pack():
+
+    line = CountingSerial(faults=DropReplies(100))
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=None)
+    ctrl.retries = 0
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        ctrl[0].get_pos()
+    assert time.monotonic() - start < 0.5
+
+
+def _delayed_query_all(ctrl):
+
+    ctrl.query_all()
+    before = ctrl.round_trip_times()['query_all']['timeout']
+    ctrl[0].start_ramp(2000)
+    start = time.monotonic()
+    status = ctrl.query_all('001')
+    elapsed = time.monotonic() - start
+
+    return status, elapsed, before
+
+
+def test_delayed_query_all_waits_for_the_move():
+
+    line = CountingSerial()
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=None)
+    _fast_ramps(ctrl)
+
+    status, elapsed, before = _delayed_query_all(ctrl)
+
+    # far longer than the adaptive timeout of query_all, which does not
+    # grow from waiting for the motors
+    assert elapsed > 2 * before
+    assert status['motor0']['action'] == 'inactive'
+    assert ctrl.round_trip_times()['query_all']['timeout'] == before
+    assert ctrl[0].get_pos()[0] == 2000
+
+
+def test_async_delayed_query_all_waits_for_the_move():
+
+    async def main():
+        ctrl = AsyncSixpack2Controller(transport=CountingSerial(),
+                                       num_motors=1, timeout=None)
+        async with ctrl:
+            await ctrl.set_velocity(5)
+            await ctrl[0].set_startvel(1, 10, 0)
+            await ctrl[0].set_velacc(1000, 300)
+            await ctrl.query_all()
+            before = ctrl.round_trip_times()['query_all']['timeout']
+            await ctrl[0].start_ramp(2000)
+            start = time.monotonic()
+            status = await ctrl.query_all('001')
+            elapsed = time.monotonic() - start
+
+            assert elapsed > 2 * before
+            assert status['motor0']['action'] == 'inactive'
+            assert ctrl.round_trip_times()['query_all']['timeout'] == before
+
+    asyncio.run(main())
+
+
+def test_long_wait_after_short_requests():
+
+    line = CountingSerial()
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=None)
+    _fast_ramps(ctrl)
+    # the round trip estimate learns the short replies of the simulator
+    for _ in range(20):
+        ctrl.query_all()
+        ctrl[0].get_pos()
+    assert ctrl.round_trip_times()['query_all']['timeout'] < 0.2
+
+    ctrl[0].start_ramp(6000)
+    start = time.monotonic()
+    status = ctrl.wait_until_idle('001')
+
+    assert time.monotonic() - start > 0.5
+    assert status['motor0']['action'] == 'inactive'
+    assert ctrl[0].get_pos()[0] == 6000
+
+
+# =============================================================================
+# Status cache
+# =============================================================================
+
+
+def test_status_snapshot(ctrl, line):
+
+    ctrl[1].set_actualpos(42)
+    before = ctrl.status()
+    ctrl[1].get_pos()
+    after = ctrl.status()
+
+    assert before[1].position is None
+    assert after[1].position == 42
+    assert after[1].action == 'inactive'
+    assert after[1].position_time <= time.monotonic()
+    assert after[1].velocity_time is None
+    assert after[0] is before[0]
+
+
+def test_max_age(ctrl, line):
+
+    ctrl[0].set_actualpos(42)
+    del line.written[:]
+
+    assert ctrl[0].position() == 42
+    assert ctrl[0].position(max_age=10) == 42
+    assert len(line.written) == 1
+    time.sleep(0.02)
+    assert ctrl[0].position(max_age=0.01) == 42
+    assert len(line.written) == 2
+
+
+def test_poller_refreshes_the_cache(ctrl, line):
+
+    for motor in ctrl:
+        motor.set_actualpos(7)
+    poller = ctrl.start_poller(rate=100, motors=ctrl[:2])
+    with pytest.raises(RuntimeError):
+        ctrl.start_poller()
+    deadline = time.monotonic() + 2
+    while poller.cycles < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ctrl.stop_poller()
+
+    assert not poller.is_alive()
+    assert poller.errors == 0
+    assert [(status.position, status.velocity)
+            for status in ctrl.status()] == [(7, 0), (7, 0), (None, None)]
+    # served from the cache
+    written = len(line.written)
+    assert ctrl[1].velocity(max_age=10) == 0
+    assert len(line.written) == written
+
+
+def test_poller_counts_errors():
+
+    line = CountingSerial(faults=DropReplies(1000))
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.01)
+    poller = ctrl.start_poller(rate=100)
+    deadline = time.monotonic() + 2
+    while poller.errors < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ctrl.stop_poller()
+
+    assert poller.errors >= 2
+    assert isinstance(poller.last_error, TimeoutError)
+
+
+# =============================================================================
+# Waiting for motors
+# =============================================================================
+
+
+def test_wait_until_reached_sends_one_delayed_query(ctrl, line):
+
+    status = ctrl.wait_until_reached([ctrl[0], ctrl[2]])
+
+    assert line.written == [QUERY_ALL.pack(0, 0, 0b101)]
+    assert status['motor2']['action'] == 'inactive'
+
+
+def test_wait_until_idle_waits_for_the_move(ctrl, line):
+
+    _fast_ramps(ctrl)
+    ctrl[0].get_pos()
+    ctrl[0].start_ramp(1000)
+    start = time.monotonic()
+    ctrl.wait_until_idle('1')
+    elapsed = time.monotonic() - start
+
+    assert elapsed == pytest.approx(
+        ctrl[0].predicted_move_time(1000, startpos=0), abs=0.1)
+    assert ctrl[0].get_pos()[:2] == (1000, 'inactive')
+
+
+def test_wait_until_idle_timeout(ctrl, line):
+
+    _fast_ramps(ctrl)
+    ctrl[0].rotate(100)
+
+    with pytest.raises(TimeoutError):
+        ctrl.wait_until_idle('1', timeout=0.2)
+    ctrl.stop_motors()
+
+
+def test_predicted_move_time(ctrl, line):
+
+    _fast_ramps(ctrl)
+    # 300 internal units at clkdiv 5
+    vmax = 16e6 * 300 / (2**5 * 2048 * 32)
+
+    assert ctrl[0].predicted_move_time(1000) is None
+    short = ctrl[0].predicted_move_time(2000, startpos=0)
+    longer = ctrl[0].predicted_move_time(6000, startpos=2000)
+    # both reach vmax, the longer move cruises 2000 steps more
+    assert longer - short == pytest.approx(2000 / vmax, rel=1e-3)
+    assert ctrl[0].predicted_move_time(0, startpos=2000) == short
+
+
+def test_wait_timeout_from_predicted_move(ctrl, line):
+
+    _fast_ramps(ctrl)
+    ctrl[0].get_pos()
+    ctrl[0].start_ramp(2000)
+    duration = ctrl[0].predicted_move_time(2000, startpos=0)
+
+    assert ctrl._wait_timeout([ctrl[0]]) == pytest.approx(
+        WAIT_TIMEOUT_FACTOR * duration + WAIT_TIMEOUT_MARGIN, abs=0.05)
+    assert ctrl._wait_timeout([ctrl[1]]) == DEFAULT_WAIT_TIMEOUT
+    ctrl.stop_motors('1')
+    assert ctrl._wait_timeout([ctrl[0]]) == DEFAULT_WAIT_TIMEOUT
+
+
+# =============================================================================
+# asyncio
+# =============================================================================
+
+
+def test_async_requests():
+
+    line = CountingSerial()
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line,
+                                           num_motors=2) as ctrl:
+            await ctrl[1].set_actualpos(1234)
+            await ctrl[1].start_ramp(1234)
+            return await ctrl[1].get_pos()
+
+    assert asyncio.run(main()) == (1234, 'inactive', 0)
+    assert line.frames()[1:] == [START_RAMP.opcode, GET_POS.opcode]
+
+
+def test_async_transaction():
+
+    line = CountingSerial()
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line,
+                                           num_motors=2) as ctrl:
+            async with ctrl.transaction():
+                ctrl[0].set_targetpos(10)
+                ctrl[1].start_ramp(20)
+                pos = ctrl[1].get_pos()
+            return await pos
+
+    assert asyncio.run(main())[1] == 'ramping'
+    assert len(line.written) == 1
+
+
+def test_async_timeout():
+
+    async def main():
+        async with AsyncSixpack2Controller(
+                transport=CountingSerial(faults=DropReplies(100)),
+                num_motors=1, timeout=0.05) as ctrl:
+            await ctrl[0].get_pos()
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(main())
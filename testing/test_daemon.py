@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import time
+from threading import Event
+
+import pytest
+
+from capture import TX, read_capture
+from codec import (COMPLETE_HWRESET, FRAME_LENGTH, GET_POS,
+                   SET_PEAK_CURRENT)
+from constants import DAEMON_TIMEOUT_MARGIN
+from sixpack_daemon import FRAME, Sixpack2Daemon
+from Sixpack2Client import Sixpack2Client
+
+
+@pytest.fixture
+def daemon(ctrl, tmp_path):
+
+    daemon = Sixpack2Daemon(ctrl, str(tmp_path / 'sixpack.sock'),
+                            publish_rate=100).start()
+    yield daemon
+    daemon.stop()
+
+
+@pytest.fixture
+def client(daemon):
+
+    client = Sixpack2Client(daemon.path, timeout=0.5)
+    yield client
+    client.close()
+
+
+def test_hello(client, ctrl):
+
+    assert client.num_motors == ctrl.num_motors == 3
+    assert len(client) == 3
+
+
+def test_requests_through_the_daemon(client, line):
+
+    client[1].set_actualpos(1234)
+
+    assert client[1].get_pos()[:2] == (1234, 'inactive')
+    assert line.frames()[-1] == GET_POS.opcode
+
+
+def test_transaction(client, line):
+
+    with client.transaction():
+        first = client[0].get_pos()
+        second = client[2].get_pos()
+        client[1].set_actualpos(7)
+
+    assert first.result()[0] == second.result()[0] == 0
+    assert len(line.written) == 1
+    assert client[1].get_pos()[0] == 7
+
+
+def test_shadow_shared_by_clients(daemon, client, ctrl, line):
+
+    other = Sixpack2Client(daemon.path, timeout=0.5)
+    try:
+        client[0].set_peak_current(100)
+        other[0].set_peak_current(100)
+        with other.transaction():
+            other[0].set_peak_current(100)
+    finally:
+        other.close()
+
+    assert line.frames() == [SET_PEAK_CURRENT.opcode]
+    assert ctrl.suppressed == 2
+
+
+def test_hwreset_invalidates_the_shadow(client, ctrl, line):
+
+    client[0].set_peak_current(100)
+    client.complete_hwreset()
+    client[0].set_peak_current(100)
+    with client.transaction():
+        client[1].set_peak_current(100)
+        client.complete_hwreset()
+        client[1].set_peak_current(100)
+
+    assert line.frames() == [SET_PEAK_CURRENT.opcode, COMPLETE_HWRESET.opcode,
+                             SET_PEAK_CURRENT.opcode, SET_PEAK_CURRENT.opcode,
+                             COMPLETE_HWRESET.opcode,
+                             SET_PEAK_CURRENT.opcode]
+    assert ctrl.suppressed == 0
+
+
+def test_reset_flag_invalidates_the_shadow(client, ctrl, line):
+
+    client[0].set_peak_current(100)
+    # the PACK reports its reset to the first get_unit_info
+    assert client.get_unit_info()[1] == 1
+    client[0].set_peak_current(100)
+    assert client.get_unit_info()[1] == 0
+    client[0].set_peak_current(100)
+
+    assert line.frames().count(SET_PEAK_CURRENT.opcode) == 2
+    assert ctrl.suppressed == 1
+
+
+def test_errors_are_transferred(client):
+
+    frame = bytes(FRAME_LENGTH)
+
+    with pytest.raises(ValueError, match='unknown command'):
+        client._call(FRAME, frame[:1] + b'\xee' + frame[2:]
+                     + client._timeout(None)).result(timeout=5)
+
+
+def test_failing_replies_are_answered(daemon, client):
+
+    def fail(reply):
+        raise ValueError('cannot use reply')
+
+    daemon._parsers[GET_POS.opcode] = fail
+
+    with pytest.raises(ValueError, match='cannot use'):
+        client[0].get_pos()
+    with client.transaction():
+        pos = client[1].get_pos()
+    with pytest.raises(ValueError, match='cannot use'):
+        pos.result(timeout=5)
+
+
+def test_silent_daemon(daemon, client, monkeypatch):
+
+    monkeypatch.setattr(daemon, '_frame', lambda *args: None)
+    client.retries = 0
+    start = time.monotonic()
+
+    with pytest.raises(TimeoutError, match='no answer'):
+        client[0].get_pos()
+    assert time.monotonic() - start < 0.5 + DAEMON_TIMEOUT_MARGIN + 0.5
+    assert client._pending == {}
+
+
+def test_status_is_pushed(client):
+
+    updated = Event()
+    client.subscribe(lambda snapshot: snapshot[2].position == 42
+                     and updated.set())
+    client[2].set_actualpos(42)
+    client[2].get_pos()
+
+    assert updated.wait(5)
+    assert client.status()[2].position == 42
+
+
+def test_capture_by_the_daemon(client, tmp_path):
+
+    path = tmp_path / 'wire.cap'
+    client.start_capture(path)
+    client[0].get_pos()
+    client.stop_capture()
+
+    records = list(read_capture(path))
+    assert records[0][1] == TX
+    assert records[0][2][1] == GET_POS.opcode
+
+
+def test_negotiate_by_the_daemon(client, line):
+
+    start = time.monotonic()
+
+    assert client.negotiate_baudrate(57600)[0] == 57600
+    assert line.baudrate == 57600
+    assert time.monotonic() - start < 5
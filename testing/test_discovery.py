@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import os
+import asyncio
+
+import pytest
+
+from codec import GET_POS, GET_UNIT_INFO, SET_PEAK_CURRENT
+from portstate import clear_port_state, load_port_state, save_port_state
+from simulator import VirtualSixpack2
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from Sixpack2Controller import Sixpack2Controller
+from conftest import CountingSerial
+
+
+def _units():
+    return [VirtualSixpack2(address=0, num_motors=2),
+            VirtualSixpack2(address=3, num_motors=1, serial_number=42)]
+
+
+def test_several_units_answer_by_address():
+
+    line = CountingSerial(_units())
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.5)
+
+    units = ctrl.discover(range(5))
+
+    assert [(u['address'], u['num_motors']) for u in units] == [(0, 2),
+                                                                (3, 1)]
+    assert units[1]['serial'] == 42
+    assert units[0]['reset_flag'] == 1
+
+
+def test_num_motors_from_the_cache():
+
+    Sixpack2Controller(transport=CountingSerial(_units()), num_motors=1,
+                       timeout=0.5).discover(range(5))
+
+    line = CountingSerial(_units())
+    ctrl = Sixpack2Controller(transport=line, sixpack_addr='03',
+                              num_motors=None, timeout=0.5)
+
+    assert len(ctrl) == 1
+    assert line.written == []
+
+
+def test_unknown_unit_is_probed():
+
+    line = CountingSerial(_units())
+    ctrl = Sixpack2Controller(transport=line, num_motors=None, timeout=0.5)
+
+    assert len(ctrl) == 2
+    assert line.frames()[0] == GET_UNIT_INFO.opcode
+    assert set(line.frames()[1:]) == {GET_POS.opcode}
+
+    with pytest.raises(TimeoutError):
+        Sixpack2Controller(transport=CountingSerial(_units()),
+                           sixpack_addr='07', num_motors=None, timeout=0.5)
+
+
+def test_lazy_port_is_opened_by_the_first_frame():
+
+    line = CountingSerial()
+    line.close()
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.5,
+                              lazy=True)
+
+    assert not line.is_open
+    ctrl[0].get_pos()
+    assert line.is_open
+
+
+def test_reset_flag_invalidates_the_shadow(line):
+
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.5)
+    ctrl[0].set_peak_current(100)
+    ctrl.discover([0])
+    ctrl[0].set_peak_current(100)
+
+    assert line.frames().count(SET_PEAK_CURRENT.opcode) == 2
+    assert ctrl.suppressed == 0
+
+
+def test_async_discover():
+
+    line = CountingSerial(_units())
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line,
+                                           num_motors=1) as ctrl:
+            return await ctrl.discover(range(5))
+
+    units = asyncio.run(main())
+
+    assert [(u['address'], u['num_motors']) for u in units] == [(0, 2),
+                                                                (3, 1)]
+    ctrl = AsyncSixpack2Controller(transport=CountingSerial(_units()),
+                                   sixpack_addr='03', num_motors=None)
+    assert len(ctrl) == 1
+    with pytest.raises(RuntimeError, match='await discover'):
+        AsyncSixpack2Controller(transport=CountingSerial(_units()),
+                                sixpack_addr='07', num_motors=None)
+
+
+def test_clear_port_state_replaces_the_file(state_file, monkeypatch):
+
+    save_port_state('/dev/ttyA', units={'3': 1}, baudrate=115200)
+    save_port_state('/dev/ttyB', baudrate=9600)
+    replaced = []
+    replace = os.replace
+    monkeypatch.setattr(os, 'replace', lambda src, dst: (
+        replaced.append(dst), replace(src, dst)))
+
+    clear_port_state('/dev/ttyA', 'units')
+    assert load_port_state('/dev/ttyA') == {'baudrate': 115200}
+    clear_port_state('/dev/ttyB')
+    assert load_port_state('/dev/ttyB') == {}
+
+    assert replaced == [state_file, state_file]
+    assert not os.path.exists(state_file + '.tmp')
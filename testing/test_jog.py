@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import time
+
+import pytest
+
+from codec import ROTATE, STOP_MOTORS
+
+
+def _until(condition, timeout=5):
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+    return None
+
+
+def test_latest_value_wins(ctrl, line):
+
+    # one rotate frame every 0.47 s at 19200 baud
+    jog = ctrl[0].jog(share=0.01, timeout=5)
+    jog.set(1)
+    _until(lambda: jog.sent == 1)
+    for rotvel in range(2, 11):
+        jog.set(rotvel)
+    _until(lambda: jog.sent == 2)
+    jog.close()
+
+    assert line.written == [ROTATE.pack(0, 0, 1), ROTATE.pack(0, 0, 10),
+                            STOP_MOTORS.pack(0, 1)]
+    assert jog.coalesced == 8
+    assert jog.error is None
+
+
+def test_unchanged_value_is_not_resent(ctrl, line):
+
+    with ctrl[1].jog(timeout=5) as jog:
+        jog.set(-3)
+        _until(lambda: jog.sent == 1)
+        jog.set(-3)
+        time.sleep(0.05)
+
+    assert jog.sent == 1
+    assert line.frames() == [ROTATE.opcode, STOP_MOTORS.opcode]
+
+
+def test_timeout_stops_the_motor(ctrl, line):
+
+    with ctrl[0].jog(timeout=0.1) as jog:
+        jog.set(5)
+        _until(lambda: jog.timeouts == 1)
+        assert line.frames() == [ROTATE.opcode, STOP_MOTORS.opcode]
+        # the next value starts the motor again
+        jog.set(5)
+        _until(lambda: jog.sent == 2)
+
+    assert line.frames()[2:] == [ROTATE.opcode, STOP_MOTORS.opcode]
+    assert ctrl[0].get_pos()[1] == 'inactive'
+
+
+def test_invalid_jogs(ctrl):
+
+    with pytest.raises(ValueError):
+        ctrl[0].jog(share=0)
+    with pytest.raises(ValueError):
+        ctrl[0].jog(timeout=0)
+
+    jog = ctrl[0].jog()
+    with pytest.raises(ValueError):
+        jog.set(1 << 20)
+    jog.close()
+    with pytest.raises(RuntimeError, match='closed'):
+        jog.set(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from urllib.request import urlopen
+
+from codec import FRAME_LENGTH
+from metrics import Metrics, prometheus_text, start_http_exporter
+from Sixpack2Controller import Sixpack2Controller
+from conftest import CountingSerial, DropReplies
+
+
+def test_counts_per_command(ctrl, line):
+
+    calls = []
+    ctrl.enable_metrics(before=[lambda frame: calls.append(frame[1])])
+    ctrl[0].set_peak_current(100)
+    ctrl[0].set_peak_current(100)
+    ctrl[0].get_pos()
+    with ctrl.transaction():
+        ctrl[1].get_pos()
+        ctrl[2].get_pos()
+
+    snapshot = ctrl.metrics()
+    assert snapshot['set_peak_current']['frames'] == 1
+    assert snapshot['set_peak_current']['suppressed'] == 1
+    assert snapshot['set_peak_current']['replies'] == 0
+    get_pos = snapshot['get_pos']
+    assert get_pos['frames'] == get_pos['replies'] == 3
+    assert get_pos['bytes_sent'] == 3 * FRAME_LENGTH
+    assert get_pos['bytes_received'] == 3 * FRAME_LENGTH
+    assert sum(get_pos['rtt_buckets']) == 3
+    assert len(calls) == 4
+
+    ctrl.disable_metrics()
+    assert ctrl.metrics() == {}
+
+
+def test_timeouts_and_after_hooks():
+
+    line = CountingSerial(faults=DropReplies(1))
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.1)
+    outcomes = []
+    ctrl.enable_metrics(after=[lambda frame, reply, rtt, error:
+                               outcomes.append((reply is None, error))])
+
+    # the lost reply is requested again
+    ctrl[0].get_pos()
+
+    assert ctrl.metrics()['get_pos']['timeouts'] == 1
+    assert ctrl.metrics()['get_pos']['retries'] == 1
+    assert ctrl.metrics()['get_pos']['replies'] == 1
+    assert outcomes[0][0] and isinstance(outcomes[0][1], TimeoutError)
+    assert outcomes[1] == (False, None)
+
+
+def test_prometheus_text():
+
+    metrics = Metrics(buckets=(0.01, 0.1))
+    frame = bytes([0, 0x20] + (FRAME_LENGTH - 2) * [0])
+    metrics.after(frame, (), metrics.before(frame))
+    metrics.after(frame, (), metrics.before(frame) - 1.0)
+    metrics.suppress(0x10)
+
+    text = prometheus_text(metrics).splitlines()
+
+    assert '# TYPE sixpack2_frames_total counter' in text
+    assert 'sixpack2_frames_total{command="get_pos"} 2' in text
+    assert 'sixpack2_suppressed_total{command="set_peak_current"} 1' in text
+    assert 'sixpack2_rtt_seconds_bucket{command="get_pos",le="0.01"} 1' \
+        in text
+    assert 'sixpack2_rtt_seconds_bucket{command="get_pos",le="+Inf"} 2' \
+        in text
+    assert 'sixpack2_rtt_seconds_count{command="get_pos"} 2' in text
+    # no histogram for commands without replies
+    assert not any(line.startswith('sixpack2_rtt_seconds_count{command="set'
+                                   ) for line in text)
+
+
+def test_http_exporter(ctrl):
+
+    ctrl.enable_metrics()
+    ctrl[0].get_pos()
+    server = start_http_exporter(ctrl, port=0, addr='127.0.0.1')
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        with urlopen(url, timeout=5) as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert 'sixpack2_frames_total{command="get_pos"} 1' in body
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import time
+import asyncio
+
+import pytest
+
+from codec import (GET_POS, QUERY_ALL, SET_STARTVEL, SET_VELOCITY,
+                   SET_TARGETPOS, SET_VELACC, START_MULTI_MOVEMENT)
+from constants import DEFAULT_WAIT_TIMEOUT
+from motion import Ramp, ramp_params
+from Sixpack2Controller import Sixpack2Controller
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from conftest import CountingSerial
+
+
+def _positions(ramp, steps=200):
+    return [ramp.state(ramp.start + ramp.duration * i / steps)[0]
+            for i in range(steps + 1)]
+
+
+# =============================================================================
+# Ramp math
+# =============================================================================
+
+
+def test_trapezoidal_ramp():
+
+    ramp = Ramp(0, 1000, 10.0, v0=100.0, v1=500.0, a=1000.0)
+
+    # 0.4 s up and down (120 steps each), the rest at 500 steps/s
+    assert ramp.t_acc == pytest.approx(0.4)
+    assert ramp.t_cruise == pytest.approx(760 / 500)
+    assert ramp.end == pytest.approx(10.0 + 0.8 + 760 / 500)
+    assert ramp.state(10.0) == (0, 0.0)
+    assert ramp.state(10.4)[0] == pytest.approx(120)
+    assert ramp.state(10.4)[1] == pytest.approx(500)
+    assert ramp.state(ramp.end - 0.4)[0] == pytest.approx(880)
+    assert ramp.state(ramp.end) == (1000, 0.0)
+    assert ramp.state(ramp.end + 1) == (1000, 0.0)
+
+
+def test_triangular_ramp():
+
+    ramp = Ramp(0, 100, 0.0, v0=0.0, v1=500.0, a=1000.0)
+
+    # 500 steps/s are not reached on 100 steps
+    assert ramp.t_cruise == 0.0
+    assert ramp.vpeak == pytest.approx(316.23, abs=0.01)
+    assert ramp.state(ramp.t_acc)[0] == pytest.approx(50)
+    assert ramp.duration == pytest.approx(2 * ramp.t_acc)
+
+
+def test_constant_velocity_and_rest():
+
+    ramp = Ramp(0, 300, 0.0, v0=100.0, v1=100.0, a=1000.0)
+    assert ramp.duration == pytest.approx(3.0)
+    assert ramp.state(1.5) == (pytest.approx(150), 100.0)
+
+    rest = Ramp.at_rest(42, 5.0)
+    assert rest.duration == 0.0 and rest.distance == 0
+    assert rest.state(100.0) == (42, 0.0)
+
+    with pytest.raises(ValueError):
+        Ramp(0, 10, 0.0, v0=0.0, v1=0.0, a=1000.0)
+
+
+def test_ramp_is_continuous_and_symmetric():
+
+    ramp = Ramp(500, -500, 0.0, v0=50.0, v1=400.0, a=800.0)
+    positions = _positions(ramp)
+
+    assert ramp.direction == -1
+    assert all(p1 >= p2 for p1, p2 in zip(positions, positions[1:]))
+    assert max(abs(p1 - p2) for p1, p2 in zip(positions, positions[1:])) \
+        <= 400 * ramp.duration / 200 + 1e-9
+    # decelerating is accelerating backwards in time
+    for p1, p2 in zip(positions, reversed(positions)):
+        assert p1 - 500 == pytest.approx(-500 - p2)
+
+
+def test_elapsed_inverts_travelled():
+
+    for v0, v1, a in ((0.0, 500.0, 1000.0), (100.0, 500.0, 1000.0),
+                      (100.0, 100.0, 0.0)):
+        ramp = Ramp(0, 1000, 0.0, v0=v0, v1=v1, a=a)
+        for travelled in (0, 1, 60, 120, 500, 880, 999, 1000):
+            t = ramp._elapsed(travelled)
+            assert ramp._travelled(t)[0] == pytest.approx(travelled)
+
+
+def test_align_shifts_the_ramp():
+
+    ramp = Ramp(0, 1000, 0.0, v0=100.0, v1=500.0, a=1000.0)
+    ramp.align(120, 2.0)
+
+    assert ramp.start == pytest.approx(1.6)
+    assert ramp.state(2.0)[0] == pytest.approx(120)
+
+
+def test_ramp_params():
+
+    v0, v1, a = ramp_params(10, 1000, 300, 5, 0)
+
+    assert 0 < v0 < v1 and a > 0
+    # a maximum velocity below the start velocity jumps to the start
+    assert ramp_params(10, 5, 300, 5, 0)[1] == v0
+
+
+# =============================================================================
+# Estimates of a motor
+# =============================================================================
+
+
+def test_estimated_position_of_a_move(ctrl):
+
+    ctrl.set_velocity(5)
+    ctrl[0].set_startvel(1, 10, 0)
+    ctrl[0].set_velacc(1000, 300)
+    ctrl[0].set_actualpos(0)
+    ctrl[0].get_pos()
+
+    assert ctrl[0].estimated_pos() == 0
+    ctrl[0].start_ramp(2000)
+    arrival = ctrl[0].predicted_arrival()
+    assert arrival > time.monotonic()
+
+    time.sleep(0.05)
+    estimate = ctrl[0].estimated_pos()
+    posact = ctrl[0].get_pos()[0]
+    assert 0 < estimate < 2000
+    assert ctrl[0].estimated_pos() == pytest.approx(posact, abs=50)
+    assert ctrl[0].estimated_vel() > 0
+
+    ctrl.stop_motors()
+    assert ctrl[0].estimated_pos() is None
+
+
+def test_move_from_an_unknown_position(ctrl, line):
+
+    ctrl.set_velocity(5)
+    for motor in ctrl[:2]:
+        motor.set_startvel(1, 10, 0)
+        motor.set_velacc(1000, 300)
+    ctrl[0].start_ramp(2000)
+    assert ctrl[0].predicted_arrival() is None
+    assert ctrl._wait_timeout([ctrl[0]]) == DEFAULT_WAIT_TIMEOUT
+
+    # a position read bounds the rest of the move by a ramp from rest
+    time.sleep(0.05)
+    ctrl[0].get_pos()
+    assert ctrl[0].predicted_arrival() > time.monotonic()
+    assert ctrl._wait_timeout([ctrl[0]]) < DEFAULT_WAIT_TIMEOUT
+    ctrl.stop_motors()
+
+    # which wait_until_idle does before waiting
+    ctrl[1].start_ramp(500)
+    del line.written[:]
+    ctrl.wait_until_idle(2)
+
+    assert line.frames() == [GET_POS.opcode, QUERY_ALL.opcode]
+    assert ctrl[1].get_pos()[0] == 500
+
+
+def test_async_wait_reads_an_unknown_position():
+
+    line = CountingSerial(timeout=0.5)
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line, num_motors=1,
+                                           timeout=0.5) as ctrl:
+            await ctrl.set_velocity(5)
+            await ctrl[0].set_startvel(1, 10, 0)
+            await ctrl[0].set_velacc(1000, 300)
+            await ctrl[0].start_ramp(500)
+            del line.written[:]
+            await ctrl.wait_until_idle(1)
+            return (await ctrl[0].get_pos())[0]
+
+    assert asyncio.run(main()) == 500
+    assert line.frames()[:2] == [GET_POS.opcode, QUERY_ALL.opcode]
+
+
+# =============================================================================
+# Linear moves
+# =============================================================================
+
+
+def _ramps(ctrl):
+
+    ctrl.set_velocity(5)
+    for motor in ctrl:
+        motor.set_startvel(1, 10, 0)
+        motor.set_velacc(1000, 300)
+        motor.set_actualpos(0)
+        motor.get_pos()
+
+
+def _axis_duration(ctrl, motno, distance):
+
+    clkdiv, = ctrl._written[SET_VELOCITY.key(())]
+    _, _, vstart, divi = ctrl._written[SET_STARTVEL.key((motno,))]
+    _, amax, vmax = ctrl._written[SET_VELACC.key((motno,))]
+
+    return Ramp(0, distance, 0.0,
+                *ramp_params(vstart, vmax, amax, clkdiv, divi)).duration
+
+
+def test_move_linear_scales_the_axes(ctrl, line):
+
+    _ramps(ctrl)
+    del line.written[:]
+
+    duration = ctrl.move_linear({0: 2000, 1: -1000, ctrl[2]: 500})
+
+    assert len(line.written) == 1
+    assert line.frames().count(START_MULTI_MOVEMENT.opcode) == 1
+    assert line.frames().count(SET_TARGETPOS.opcode) == 3
+    vmax = [ctrl._written[SET_VELACC.key((motno,))][2]
+            for motno in range(3)]
+    # the longest axis runs at its own limit, the others slower
+    assert vmax[0] == 300
+    assert vmax[1] == pytest.approx(150, abs=1)
+    assert vmax[2] == pytest.approx(75, abs=1)
+    durations = [_axis_duration(ctrl, motno, distance)
+                 for motno, distance in enumerate((2000, 1000, 500))]
+    assert max(durations) == pytest.approx(duration)
+    assert max(durations) - min(durations) < 0.02 * duration
+
+
+def test_move_linear_arrives_together(ctrl):
+
+    _ramps(ctrl)
+    ctrl.move_linear({0: 2000, 1: -1000, 2: 500})
+
+    ctrl.wait_until_idle()
+
+    assert [motor.get_pos()[0] for motor in ctrl] == [2000, -1000, 500]
+
+
+def test_restore_limits(ctrl, line):
+
+    _ramps(ctrl)
+    ctrl.move_linear({0: 2000, 1: 1000})
+    ctrl.stop_motors()
+    # a second move scales from the user's settings again
+    ctrl.move_linear({0: 3000, 1: 1500})
+    assert ctrl._written[SET_VELACC.key((1,))][2] == pytest.approx(150,
+                                                                   abs=1)
+    del line.written[:]
+
+    assert ctrl.restore_limits([1]) == 2
+    assert ctrl._written[SET_VELACC.key((1,))] == (1, 1000, 300)
+    assert ctrl.restore_limits() == 2
+    assert ctrl.restore_limits() == 0
+    assert len(line.written) == 2
+
+
+def test_move_linear_needs_ramp_settings(ctrl):
+
+    other = Sixpack2Controller(transport=CountingSerial(), num_motors=1,
+                               timeout=0.5)
+
+    with pytest.raises(ValueError, match='ramp settings'):
+        ctrl.move_linear({0: 100})
+    with pytest.raises(ValueError, match='another controller'):
+        ctrl.move_linear({other[0]: 100})
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import pytest
+
+from codec import (CONTROL_CURRENT, REF_SEARCH_PARAMS, SET_PEAK_CURRENT,
+                   SET_STARTVEL, SET_VELACC, SET_VELOCITY)
+from motorprofile import Profile, _frame
+
+
+# =============================================================================
+# Translation of settings into frames
+# =============================================================================
+
+
+def test_single_value():
+
+    assert _frame(SET_PEAK_CURRENT, (1,), 100, 'peak') \
+        == (SET_PEAK_CURRENT, (1, 100))
+    assert _frame(SET_VELOCITY, (), 5, 'clkdiv') == (SET_VELOCITY, (5,))
+
+
+def test_named_values():
+
+    command, params = _frame(SET_STARTVEL, (0,),
+                             {'divi': 3, 'vstart': 10, 'vmin': 1}, 'start')
+
+    assert command is SET_STARTVEL
+    assert params == (0, 1, 10, 3)
+
+
+def test_current_levels():
+
+    _, params = _frame(CONTROL_CURRENT, (2,),
+                       {'T0': 1000, 'levels': [0, 50, 75, 100]}, 'current')
+
+    assert params == (2, 8, 2, 1, 0, 1000)
+
+
+def test_debounce_and_default():
+
+    _, params = _frame(REF_SEARCH_PARAMS, (0,),
+                       {'vrefmax': 100, 'debounce': 4}, 'ref')
+
+    assert params == (0, 100, 0b111, 0)
+
+
+@pytest.mark.parametrize('command, value', [
+    (SET_VELACC, 100),
+    (SET_VELACC, {'amax': 100}),
+    (SET_VELACC, {'amax': 100, 'vmax': 300, 'vmin': 1}),
+    (CONTROL_CURRENT, {'T0': 1000, 'levels': [0, 50, 100]}),
+    (CONTROL_CURRENT, {'T0': 1000, 'levels': [0, 50, 75, 99]}),
+    (REF_SEARCH_PARAMS, {'vrefmax': 100, 'debounce': 3}),
+    (SET_VELACC, {'amax': 100, 'vmax': 2**16}),
+])
+def test_invalid_values(command, value):
+
+    with pytest.raises(ValueError):
+        _frame(command, (0,), value, 'motor 0')
+
+
+# =============================================================================
+# Profiles
+# =============================================================================
+
+
+def test_profile_checked_when_created():
+
+    with pytest.raises(ValueError, match='unknown setting'):
+        Profile.from_dict({'motors': {0: {'speed': 3}}})
+    with pytest.raises(ValueError, match='unknown controller setting'):
+        Profile.from_dict({'clock': 5})
+
+
+def test_profile_motor_count():
+
+    profile = Profile.from_dict({'motors': [{}, {}, {'peak_current': 50}]})
+
+    assert profile.frames(3) == [(SET_PEAK_CURRENT, (2, 50))]
+    with pytest.raises(ValueError):
+        profile.frames(2)
+
+
+def test_apply_profile_sends_differences(ctrl, line):
+
+    profile = {'clkdiv': 5,
+               'motors': {0: {'peak_current': 100,
+                              'velacc': {'amax': 100, 'vmax': 300}}}}
+
+    assert ctrl.apply_profile(profile) == 3
+    assert len(line.written) == 1
+
+    profile['motors'][0]['peak_current'] = 90
+    assert ctrl.apply_profile(profile) == 1
+    assert line.frames()[-1] == SET_PEAK_CURRENT.opcode
+
+    assert ctrl.apply_profile(profile) == 0
+    assert ctrl.apply_profile(profile, force=True) == 3
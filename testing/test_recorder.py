@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import pytest
+
+from recorder import TelemetryRecorder, load_trace
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from Sixpack2Controller import Sixpack2Controller
+from simulator import Faults
+from conftest import CountingSerial
+
+np = pytest.importorskip('numpy')
+
+
+def test_ring_keeps_the_last_samples(ctrl, line):
+
+    for motor in ctrl:
+        motor.set_actualpos(100 * motor._motno)
+
+    rec = TelemetryRecorder(ctrl, capacity=4)
+    for _ in range(3):
+        rec.sample()
+
+    assert rec.count == 9
+    assert len(line.written) == 3 + 3
+    samples = rec.samples()
+    assert list(samples['motor']) == [2, 0, 1, 2]
+    assert list(samples['posact']) == [200, 0, 100, 200]
+    assert np.all(np.diff(samples['time']) > 0)
+    assert list(rec.samples(last=2)['motor']) == [1, 2]
+
+
+def test_spill_file_holds_all_samples(ctrl, tmp_path):
+
+    path = tmp_path / 'trace.bin'
+    ctrl[1].set_actualpos(-5)
+
+    rec = TelemetryRecorder(ctrl, motors=ctrl[:2], capacity=4, spill=path)
+    for _ in range(5):
+        rec.sample()
+    rec.stop()
+
+    trace = load_trace(path)
+    assert isinstance(trace, np.memmap)
+    assert len(trace) == 10
+    assert list(trace['motor']) == 5 * [0, 1]
+    assert list(trace['posact'][1::2]) == 5 * [-5]
+
+
+def test_empty_trace(tmp_path):
+
+    path = tmp_path / 'trace.bin'
+    path.touch()
+
+    assert len(load_trace(path)) == 0
+
+
+def test_recorder_thread(ctrl):
+
+    rec = TelemetryRecorder(ctrl, capacity=16, rate=100)
+    rec.start()
+    try:
+        while rec.cycles < 3:
+            rec._stopped.wait(0.01)
+    finally:
+        rec.stop()
+
+    assert rec.errors == 0
+    assert rec.count >= 3 * len(ctrl)
+
+
+class DropReply(Faults):
+    """
+    Loses the n-th reply of the PACK
+    """
+
+    def __init__(self, n):
+
+        Faults.__init__(self)
+        self.n = n
+
+    def apply(self, reply):
+
+        self.n -= 1
+
+        return 0.0, b'' if self.n == 0 else reply
+
+
+def test_missing_reply_skips_the_motor():
+
+    # the get_vel reply of the last motor
+    line = CountingSerial(faults=DropReply(6))
+    ctrl = Sixpack2Controller(transport=line, num_motors=3, timeout=0.1)
+    ctrl.retries = 0
+
+    rec = TelemetryRecorder(ctrl)
+    rec.sample()
+    rec.sample()
+
+    assert rec.errors == 1
+    assert isinstance(rec.last_error, TimeoutError)
+    assert list(rec.samples()['motor']) == [0, 1, 0, 1, 2]
+
+
+def test_async_controller_rejected():
+
+    ctrl = AsyncSixpack2Controller(transport=CountingSerial(), num_motors=1)
+
+    with pytest.raises(TypeError, match='blocking'):
+        TelemetryRecorder(ctrl)
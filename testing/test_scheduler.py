@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import time
+import asyncio
+
+import pytest
+
+from codec import GET_POS
+from scheduler import (BusScheduler, TrafficClass, default_classes,
+                       slot_times)
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from conftest import CountingSerial
+
+
+def _recorder(times):
+
+    def request(item):
+        times.append((time.monotonic(), item))
+
+    return request
+
+
+# =============================================================================
+# Budget
+# =============================================================================
+
+
+def test_slot_times(ctrl):
+
+    frame, slot = slot_times(ctrl)
+
+    assert frame == pytest.approx(90 / 19200)
+    assert slot == pytest.approx(2 * 90 / 19200 + 0.003)
+
+
+def test_budget_within_capacity(ctrl):
+
+    scheduler = BusScheduler(ctrl, [TrafficClass('a', 5, None, [0, 1]),
+                                    TrafficClass('b', 2, None, [0])])
+    capacity, demand, rates = scheduler.budget()
+
+    assert capacity == pytest.approx(0.8 / slot_times(ctrl)[1])
+    assert demand == 12
+    assert rates == {'a': 5, 'b': 2}
+
+
+def test_budget_scaled_down(ctrl):
+
+    scheduler = BusScheduler(ctrl, [TrafficClass('a', 100, None, [0, 1]),
+                                    TrafficClass('b', 40, None, [0, 1, 2])],
+                             share=0.5)
+    capacity, demand, rates = scheduler.budget()
+
+    assert demand == 320
+    # all classes are scaled by the same factor to fill the budget
+    assert rates['a'] / rates['b'] == pytest.approx(100 / 40)
+    assert 2 * rates['a'] + 3 * rates['b'] == pytest.approx(capacity)
+
+    ctrl.transmitter_delay = 0
+    assert scheduler.budget()[0] > capacity
+
+
+def test_budget_follows_active_items(ctrl):
+
+    active = {0}
+    scheduler = BusScheduler(ctrl, [TrafficClass('a', 100, None, [0, 1, 2],
+                                                 active.__contains__)])
+
+    assert scheduler.budget()[1] == 100
+    active.update((1, 2))
+    assert scheduler.budget()[1] == 300
+
+
+def test_invalid_budgets(ctrl):
+
+    with pytest.raises(ValueError):
+        TrafficClass('a', 0, None, [0])
+    with pytest.raises(ValueError):
+        BusScheduler(ctrl, [], share=0)
+    with pytest.raises(ValueError):
+        BusScheduler(ctrl, [], share=1.5)
+
+
+# =============================================================================
+# Scheduling
+# =============================================================================
+
+
+def test_requests_are_spaced_by_the_budget(ctrl):
+
+    times = []
+    scheduler = ctrl.start_scheduler(
+        [TrafficClass('a', 1000, _recorder(times), [0, 1, 2])], share=0.5)
+    time.sleep(0.5)
+    ctrl.stop_poller()
+
+    capacity = scheduler.budget()[0]
+    assert scheduler.scale == pytest.approx(capacity / 3000)
+    # the worker which lets commands jump ahead was started
+    assert ctrl._worker is not None and ctrl._worker.is_alive()
+    assert scheduler.sent['a'] == len(times)
+    assert 0.3 * capacity <= len(times) <= 0.5 * capacity + 2
+    gaps = [t2 - t1 for (t1, _), (t2, _) in zip(times, times[1:])]
+    assert min(gaps) >= 0.9 / capacity
+    # the items take turns
+    assert [item for _, item in times[:6]] == [0, 1, 2, 0, 1, 2]
+
+
+def test_default_classes_poll_moving_motors_faster(ctrl, line):
+
+    ctrl.set_velocity(5)
+    ctrl[0].set_startvel(1, 10, 0)
+    ctrl[0].set_velacc(1000, 300)
+    ctrl[0].set_actualpos(0)
+    ctrl.stop_motors()
+    ctrl[0].rotate(100)
+    ctrl[0].get_pos()
+    del line.written[:]
+
+    scheduler = ctrl.start_scheduler(moving=40, idle=4)
+    time.sleep(0.5)
+    ctrl.stop_poller()
+    ctrl.stop_motors()
+
+    assert [cls.name for cls in scheduler.classes] == ['moving', 'idle']
+    assert scheduler.errors == 0
+    polled = [chunk[2] for chunk in line.written
+              if chunk[1] == GET_POS.opcode]
+    assert polled.count(0) > 3 * max(polled.count(1), polled.count(2))
+
+
+def test_default_classes(ctrl):
+
+    classes = default_classes(ctrl, motors=ctrl[:2], channels=(0, 1))
+
+    assert [(cls.name, cls.rate) for cls in classes] == [('moving', 50.0),
+                                                         ('idle', 2.0),
+                                                         ('inputs', 10.0)]
+    assert [motor._motno for motor in classes[1].selected()] == [0, 1]
+    assert classes[0].selected() == []
+
+
+def test_async_scheduler():
+
+    times = []
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=CountingSerial(),
+                                           num_motors=2) as ctrl:
+            scheduler = ctrl.start_scheduler(
+                [TrafficClass('a', 1000, _recorder(times), [0, 1]),
+                 TrafficClass('pos', 10, lambda motor: motor.get_pos(),
+                              ctrl)])
+            await asyncio.sleep(0.3)
+            ctrl.stop_poller()
+            return scheduler
+
+    scheduler = asyncio.run(main())
+
+    assert not scheduler.is_alive()
+    assert scheduler.scale < 1
+    assert scheduler.errors == 0
+    assert scheduler.sent['pos'] >= 2
+    assert len(times) <= 0.3 * scheduler.budget()[0] + 2
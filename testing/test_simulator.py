@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import time
+
+import pytest
+
+from codec import FRAME_LENGTH
+from simulator import Faults, PtySimulator, VirtualSixpack2
+from Sixpack2Controller import Sixpack2Controller
+from conftest import CountingSerial
+
+
+def test_virtual_motor_moves_to_target(ctrl):
+
+    ctrl[2].set_actualpos(-100)
+    ctrl[2].start_ramp(100)
+
+    assert ctrl[2].get_pos()[1] == 'ramping'
+    ctrl.wait_until_idle('100')
+    assert ctrl[2].get_pos() == (100, 'inactive', 0)
+
+
+def test_rotation_and_stop(ctrl):
+
+    ctrl[0].rotate(-50)
+    _, velocity, action = ctrl[0].get_vel()
+    ctrl.stop_motors('1')
+    ctrl.wait_until_idle('1', timeout=5)
+
+    assert velocity < 0 and action == 'rotation'
+    assert ctrl[0].get_vel()[1:] == (0, 'inactive')
+
+
+def test_unit_info_reports_the_reset_once():
+
+    device = VirtualSixpack2(serial_number=1234)
+    ctrl = Sixpack2Controller(transport=CountingSerial(device),
+                              num_motors=1, timeout=0.5)
+
+    firmware, reset_flag, _, serial = ctrl.get_unit_info()
+    assert (reset_flag, serial) == (1, 1234)
+    assert ctrl.get_unit_info()[1] == 0
+    ctrl.complete_hwreset()
+    assert ctrl.get_unit_info()[1] == 1
+
+
+def test_line_takes_the_frame_times(ctrl):
+
+    start = time.monotonic()
+    for _ in range(5):
+        ctrl[0].get_pos()
+
+    # request and reply of 9 bytes, 10 bits each
+    assert time.monotonic() - start > 5 * 2 * FRAME_LENGTH * 10 / 19200
+
+
+def test_dropped_replies():
+
+    line = CountingSerial(faults=Faults(drop_reply=1.0), timeout=0.05)
+    ctrl = Sixpack2Controller(transport=line, num_motors=1, timeout=0.05)
+
+    with pytest.raises(TimeoutError):
+        ctrl[0].get_pos()
+
+
+def test_pty_simulator():
+
+    sim = PtySimulator(VirtualSixpack2(serial_number=77)).start()
+    try:
+        ctrl = Sixpack2Controller(port=sim.port, num_motors=1, timeout=1)
+        assert ctrl.get_unit_info()[3] == 77
+        ctrl._ser.close()
+    finally:
+        sim.stop()
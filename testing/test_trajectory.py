@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from queue import Full
+
+import pytest
+
+from codec import START_PARALLEL_RAMP, START_RAMP, STOP_MOTORS
+from trajectory import TrajectoryExecutor, read_points
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from conftest import CountingSerial
+
+
+@pytest.fixture
+def axes(ctrl):
+
+    ctrl.set_velocity(5)
+    for motor in ctrl:
+        motor.set_startvel(1, 10, 0)
+        motor.set_velacc(1000, 300)
+        motor.set_actualpos(0)
+        motor.get_pos()
+
+    return ctrl[:2]
+
+
+def test_execute_runs_all_segments(ctrl, line, axes):
+
+    ex = TrajectoryExecutor(ctrl, axes)
+
+    assert ex.execute([(200, 100), (400, 100), (400, 300)]) == 3
+    assert [motor.get_pos()[0] for motor in axes] == [400, 300]
+    frames = line.frames()
+    # a single moving axis is started with start_ramp
+    assert frames.count(START_PARALLEL_RAMP.opcode) == 1
+    assert frames.count(START_RAMP.opcode) == 2
+
+
+def test_points_are_consumed_lazily(ctrl, axes):
+
+    ex = TrajectoryExecutor(ctrl, axes, lookahead=2)
+    ahead = []
+
+    def points():
+        for i in range(1, 9):
+            ahead.append(i - ex.segments)
+            yield 50 * i, -50 * i
+
+    assert ex.execute(points()) == 8
+    # the running segment, the encoded one and the lookahead window
+    assert max(ahead) <= 2 + 2
+
+
+def test_put_blocks_while_the_window_is_full(ctrl, axes):
+
+    ex = TrajectoryExecutor(ctrl, axes, lookahead=1)
+    ex.put((10, 10))
+
+    with pytest.raises(Full):
+        ex.put((20, 20), timeout=0.05)
+
+    ex.start()
+    ex.put((20, 20), timeout=5)
+    ex.close()
+    ex.join(5)
+    assert ex.segments == 2 and ex.error is None
+
+
+def test_stop_aborts_the_trajectory(ctrl, line, axes):
+
+    ex = TrajectoryExecutor(ctrl, axes)
+    ex.start()
+    ex.put((100000, 100000))
+    while not ex.segments:
+        ex._stopped.wait(0.01)
+    ex.stop()
+
+    assert line.frames()[-1] == STOP_MOTORS.opcode
+    with pytest.raises(RuntimeError, match='stopped'):
+        ex.put((0, 0))
+
+
+def test_errors_stop_the_executor(ctrl, axes):
+
+    ex = TrajectoryExecutor(ctrl, axes)
+
+    with pytest.raises(ValueError, match='coordinates'):
+        ex.execute([(10, 10), (1, 2, 3)])
+    with pytest.raises(ValueError):
+        TrajectoryExecutor(ctrl, axes, lookahead=0)
+    with pytest.raises(TypeError):
+        TrajectoryExecutor(AsyncSixpack2Controller(
+            transport=CountingSerial(), num_motors=2), axes)
+
+
+def test_read_points(tmp_path):
+
+    path = tmp_path / 'path.csv'
+    path.write_text('x,y,z\n# comment\n1,2,3\n\n4.0,5,6\n')
+
+    assert list(read_points(path, columns=['z', 'x'])) == [(3, 1), (6, 4)]
+    path.write_text('1;2\n3;4\n')
+    assert list(read_points(path, delimiter=';')) == [(1, 2), (3, 4)]
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import time
+import asyncio
+from threading import Thread
+
+from codec import (GET_POS, QUERY_ALL, SET_PEAK_CURRENT, START_RAMP,
+                   STOP_MOTORS)
+from AsyncSixpack2Controller import AsyncSixpack2Controller
+from conftest import CountingSerial
+
+# frames written while wait_until_idle waits for a long move of motor 0
+EXPECTED = [START_RAMP.opcode, QUERY_ALL.opcode, STOP_MOTORS.opcode,
+            SET_PEAK_CURRENT.opcode, GET_POS.opcode]
+
+
+def test_priorities_and_preemption(ctrl, line):
+
+    worker = ctrl.start_worker()
+    ctrl[0].start_ramp(10**6)
+
+    results = []
+    waiting = Thread(target=lambda: results.append(
+        ctrl.wait_until_idle('001', timeout=10)))
+    waiting.start()
+    time.sleep(0.1)
+
+    # queued behind the delayed query_all, telemetry submitted first
+    pos = ctrl.submit(GET_POS, 0, ctrl._resp_addr)
+    peak = ctrl.submit(SET_PEAK_CURRENT, 1, 50)
+    stop = ctrl.submit(STOP_MOTORS, 0b001)
+
+    stop.result(timeout=1)
+    assert not pos.done() and not peak.done()
+    waiting.join(timeout=10)
+    assert results
+    assert pos.result(timeout=1)[2] == 0
+    peak.result(timeout=1)
+
+    assert worker.preempted == 1
+    assert line.frames() == EXPECTED
+
+
+def test_async_priorities_and_preemption():
+
+    line = CountingSerial()
+
+    async def main():
+        async with AsyncSixpack2Controller(transport=line, num_motors=3,
+                                           timeout=0.5) as ctrl:
+            worker = ctrl.start_worker()
+            await ctrl[0].start_ramp(10**6)
+
+            waiting = asyncio.ensure_future(
+                ctrl.wait_until_idle('001', timeout=10))
+            await asyncio.sleep(0.1)
+            pos = asyncio.ensure_future(ctrl[0].get_pos())
+            peak = asyncio.ensure_future(ctrl[1].set_peak_current(50))
+            await asyncio.sleep(0)
+
+            await asyncio.wait_for(ctrl.stop_motors('001'), 1)
+            assert not pos.done() and not peak.done()
+            await asyncio.wait_for(waiting, 10)
+            await asyncio.gather(pos, peak)
+
+            return worker.preempted
+
+    assert asyncio.run(main()) == 1
+    assert line.frames() == EXPECTED
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+import csv
+from time import monotonic
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from asyncio import iscoroutinefunction
+from codec import SET_TARGETPOS, START_RAMP, START_PARALLEL_RAMP
+from constants import TRAJECTORY_LEAD
+
+# end of the point stream (see TrajectoryExecutor.close) and interval (s)
+# at which waiting threads check whether the executor was stopped
+_END = object()
+POLL_INTERVAL = 0.1
+
+
+# =============================================================================
+# Point sources
+# =============================================================================
+
+
+def read_points(path, columns=None, delimiter=','):
+    """
+    Yields the points of a CSV file one at a time (without reading the
+    whole file) as tuples of ints; columns selects and orders the columns
+    (indices or header names, default: all). Lines starting with '#' and
+    empty lines are skipped, a header line is taken if columns are named.
+    """
+
+    with open(path, newline='') as f:
+        rows = csv.reader((line for line in f
+                           if line.strip() and not line.startswith('#')),
+                          delimiter=delimiter)
+        if columns is not None and any(isinstance(c, str) for c in columns):
+            header = next(rows)
+            columns = [header.index(c) if isinstance(c, str) else c
+                       for c in columns]
+        for row in rows:
+            if columns is not None:
+                row = [row[c] for c in columns]
+            yield tuple(int(float(value)) for value in row)
+
+    return None
+
+
+# =============================================================================
+# Streaming executor
+# =============================================================================
+
+
+class TrajectoryExecutor(Thread):
+    """
+    Thread driving motors through a stream of points: one target position
+    per motor (None: axis does not move), e.g. tuples, rows of a NumPy
+    array or read_points. Every point is a segment started with
+    start_parallel_ramp; segment boundaries are found with the delayed
+    response of query_all, after sleeping until the predicted arrival (see
+    motion.py) so that the line stays free for other traffic meanwhile.
+
+        ex = TrajectoryExecutor(ctrl, [ctrl[0], ctrl[1]])
+        ex.execute(read_points('path.csv'))
+
+    or, with a producer pushing points from another thread:
+
+        ex.start()
+        ex.put(point)       # blocks while lookahead points are waiting
+        ex.close()
+        ex.join()
+
+    The frames of the next segment are encoded while the current segment
+    runs and written with a single write at the boundary. At most
+    lookahead points are buffered, so producers are slowed down to the
+    pace of the motors instead of filling memory.
+    """
+
+    def __init__(self, ctrl, motors, lookahead=8, predict=True):
+
+        Thread.__init__(self, name='Sixpack2Trajectory', daemon=True)
+
+        if iscoroutinefunction(ctrl._flush):
+            raise TypeError('TrajectoryExecutor needs a blocking controller')
+        if lookahead < 1:
+            raise ValueError('lookahead has to be positive ({})'
+                             .format(lookahead))
+
+        self._ctrl = ctrl
+        self.motors = list(motors)
+        self.predict = predict
+        self._points = Queue(maxsize=lookahead)
+        self._stopped = Event()
+
+        self.segments = 0
+        self.error = None
+
+    # ------------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------------
+
+    def _offer(self, point, timeout=None):
+        """
+        Queues a point, waiting while the lookahead window is full; returns
+        False if the executor has stopped meanwhile
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self._stopped.is_set():
+            wait = POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    raise Full
+            try:
+                self._points.put(point, timeout=wait)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def put(self, point, timeout=None):
+        """
+        Appends a point, waiting while the lookahead window is full (raises
+        queue.Full after timeout seconds). Raises RuntimeError if the
+        executor has stopped.
+        """
+
+        if not self._offer(point, timeout):
+            raise RuntimeError('trajectory executor stopped ({!r})'
+                               .format(self.error))
+
+        return None
+
+    def close(self):
+        """
+        Marks the end of the stream: the executor finishes the buffered
+        points and ends
+        """
+
+        self.put(_END)
+
+        return None
+
+    def execute(self, points):
+        """
+        Runs the trajectory given by the iterable points (consumed lazily)
+        and returns once the last segment is finished. Re-raises the error
+        which stopped the executor.
+        """
+
+        self.start()
+        try:
+            for point in points:
+                if not self._offer(point):
+                    break
+            else:
+                self._offer(_END)
+        except BaseException:
+            self.stop()
+            raise
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+        return self.segments
+
+    def stop(self, join=True):
+        """
+        Aborts the trajectory and stops the motors
+        """
+
+        self._stopped.set()
+        if join and self.is_alive():
+            self.join()
+
+        return None
+
+    # ------------------------------------------------------------------------
+    # Executor thread
+    # ------------------------------------------------------------------------
+
+    def _next(self):
+
+        while not self._stopped.is_set():
+            try:
+                point = self._points.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            if point is _END:
+                return None
+            return self._encode(point)
+
+        return None
+
+    def _encode(self, point):
+        """
+        Encodes a segment: the targets of the axes which move, with their
+        set_targetpos frames, the motor mask and the start frame
+        (start_ramp if only one axis moves)
+        """
+
+        if len(point) != len(self.motors):
+            raise ValueError('point {} has {} coordinates for {} motors'
+                             .format(point, len(point), len(self.motors)))
+
+        addr = self._ctrl._sixpack_addr
+        targets = []
+        mask = 0
+        for motor, targetpos in zip(self.motors, point):
+            if targetpos is None:
+                continue
+            targetpos = int(targetpos)
+            if targetpos == motor._targetpos:
+                continue
+            frame = SET_TARGETPOS.pack(addr, motor._motno, targetpos)
+            targets.append((motor, targetpos, frame))
+            mask |= 1 << motor._motno
+
+        if len(targets) == 1:
+            motor, targetpos, _ = targets[0]
+            start = START_RAMP.pack(addr, motor._motno, targetpos)
+        else:
+            start = START_PARALLEL_RAMP.pack(addr, mask)
+
+        return targets, mask, start
+
+    def _preload(self, segment, running):
+        """
+        Writes the targets of the next segment for the axes standing still
+        in the current one (running: their mask): setting the target of a
+        motor which does not ramp does not start it. Returns the mask of
+        the preloaded axes.
+        """
+
+        targets, mask, _ = segment
+        batch = [(frame, None, None, None) for motor, _, frame in targets
+                 if not running >> motor._motno & 1]
+        if len(batch) == len(targets) == 1:
+            # start_ramp sets the target itself
+            return 0
+        if batch:
+            self._ctrl._send_batch(batch)
+
+        return mask & ~running
+
+    def _start(self, segment, preloaded):
+        """
+        Writes the remaining targets and the start of a segment
+        """
+
+        targets, mask, start = segment
+        if len(targets) == 1 and not preloaded:
+            batch = [(start, None, None, None)]
+        else:
+            batch = [(frame, None, None, None) for motor, _, frame in targets
+                     if not preloaded >> motor._motno & 1]
+            batch.append((start if len(targets) > 1 else
+                          START_PARALLEL_RAMP.pack(self._ctrl._sixpack_addr,
+                                                   mask), None, None, None))
+        self._ctrl._send_batch(batch)
+        for motor, targetpos, _ in targets:
+            motor._start_move(targetpos)
+        self.segments += 1
+
+        return None
+
+    def _wait(self, segment):
+        """
+        Waits until the motors of the segment have arrived
+        """
+
+        targets, mask, _ = segment
+        if self.predict:
+            arrivals = [motor.predicted_arrival() for motor, _, _ in targets]
+            if None not in arrivals:
+                delay = max(arrivals) - TRAJECTORY_LEAD - monotonic()
+                if delay > 0:
+                    self._stopped.wait(delay)
+        if not self._stopped.is_set():
+            self._ctrl.wait_until_idle(mask)
+
+        return None
+
+    def run(self):
+
+        ctrl = self._ctrl
+        try:
+            segment = self._next()
+            preloaded = 0
+            while segment is not None and not self._stopped.is_set():
+                if segment[1]:
+                    self._start(segment, preloaded)
+                # encode the next segment while this one runs
+                following = self._next()
+                preloaded = 0
+                if following is not None and following[1]:
+                    preloaded = self._preload(following, segment[1])
+                if segment[1]:
+                    self._wait(segment)
+                segment = following
+        except Exception as error:
+            self.error = error
+            self._stopped.set()
+
+        if self._stopped.is_set():
+            mask = 0
+            for motor in self.motors:
+                mask |= 1 << motor._motno
+            try:
+                ctrl.stop_motors(mask)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+        self._stopped.set()
+
+        return None
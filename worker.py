@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import asyncio
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Condition
+from contextlib import asynccontextmanager
+from concurrent.futures import Future
+from codec import *
+
+# =============================================================================
+# Priorities of the frames (lower is sent first)
+# =============================================================================
+
+EMERGENCY = 0
+NORMAL = 1
+TELEMETRY = 2
+
+PRIORITIES = {STOP_MOTORS.opcode: EMERGENCY,
+              ABORT_REF_SEARCH.opcode: EMERGENCY,
+              GET_POS.opcode: TELEMETRY,
+              GET_VEL.opcode: TELEMETRY,
+              READ_INPUT_CHANNELS.opcode: TELEMETRY}
+
+
+def _is_delayed(frame):
+    """
+    True for query_all with a motor mask: the PACK answers only once the
+    motors have stopped
+    """
+
+    return frame[1] == QUERY_ALL.opcode and frame[3] != 0
+
+
+def _priority(frames):
+    """
+    Priority of a frame or of the frames of a transaction
+    """
+
+    return min((PRIORITIES.get(frame[1], NORMAL) for frame in frames),
+               default=NORMAL)
+
+
+# =============================================================================
+# I/O worker
+# =============================================================================
+
+
+class IOWorker(Thread):
+    """
+    Daemon thread owning the serial port of a controller (see
+    Sixpack2Controller.start_worker), or of all units on a bus (see
+    Sixpack2Bus). Frames submitted from any thread are sent in order of
+    priority, each submitter gets a Future. Within a priority the frames
+    of a controller are sent first come first served, the controllers
+    take turns (round robin).
+
+    While waiting for a delayed reply (wait_until_idle), emergency commands
+    are written as soon as they are submitted; everything else waits.
+    """
+
+    def __init__(self, ctrl=None):
+
+        Thread.__init__(self, name='Sixpack2IOWorker', daemon=True)
+
+        # controller of frames submitted without one
+        self._ctrl = ctrl
+        self._queue = []
+        self._seq = count()
+        self._cond = Condition()
+        self._stopped = False
+
+        # round of the last job taken and next round of each controller
+        # (by id), see _put
+        self._round = 0
+        self._rounds = {}
+
+        self.jobs = 0
+        self.preempted = 0
+
+    # ------------------------------------------------------------------------
+    # submitting
+    # ------------------------------------------------------------------------
+
+    def _put(self, priority, job):
+        """
+        Queues job (its first item is the controller) in the round after
+        the previous job of its controller, or in the current round if the
+        controller was idle. Jobs of the same priority are taken by round,
+        so a busy controller cannot starve the others.
+        """
+
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('I/O worker is stopped')
+            key = id(job[0])
+            turn = max(self._round, self._rounds.get(key, 0))
+            self._rounds[key] = turn + 1
+            heappush(self._queue, (priority, turn, next(self._seq), job,
+                                   future))
+            self._cond.notify()
+
+        return future
+
+    def submit(self, frame, request=None, timeout=None, priority=None,
+               ctrl=None):
+        """
+        Queues a frame (request: the command of a request frame, None for
+        commands) of ctrl (default: the controller of the worker). The
+        Future is resolved with the decoded reply, None for commands.
+        """
+
+        if priority is None:
+            priority = PRIORITIES.get(frame[1], NORMAL)
+
+        return self._put(priority, (self._ctrl if ctrl is None else ctrl,
+                                    frame, request, timeout))
+
+    def submit_batch(self, batch, gap=0, priority=None, ctrl=None):
+        """
+        Queues the frames of a transaction, flushed together
+        (see Sixpack2Controller._flush)
+        """
+
+        if priority is None:
+            priority = _priority(frame for frame, _, _, _ in batch)
+
+        return self._put(priority, (self._ctrl if ctrl is None else ctrl,
+                                    batch, gap))
+
+    # ------------------------------------------------------------------------
+    # processing
+    # ------------------------------------------------------------------------
+
+    def run(self):
+
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                _, self._round, _, job, future = heappop(self._queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with job[0]._io_lock:
+                    result = self._execute(job)
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            self.jobs += 1
+
+        return None
+
+    def _execute(self, job):
+
+        if len(job) == 3:
+            ctrl, batch, gap = job
+            return ctrl._flush(batch, gap)
+
+        ctrl, frame, request, timeout = job
+        if request is None:
+            return ctrl._write_frame(frame)
+
+        preempt = self._preempt if _is_delayed(frame) else None
+
+        return ctrl._exchange(frame, request, timeout, preempt)
+
+    def _preempt(self):
+        """
+        Writes the queued emergency commands (called while waiting for a
+        delayed reply)
+        """
+
+        while True:
+            with self._cond:
+                if not self._queue or self._queue[0][0] != EMERGENCY:
+                    return None
+                _, _, _, job, future = self._queue[0]
+                if len(job) == 3 or job[2] is not None:
+                    # emergency requests have to wait for the line
+                    return None
+                heappop(self._queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                job[0]._write_frame(job[1])
+            except BaseException as error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+            self.preempted += 1
+
+    def stop(self, join=True):
+        """
+        Stops the worker after the queued frames have been sent
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if join and self.is_alive():
+            self.join()
+
+        return None
+
+
+class AsyncIOWorker(object):
+    """
+    asyncio counterpart of IOWorker (see AsyncSixpack2Controller.
+    start_worker), without a thread: the tasks waiting for the port get
+    it in order of priority, first come first served within a priority.
+
+    While the port waits for a delayed reply (wait_until_idle), emergency
+    commands are written without waiting (see preempts).
+    """
+
+    def __init__(self):
+
+        # (priority, sequence, future resolved when it is the task's turn)
+        self._queue = []
+        self._seq = count()
+        self._busy = False
+        # the task holding the port waits for a delayed reply
+        self.waiting = False
+
+        self.jobs = 0
+        self.preempted = 0
+
+    @asynccontextmanager
+    async def port(self, frames):
+        """
+        Holds the port for frames (of a transaction), in turn by their
+        priority
+        """
+
+        await self._acquire(_priority(frames))
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority):
+
+        if not self._busy:
+            self._busy = True
+            return None
+
+        turn = asyncio.get_running_loop().create_future()
+        heappush(self._queue, (priority, next(self._seq), turn))
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # the port was handed over meanwhile, pass it on
+                self._release()
+            raise
+
+        return None
+
+    def _release(self):
+
+        self.jobs += 1
+        while self._queue:
+            _, _, turn = heappop(self._queue)
+            if not turn.done():
+                turn.set_result(None)
+                return None
+        self._busy = False
+
+        return None
+
+    def preempts(self, frame):
+        """
+        True if frame is an emergency command and the port waits for a
+        delayed reply, so it is written at once (see IOWorker._preempt)
+        """
+
+        return self.waiting and _priority([frame]) == EMERGENCY
+
+    def stop(self, join=True):
+        """
+        Nothing to stop: the tasks already waiting get the port in turn,
+        later ones first come first served
+        """
+
+        return None